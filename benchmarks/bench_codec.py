@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+
+"""
+Compare the JSON codecs available to dastardcommander on typical Dastard payloads.
+
+usage:
+
+python benchmarks/bench_codec.py [--nchan N] [--repeat R] [--recording FILE]
+
+Payloads are synthetic, sized for N channels, unless a recording of a real Dastard
+stream (made with `python -m dastardcommander.recording record`) is given; then the
+last message on each topic in the recording is used. For each codec, reports the time
+to decode each ZMQ status topic (via decodeStatus, so including the conversion of
+per-channel lists to NumPy arrays) and to encode a typical JSON-RPC request.
+"""
+
+import argparse
+import json
+import time
+
+import numpy as np
+
+from dastardcommander import codec, recording
+
+
+def syntheticPayloads(nchan):
+    """Return a list of (topic, payload bytes) shaped like Dastard's messages for a
+    TDM system with nchan channels (half signal, half error)."""
+    rng = np.random.default_rng(1)
+    ngroups = max(1, nchan//64)
+    nrow = max(1, nchan//(2*ngroups))
+    status = {
+        "Running": True, "SourceName": "Lancero", "Nchannels": nchan,
+        "Nsamples": 1024, "Npresamp": 256, "SamplePeriod": 7360,
+        "ChanGroups": [{"Firstchan": i*nrow, "Nchan": nrow} for i in range(ngroups)],
+    }
+    trigger = [{
+        "ChannelIndices": list(range(1, nchan, 2)), "AutoTrigger": False, "AutoDelay": 0,
+        "EdgeTrigger": True, "EdgeRising": True, "EdgeFalling": False, "EdgeLevel": 100,
+        "EdgeMulti": False, "LevelTrigger": False, "LevelRising": False,
+        "LevelFalling": False, "LevelLevel": 0,
+    }]
+    messages = {
+        "ALIVE": {"Alive": True, "Running": True, "DataMB": 12.5, "HWactualMB": 12.5,
+                  "Time": 1.0},
+        "STATUS": status,
+        "TRIGGER": trigger,
+        "TRIGGERRATE": {"CountsSeen": rng.poisson(20, nchan).tolist(),
+                        "Duration": 1000000000},
+        "NUMBERWRITTEN": {"NumberWritten": rng.integers(0, 100000, nchan).tolist()},
+        "CHANNELNAMES": ["%s%d" % (p, i) for i in range(1, nchan//2+1) for p in ("err", "chan")],
+    }
+    return [(topic, json.dumps(msg).encode()) for topic, msg in messages.items()]
+
+
+def recordedPayloads(filename):
+    """Return a list of (topic, payload bytes) with the last message on each topic."""
+    last = {}
+    for _, topic, contents in recording.readRecording(filename):
+        last[topic.decode()] = contents
+    return sorted(last.items())
+
+
+def timeit(func, repeat):
+    tstart = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter()-tstart)/repeat
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--nchan", type=int, default=4096, help="number of channels")
+    parser.add_argument("--repeat", type=int, default=200, help="repetitions per timing")
+    parser.add_argument("--recording", help="use payloads from this ZMQ stream recording")
+    args = parser.parse_args()
+
+    if args.recording:
+        payloads = recordedPayloads(args.recording)
+        source = args.recording
+    else:
+        payloads = syntheticPayloads(args.nchan)
+        source = "%d synthetic channels" % args.nchan
+    triggers = json.loads(dict(payloads).get("TRIGGER", b"[{}]"))
+    request = {"id": 1, "method": "SourceControl.ConfigureTriggers", "params": triggers[:1]}
+    names = list(codec.CODECS.keys())
+    print("Microseconds per call, %s (codecs installed: %s)" % (source, ", ".join(names)))
+    print("%-16s %9s" % ("topic", "bytes") + "".join("%11s" % n for n in names))
+    for topic, payload in payloads:
+        times = [timeit(lambda: c.decodeStatus(topic, payload), args.repeat)
+                 for c in codec.CODECS.values()]
+        print("%-16s %9d" % (topic, len(payload)) + "".join("%11.1f" % (1e6*t) for t in times))
+    times = [timeit(lambda: c.encode(request), args.repeat) for c in codec.CODECS.values()]
+    print("%-16s %9s" % ("encode request", "") + "".join("%11.1f" % (1e6*t) for t in times))
+
+
+if __name__ == "__main__":
+    main()
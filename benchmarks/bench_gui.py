@@ -0,0 +1,321 @@
+#!/usr/bin/env python3
+
+"""
+Time the GUI's handling of Dastard messages, for arrays of increasing size.
+
+usage:
+
+python benchmarks/bench_gui.py [--nchan N ...] [--only TEXT] [--save FILE] [--compare FILE]
+
+Runs under Qt's offscreen platform, so no display is needed. A simulated Dastard
+(dastardcommander.simulator) serves the RPC connections that the main window needs.
+Each case is called with synthetic messages (see bench_codec.syntheticPayloads) for
+each channel count, after one untimed call to warm up. Reported are the mean time per
+call, including the Qt events it causes (layout, repaint), and the peak memory
+allocated by Python during one call (tracemalloc; Qt's own allocations aren't seen).
+
+--save writes the results as JSON. --compare reads earlier results and flags each case
+that became more than --threshold times slower, exiting with status 1 if any did. So
+keep a baseline with --save, and --compare against it before merging.
+"""
+
+import argparse
+import contextlib
+import io
+import itertools
+import json
+import os
+import platform
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+import h5py
+import numpy as np
+from PyQt5 import QtCore, QtWidgets
+
+from bench_codec import syntheticPayloads
+from dastardcommander import (codec, dc, observe, projectors, rpc_client, simulator,
+                              trigger_config)
+from dastardcommander.channels import ChannelTable
+
+NCHAN = (64, 256, 1024, 4096, 16384)
+
+
+class Environment(object):
+    """The Qt application, a simulated Dastard, and a main window connected to it."""
+
+    def __init__(self):
+        self.app = QtWidgets.QApplication.instance() or QtWidgets.QApplication(sys.argv)
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.server = simulator.RPCServer(("localhost", 0), simulator.RPCHandler)
+        self.server.simulator = simulator.Simulator()
+        self.server.codec = self.server.simulator.codec
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        host, port = self.server.server_address
+        settings = QtCore.QSettings(os.path.join(self.tempdir.name, "dcom.ini"),
+                                    QtCore.QSettings.IniFormat)
+        with contextlib.redirect_stdout(io.StringIO()):
+            client = rpc_client.JSONClient((host, port))
+            self.window = dc.MainWindow(client, host, port, settings)
+        self.window.hbTimer.stop()  # No heartbeats will come.
+        self.window.show()
+        self.codec = codec.getCodec()
+
+    def messages(self, nchan):
+        """Return a dict of synthetic decoded messages for nchan channels."""
+        return {topic: self.codec.decodeStatus(topic, payload)
+                for topic, payload in syntheticPayloads(nchan)}
+
+    def processEvents(self):
+        self.app.processEvents()
+
+    def close(self):
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.window.close()
+        self.server.shutdown()
+        self.tempdir.cleanup()
+
+
+# Each case is a function (env, nchan) returning the function to time.
+
+def updateReceived(topic):
+    def setup(env, nchan):
+        w = env.window
+        msgs = env.messages(nchan)
+        for t in ("STATUS", "CHANNELNAMES", "TRIGGER", "TRIGGERRATE"):
+            w.updateReceived(t, msgs[t])
+        env.processEvents()
+        return lambda: w.updateReceived(topic, msgs[topic])
+    return setup
+
+
+def observeTriggerRate(env, nchan):
+    msgs = env.messages(nchan)
+    obs = observe.Observe(None, "localhost", None)
+    obs.model.channels = ChannelTable(msgs["CHANNELNAMES"])
+    obs.model.handleStatusMessage(msgs["STATUS"])
+    obs.show()
+    return lambda: obs.model.handleTriggerRateMessage(msgs["TRIGGERRATE"])
+
+
+def setCountRates(mapClass, fraction=1.0):
+    """Alternate between two sets of rates that differ in the given fraction of pixels."""
+    def setup(env, nchan):
+        msgs = env.messages(nchan)
+        status = msgs["STATUS"]
+        crm = mapClass(None, len(status["ChanGroups"]), status["ChanGroups"][0]["Nchan"],
+                       msgs["CHANNELNAMES"])
+        crm.show()
+        counts = np.asarray(msgs["TRIGGERRATE"]["CountsSeen"], dtype=float)
+        other = counts.copy()
+        other[:int(fraction*nchan)] += 25
+        rates = itertools.cycle([counts, other])
+        return lambda: crm.setCountRates(next(rates), 30.0)
+    return setup
+
+
+def triggerMessages(nchan):
+    """A TRIGGER message with edge triggers on the signal channels only."""
+    signal = simulator.defaultTriggerState(range(1, nchan, 2))
+    signal.update({"EdgeTrigger": True, "EdgeRising": True, "EdgeLevel": 100})
+    return [signal, simulator.defaultTriggerState(range(0, nchan, 2))]
+
+
+def distinctTriggerMessages(nchan):
+    """A TRIGGER message with a different edge trigger level on every channel."""
+    msg = []
+    for i in range(nchan):
+        state = simulator.defaultTriggerState([i])
+        state.update({"EdgeTrigger": True, "EdgeRising": True, "EdgeLevel": 100+i})
+        msg.append(state)
+    return msg
+
+
+def newTriggerConfig(env, nchan):
+    tc = trigger_config.TriggerConfig(None, None)
+    tc.channels = ChannelTable(env.messages(nchan)["CHANNELNAMES"])
+    tc.chosenChannels = list(range(nchan))
+    return tc
+
+
+def triggerConfigHandleTriggerMessage(env, nchan):
+    tc = newTriggerConfig(env, nchan)
+    msg = triggerMessages(nchan)
+    return lambda: tc.handleTriggerMessage(msg)
+
+
+def triggerConfigHandleDistinctStates(env, nchan):
+    tc = newTriggerConfig(env, nchan)
+    msg = distinctTriggerMessages(nchan)
+    return lambda: tc.handleTriggerMessage(msg)
+
+
+def triggerConfigSetDistinctStates(env, nchan):
+    """Change one setting of half the channels, each in a state of its own."""
+    tc = newTriggerConfig(env, nchan)
+    tc.handleTriggerMessage(distinctTriggerMessages(nchan))
+    tc.chosenChannels = list(range(0, nchan, 2))
+    values = itertools.cycle([True, False])
+    return lambda: tc.triggerStates.set(tc.chosenChannels, "AutoTrigger", next(values))
+
+
+def triggerConfigAllTriggerStates(env, nchan):
+    tc = newTriggerConfig(env, nchan)
+    tc.handleTriggerMessage(triggerMessages(nchan))
+    return tc.alltriggerstates
+
+
+def triggerConfigToggle(env, nchan):
+    """Toggle the auto trigger check box with every channel chosen, which edits and sends
+    the trigger states (to the simulated Dastard)."""
+    tc = env.window.triggerTab
+    msgs = env.messages(nchan)
+    env.window.updateReceived("CHANNELNAMES", msgs["CHANNELNAMES"])
+    tc.handleTriggerMessage(triggerMessages(nchan))
+    tc.chosenChannels = list(range(nchan))
+
+    def toggle():
+        tc.autoTrigActive.toggle()  # (as click() would, were the tab enabled)
+        tc.changedAutoTrigConfig()
+        tc.flushTriggerEdits()  # (rather than wait for more edits)
+    return toggle
+
+
+def triggerConfigChooseChannels(env, nchan):
+    """Choose all channels by typing their names in the channel edit box."""
+    tc = newTriggerConfig(env, nchan)
+    tc.handleTriggerMessage(triggerMessages(nchan))
+    texts = itertools.cycle(["\n".join(tc.chanbyprefix(p) for p in ("chan", "err")),
+                             tc.chanbyprefix("chan")])
+
+    def choose():
+        tc.channelsChosenEdit.setPlainText(next(texts))
+        tc.flushChannelText()  # (rather than wait for typing to pause)
+    return choose
+
+
+def projectorsGetConfigs(env, nchan):
+    names = env.messages(nchan)["CHANNELNAMES"]
+    filename = os.path.join(env.tempdir.name, "bench%d_model.hdf5" % nchan)
+    rng = np.random.default_rng(2)
+    with h5py.File(filename, "w") as h5:
+        for name in names:
+            if name.startswith("chan"):
+                group = h5.create_group(name[4:]).create_group("svdbasis")
+                group["projectors"] = rng.standard_normal((5, 500))
+                group["basis"] = rng.standard_normal((500, 5))
+    return lambda: projectors.getConfigs(filename, names)
+
+
+CASES = [
+    ("MainWindow.updateReceived(TRIGGERRATE)", updateReceived("TRIGGERRATE")),
+    ("MainWindow.updateReceived(STATUS)", updateReceived("STATUS")),
+    ("MainWindow.updateReceived(CHANNELNAMES)", updateReceived("CHANNELNAMES")),
+    ("MainWindow.updateReceived(TRIGGER)", updateReceived("TRIGGER")),
+    ("CountRateModel.handleTriggerRateMessage", observeTriggerRate),
+    ("CountRateMap.setCountRates", setCountRates(observe.CountRateMap)),
+    ("CountRateMap.setCountRates(1% changed)", setCountRates(observe.CountRateMap, 0.01)),
+    ("CountRateImage.setCountRates", setCountRates(observe.CountRateImage)),
+    ("TriggerConfig.handleTriggerMessage", triggerConfigHandleTriggerMessage),
+    ("TriggerConfig handle distinct states", triggerConfigHandleDistinctStates),
+    ("TriggerConfig set distinct states", triggerConfigSetDistinctStates),
+    ("TriggerConfig.alltriggerstates", triggerConfigAllTriggerStates),
+    ("TriggerConfig toggle auto trigger", triggerConfigToggle),
+    ("TriggerConfig choose channels", triggerConfigChooseChannels),
+    ("projectors.getConfigs", projectorsGetConfigs),
+]
+
+
+def measure(env, func, repeat, maxTime):
+    """Return (mean seconds per call, peak bytes allocated by Python in one call)."""
+    func()
+    env.processEvents()
+    n = 0
+    tstart = time.perf_counter()
+    while n < repeat and (n == 0 or time.perf_counter()-tstart < maxTime):
+        func()
+        env.processEvents()
+        n += 1
+    elapsed = (time.perf_counter()-tstart)/n
+    tracemalloc.start()
+    func()
+    env.processEvents()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+def compare(results, baselineFile, threshold):
+    """Print the ratio of each result to the baseline. Return the number of cases
+    more than threshold times slower."""
+    with open(baselineFile) as fp:
+        baseline = {(r["case"], r["nchan"]): r for r in json.load(fp)["results"]}
+    nslower = 0
+    print("\nCompared with %s:" % baselineFile)
+    for r in results:
+        b = baseline.get((r["case"], r["nchan"]))
+        if b is None:
+            continue
+        ratio = r["seconds"]/b["seconds"] if b["seconds"] > 0 else float("inf")
+        flag = ""
+        if ratio > threshold:
+            flag = "  SLOWER"
+            nslower += 1
+        print("%-42s %6d %8.2fx%s" % (r["case"], r["nchan"], ratio, flag))
+    return nslower
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--nchan", type=int, nargs="+", default=NCHAN,
+                        help="channel counts to sweep (default: %s)" % (NCHAN,))
+    parser.add_argument("--only", help="run only the cases whose name contains this")
+    parser.add_argument("--repeat", type=int, default=20, help="maximum calls per timing")
+    parser.add_argument("--max-time", type=float, default=5.0,
+                        help="stop timing a case after this many seconds")
+    parser.add_argument("--save", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="compare with results saved earlier")
+    parser.add_argument("--threshold", type=float, default=1.5,
+                        help="slow-down factor counted as a regression")
+    args = parser.parse_args()
+
+    env = Environment()
+    results = []
+    print("%-42s %6s %12s %12s" % ("case", "nchan", "ms/call", "peak kB"))
+    try:
+        for name, setup in CASES:
+            if args.only and args.only not in name:
+                continue
+            for nchan in args.nchan:
+                # The code being timed prints a lot; keep the report readable.
+                with contextlib.redirect_stdout(io.StringIO()):
+                    func = setup(env, nchan)
+                    seconds, peak = measure(env, func, args.repeat, args.max_time)
+                results.append({"case": name, "nchan": nchan, "seconds": seconds,
+                                "peakBytes": peak})
+                print("%-42s %6d %12.3f %12.1f" % (name, nchan, 1e3*seconds, peak/1e3))
+    finally:
+        env.close()
+
+    if args.save:
+        info = {"time": time.time(), "python": platform.python_version(),
+                "qt": QtCore.QT_VERSION_STR, "numpy": np.__version__,
+                "machine": platform.node(), "platform": platform.platform()}
+        with open(args.save, "w") as fp:
+            json.dump({"info": info, "results": results}, fp, indent=1)
+        print("Wrote results to %s" % args.save)
+    if args.compare:
+        nslower = compare(results, args.compare, args.threshold)
+        if nslower > 0:
+            print("%d cases more than %gx slower" % (nslower, args.threshold))
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
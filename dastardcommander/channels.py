@@ -0,0 +1,156 @@
+"""
+The table of channel names, made from each CHANNELNAMES message and shared by all tabs,
+and the compact text form of lists of channel numbers, like "1,4,10-20,21-3999:2".
+"""
+
+import re
+
+import numpy as np
+
+
+def formatNumbers(numbers):
+    """Return the sorted, distinct integers in numbers as compact text, with each run of 3
+    or more evenly spaced values as a range "first-last" or "first-last:step", e.g.
+    [1, 2, 3, 5, 7, 9, 12] becomes "1-3,5-9:2,12"."""
+    x = np.unique(np.asarray(numbers, dtype=int))
+    d = np.diff(x)
+    # Runs of equal differences: run k spans numbers starts[k] to ends[k].
+    edges = np.flatnonzero(d[1:] != d[:-1])+1
+    starts = np.concatenate([[0], edges])
+    ends = np.concatenate([edges, [len(d)]])
+    parts = []
+    i = 0  # the first number not yet written
+    for s, e in zip(starts.tolist(), ends.tolist()):
+        s = max(s, i)
+        if e-s+1 < 3:
+            continue
+        parts.extend(str(n) for n in x[i:s].tolist())
+        step = d[s]
+        parts.append("%d-%d" % (x[s], x[e]) if step == 1 else "%d-%d:%d" % (x[s], x[e], step))
+        i = e+1
+    parts.extend(str(n) for n in x[i:].tolist())
+    return ",".join(parts)
+
+
+# A term of a list of channel numbers: a number, or a range "first-last" or "first-last:step".
+_TERM = re.compile(r"([0-9]{1,18})(?:-([0-9]{1,18})(?::([0-9]{1,18}))?)?")
+
+# The largest channel number a range may reach, unless parseNumbers is told otherwise.
+MAX_NUMBER = 999999
+
+
+def parseNumbers(text, maxNumber=MAX_NUMBER):
+    """Parse text of the form formatNumbers writes (any order, repeats allowed) into an
+    array of integers. Ranges stop at maxNumber (say, the largest channel number there
+    is), so even a huge range costs little. Return (numbers, bad), where bad lists the
+    terms not understood and the ranges wholly beyond maxNumber."""
+    pieces = []
+    plain = []
+    bad = []
+    for term in text.split(","):
+        if len(term) == 0:
+            continue  # e.g. after a trailing comma
+        m = _TERM.fullmatch(term)
+        if m is None:
+            bad.append(term)
+            continue
+        first, last, step = m.groups()
+        if last is None:
+            plain.append(first)
+            continue
+        first, last, step = int(first), int(last), int(step or 1)
+        if last < first or step < 1 or first > maxNumber:
+            bad.append(term)
+            continue
+        pieces.append(np.arange(first, min(last, maxNumber)+1, step))
+    pieces.append(np.array(plain, dtype=str).astype(int) if plain else np.zeros(0, dtype=int))
+    return np.concatenate(pieces), bad
+
+
+class ChannelTable(object):
+    """Dastard's channel names, indexed for fast lookups.
+
+    A name is a prefix and a number, like "chan12" or "err12". Alongside the names are
+    NumPy arrays of each channel's prefix and number (-1 for a name without one) and
+    masks of the signal ("chan") and TDM error ("err") channels, with dicts to find a
+    channel's index by name or by prefix and number. A table isn't changed once made: a
+    new CHANNELNAMES message makes a new table, so a tab can hold on to one and compare
+    it with the next."""
+
+    def __init__(self, names=()):
+        self.names = list(names)
+        prefixes = [name.rstrip("0123456789") for name in self.names]
+        self.index = np.arange(len(self.names))
+        self.prefix = np.array(prefixes, dtype=str)
+        self.number = np.array([int(name[len(p):]) if len(name) > len(p) else -1
+                                for (name, p) in zip(self.names, prefixes)], dtype=int)
+        self.isSignal = self.prefix == "chan"
+        self.isError = self.prefix == "err"
+        self.prefixes = set(prefixes)
+        self._byName = {name: i for (i, name) in enumerate(self.names)}
+        self._byNumber = {p: {} for p in self.prefixes}
+        for i, (p, n) in enumerate(zip(prefixes, self.number.tolist())):
+            self._byNumber[p][n] = i
+        self._signalIndices = self.index[self.isSignal]
+        # Per prefix, an array from channel number to index (-1 for no such channel).
+        self._lookup = {}
+        for p in self.prefixes:
+            chosen = (self.prefix == p) & (self.number >= 0)
+            lookup = np.full(self.number[chosen].max()+1 if chosen.any() else 0, -1, dtype=int)
+            lookup[self.number[chosen]] = self.index[chosen]
+            self._lookup[p] = lookup
+
+    def __len__(self):
+        return len(self.names)
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __getitem__(self, i):
+        return self.names[i]
+
+    def __eq__(self, other):
+        if self is other:
+            return True
+        return isinstance(other, ChannelTable) and self.names == other.names
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return "ChannelTable(%d channels with prefixes %s)" % (len(self), sorted(self.prefixes))
+
+    def indexOf(self, name):
+        """Return the index of the channel named name, or None if there's none."""
+        return self._byName.get(name)
+
+    def numberToIndex(self, prefix):
+        """Return a dict from channel number to index, for the channels with prefix."""
+        return self._byNumber.get(prefix, {})
+
+    def indicesOf(self, prefix, numbers):
+        """Return (indices, missing): arrays of the indices of the channels with prefix
+        and the given numbers, and of the numbers for which there's no such channel."""
+        numbers = np.asarray(numbers, dtype=int)
+        lookup = self._lookup.get(prefix, np.zeros(0, dtype=int))
+        indices = np.full(len(numbers), -1, dtype=int)
+        inside = (numbers >= 0) & (numbers < len(lookup))
+        indices[inside] = lookup[numbers[inside]]
+        return indices[indices >= 0], numbers[indices < 0]
+
+    def maxNumber(self, prefix):
+        """Return the largest number of a channel with prefix, or -1 if there's none."""
+        return len(self._lookup.get(prefix, ()))-1
+
+    def indicesWithPrefix(self, prefix):
+        """Return an array of the indices of the channels with prefix."""
+        return self.index[self.prefix == prefix]
+
+    def signalIndices(self):
+        """Return a list of the indices of the signal channels."""
+        return self._signalIndices.tolist()
+
+    def allIndices(self):
+        return self.index.tolist()
@@ -0,0 +1,88 @@
+"""
+JSON codecs for the JSON-RPC client and for the ZMQ status messages.
+
+getCodec() returns the fastest codec that is installed: orjson, then ujson, and
+the standard library json if neither is. All codecs encode objects to bytes and
+decode from bytes or str.
+"""
+
+import json
+from collections import OrderedDict
+
+import numpy as np
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+# Fields of the ZMQ status messages that are long lists of numbers (one per channel).
+# decodeStatus returns these as NumPy arrays.
+ARRAY_FIELDS = {
+    "TRIGGERRATE": ("CountsSeen",),
+    "NUMBERWRITTEN": ("NumberWritten",),
+}
+
+
+class JSONCodec(object):
+    """The standard library json module."""
+    name = "json"
+
+    def encode(self, obj):
+        return json.dumps(obj).encode()
+
+    def decode(self, data):
+        return json.loads(data)
+
+    def decodeStatus(self, topic, data):
+        """Decode a ZMQ status message, with per-channel number lists as NumPy arrays."""
+        msg = self.decode(data)
+        for field in ARRAY_FIELDS.get(topic, ()):
+            values = msg.get(field)
+            if values is not None:
+                msg[field] = np.asarray(values)
+        return msg
+
+
+class OrjsonCodec(JSONCodec):
+    name = "orjson"
+
+    def encode(self, obj):
+        return orjson.dumps(obj, option=orjson.OPT_SERIALIZE_NUMPY)
+
+    def decode(self, data):
+        return orjson.loads(data)
+
+
+class UjsonCodec(JSONCodec):
+    name = "ujson"
+
+    def encode(self, obj):
+        return ujson.dumps(obj).encode()
+
+    def decode(self, data):
+        return ujson.loads(data)
+
+
+CODECS = OrderedDict()
+if orjson is not None:
+    CODECS[OrjsonCodec.name] = OrjsonCodec()
+if ujson is not None:
+    CODECS[UjsonCodec.name] = UjsonCodec()
+CODECS[JSONCodec.name] = JSONCodec()
+
+
+def getCodec(name=None):
+    """Return the codec called name, or the fastest one installed if name is None."""
+    if name is None:
+        return next(iter(CODECS.values()))
+    try:
+        return CODECS[name]
+    except KeyError:
+        raise ValueError("JSON codec '%s' is not available; choose from %s" %
+                         (name, list(CODECS.keys())))
@@ -12,14 +12,13 @@ May 2018 -
 """
 
 # Non-Qt imports
-import json
 import socket
 import subprocess
 import sys
 import os
 import zmq
 
-from collections import OrderedDict, defaultdict
+from collections import OrderedDict
 import numpy as np
 # Qt5 imports
 import PyQt5.uic
@@ -36,6 +35,10 @@ from . import writing
 from . import projectors
 from . import observe
 from . import workflow
+from . import diagnostics
+from . import dispatch
+from . import recording
+from .channels import ChannelTable
 __version__ = '0.2.3'
 
 # Here is how you try to import compiled UI files and fall back to processing them
@@ -55,14 +58,20 @@ QCoreApplication.setApplicationName("DastardCommander")
 
 
 class MainWindow(QtWidgets.QMainWindow):
-    def __init__(self, rpc_client, host, port, settings, parent=None):
-        self.client = rpc_client
-        self.client.setQtParent(self)
+
+    def __init__(self, client, host, port, settings, parent=None):
         self.host = host
         self.port = port
         self.settings = settings
 
         QtWidgets.QMainWindow.__init__(self, parent)
+        # Calls whose results aren't needed right away go through asyncClient, so a
+        # slow Dastard can't freeze the GUI (and so cause a missed heartbeat). Those
+        # that are go through self.client, which waits for them. Both use the one
+        # connection, client's, so Dastard gets all calls in the order they were made.
+        self.asyncClient = rpc_client.AsyncJSONClient(client, qtParent=self)
+        self.client = rpc_client.SyncJSONClient(self.asyncClient)
+        self.asyncClient.serverMissing.connect(lambda: self.closeReconnect("RPC server is missing"))
         self.setWindowIcon(QtGui.QIcon('dc.png'))
         PyQt5.uic.loadUi(os.path.join(os.path.dirname(__file__), "ui/dc.ui"), self)
         self.setWindowTitle("Dastard Commander %s    (connected to %s:%d)" %
@@ -79,6 +88,8 @@ class MainWindow(QtWidgets.QMainWindow):
         self.actionPop_out_Observe.triggered.connect(self.popOutObserve)
         self.actionTDM_Autotune.triggered.connect(self.crateStartAndAutotune)
         self.actionAdvanced_Triggering.triggered.connect(lambda: self.setTriggerTabVisible(False))
+        self.actionDiagnostics.triggered.connect(self.showDiagnostics)
+        self.actionRecord_ZMQ_Stream.toggled.connect(self.toggleRecordZMQ)
         self.pushButton_sendEdgeMulti.clicked.connect(self.sendEdgeMulti)
         self.pushButton_sendMix.clicked.connect(self.sendMix)
         self.pushButton_sendExperimentStateLabel.clicked.connect(self.sendExperimentStateLabel)
@@ -94,7 +105,7 @@ class MainWindow(QtWidgets.QMainWindow):
         self.updateLanceroCardChoices()
         parallel = settings.value("parallelStream", True, type=bool)
         self.buildLanceroFiberBoxes(8, parallel)
-        self.triggerTab = trigger_config.TriggerConfig(None, self.client)
+        self.triggerTab = trigger_config.TriggerConfig(None, self.asyncClient)
         self.tabTriggering.layout().addWidget(self.triggerTab)
 
         self.triggerTabSimple = trigger_config_simple.TriggerConfigSimple(None, self)
@@ -105,28 +116,25 @@ class MainWindow(QtWidgets.QMainWindow):
         self.phaseResetMultiplierBox.editingFinished.connect(self.slotPhaseResetUpdate)
         self.triggerTab.recordLengthSpinBox.valueChanged.connect(self.slotPhaseResetUpdate)
 
-        self.writingTab = writing.WritingControl(None, host, self.client)
+        self.writingTab = writing.WritingControl(None, host, self.asyncClient)
         self.tabWriting.layout().addWidget(self.writingTab)
 
-        self.observeWindow = observe.Observe(parent=None, host=host, client=self.client)
-        self.observeTab = observe.Observe(parent=None, host=host, client=self.client)
+        # The Observe tab and pop-out window are two views of one count-rate model.
+        self.countRateModel = observe.CountRateModel(self)
+        self.observeWindow = observe.Observe(parent=None, host=host, client=self.asyncClient,
+                                             model=self.countRateModel)
+        self.observeTab = observe.Observe(parent=None, host=host, client=self.asyncClient,
+                                          model=self.countRateModel)
         self.tabObserve.layout().addWidget(self.observeTab)
-        self.triggerTab.changedTriggerStateSig.connect(self.observeTab.resetIntegration)
-        self.triggerTab.changedTriggerStateSig.connect(self.observeWindow.resetIntegration)
+        self.triggerTab.changedTriggerStateSig.connect(self.countRateModel.resetIntegration)
+
+        self.diagnosticsWindow = diagnostics.DiagnosticsDialog(self.client.stats)
 
         self.workflowTab = workflow.Workflow(self, parent=self.tabWorkflow)
         self.workflowTab.projectorsLoadedSig.connect(self.writingTab.checkBox_OFF.setChecked)
 
         self.microscopes = []
-        self.last_messages = defaultdict(str)
-        self.channel_names = []
-        self.channel_prefixes = set()
-        self.triggerTab.channel_names = self.channel_names
-        self.observeTab.channel_names = self.channel_names
-        self.observeWindow.channel_names = self.channel_names
-        self.triggerTab.channel_prefixes = self.channel_prefixes
-        self.workflowTab.channel_names = self.channel_names
-        self.workflowTab.channel_prefixes = self.channel_prefixes
+        self.setChannels(ChannelTable())
         self.launchMicroscopeButton.clicked.connect(self.launchMicroscope)
         self.killAllMicroscopesButton.clicked.connect(self.killAllMicroscopes)
         self.tabWidget.setEnabled(False)
@@ -139,17 +147,46 @@ class MainWindow(QtWidgets.QMainWindow):
         self.nmsg = 0
         self.zmqthread = QtCore.QThread()
         self.zmqlistener = status_monitor.ZMQListener(host, port)
-        self.zmqlistener.message.connect(self.updateReceived)
+        self.zmqlistener.messages.connect(self.updateBatchReceived)
+
+        # Each message goes to the handlers registered for its topic. The pop-out
+        # Observe window is registered only while it's open.
+        self.fullyConfigured = False
+        self.dispatcher = dispatch.TopicDispatcher(self.zmqlistener)
+        self.handlerStats = diagnostics.HandlerStats()
+        self.dispatcher.addHook(self.handlerStats.record)
+        for consumer in (self, self.triggerTab, self.triggerTabSimple, self.writingTab,
+                         self.countRateModel, self.observeTab, self.workflowTab):
+            self.dispatcher.register(consumer, consumer.topicHandlers())
+        self.observeWindow.closed.connect(lambda: self.dispatcher.unregister(self.observeWindow))
+        self.dispatcher.whenSeen(("TRIANGLE", "SIMPULSE", "LANCERO", "ABACO"),
+                                 self.handleConfigured)
 
         # We don't want to make this request until the zmqthread is running.
         # So set it up as a slot to receive the thread's started message.
         def request_status():
-            self.client.call("SourceControl.SendAllStatus", "dummy")
+            self.asyncClient.call("SourceControl.SendAllStatus", "dummy")
 
         self.zmqlistener.moveToThread(self.zmqthread)
         self.zmqthread.started.connect(request_status)
         self.zmqthread.started.connect(self.zmqlistener.loop)
         QtCore.QTimer.singleShot(0, self.zmqthread.start)
+        self.diagnosticsWindow.addSection("ZMQ status messages",
+                                          self.zmqlistener.stats.summary,
+                                          self.zmqlistener.stats.asDict,
+                                          self.zmqlistener.stats.reset)
+        self.diagnosticsWindow.addSection("Conflated ZMQ messages",
+                                          self.zmqlistener.latest.summary)
+        self.diagnosticsWindow.addSection("ZMQ message handlers",
+                                          self.handlerStats.summary,
+                                          self.handlerStats.asDict,
+                                          self.handlerStats.reset)
+
+        # The listener keeps only the newest message on high-rate topics. Handle
+        # them on this render tick.
+        self.renderTimer = QtCore.QTimer()
+        self.renderTimer.timeout.connect(self.drainConflated)
+        self.renderTimer.start(200)
 
         # A timer to monitor for the heartbeat. If this ever times out, it's because
         # too long has elapsed without receiving a heartbeat from Dstard.  Then we
@@ -158,18 +195,16 @@ class MainWindow(QtWidgets.QMainWindow):
         self.hbTimer.timeout.connect(lambda: self.closeReconnect("missing heartbeat"))
         self.hbTimeout = 5000  # that is, 5000 ms
         self.hbTimer.start(self.hbTimeout)
-        self.fullyConfigured = False
 
-    @pyqtSlot(str, str)
-    def updateReceived(self, topic, message):
+    @pyqtSlot(list)
+    def updateBatchReceived(self, batch):
+        stats = self.zmqlistener.stats
+        for topic, d, received in batch:
+            self.updateReceived(topic, d)
+            stats.handled(topic, received)
 
-        try:
-            d = json.loads(message)
-        except Exception as e:
-            print("Error processing status message [topic,msg]: '%s', '%s'" % (
-                topic, message))
-            print("Error is: %s" % e)
-            return
+    def updateReceived(self, topic, d):
+        """Handle one status message, already decoded by the ZMQListener thread."""
 
         quietTopics = set(["TRIGGERRATE", "NUMBERWRITTEN",
                            "EXTERNALTRIGGER", "DATADROP"])  # add "ALIVE"
@@ -178,161 +213,129 @@ class MainWindow(QtWidgets.QMainWindow):
         if self.nmsg == 15:
             print("For message 15+, suppressing {} messages.".format(quietTopics))
 
-        if topic == "ALIVE":
-            self.heartbeat(d)
-
-        elif topic == "CURRENTTIME":
-            print("CurrentTime message: '%s'" % message)
-
-        elif topic == "TRIGGERRATE":
-            self.observeTab.handleTriggerRateMessage(d)
-            self.observeWindow.handleTriggerRateMessage(d)
-
-        # All other messages are ignored if they haven't changed
-        elif not self.last_messages[topic] == message:
-            if topic == "STATUS":
-                is_running = d["Running"]
-                self._setGuiRunning(is_running)
-                self.triggerTab.updateRecordLengthsFromServer(d["Nsamples"], d["Npresamp"])
-                self.triggerTabSimple.handleNsamplesNpresamplesMessage(d["Nsamples"], d["Npresamp"])
-                self.workflowTab.handleStatusUpdate(d)
-
-                source = d["SourceName"]
-                nchan = d["Nchannels"]
-                self.samplePeriod = d["SamplePeriod"]
-
-                self.sourceIsTDM = (source == "Lancero")
-                if source == "Triangles":
-                    self.dataSource.setCurrentIndex(0)
-                    self.triangleNchan.setValue(nchan)
-                elif source == "SimPulses":
-                    self.dataSource.setCurrentIndex(1)
-                    self.simPulseNchan.setValue(nchan)
-                elif source == "Lancero":
-                    self.dataSource.setCurrentIndex(2)
-                elif source == "Roach":
-                    self.dataSource.setCurrentIndex(3)
-                elif source == "Abaco":
-                    self.dataSource.setCurrentIndex(4)
-                if is_running:
-                    groups_info = d["ChanGroups"]
-                    ngroups = len(groups_info)
-                    # in principle chan per group can vary, we ignore that until it happens
-                    nrow = groups_info[0]["Nchan"]
-                else:
-                    groups_info = None
-                    ngroups = None
-                    nrow = None
-                self.updateStatusBar(is_running, source, ngroups, nrow)
-                self.observeTab.handleStatusUpdate(is_running, source, ngroups, nrow)
-                self.observeWindow.handleStatusUpdate(is_running, source, ngroups, nrow)
-
-            elif topic == "TRIGGER":
-                self.triggerTab.handleTriggerMessage(d)
-                self.triggerTabSimple.handleTriggerMessage(d, self.nmsg)
-
-            elif topic == "WRITING":
-                self.writingTab.handleWritingMessage(d)
-                self.workflowTab.handleWritingMessage(d)
-                self.observeTab.handleWritingMessage(d)
-
-            elif topic == "TRIANGLE":
-                self.triangleNchan.setValue(d["Nchan"])
-                self.triangleSampleRate.setValue(d["SampleRate"])
-                self.triangleMinimum.setValue(d["Min"])
-                self.triangleMaximum.setValue(d["Max"])
-
-            elif topic == "SIMPULSE":
-                self.simPulseNchan.setValue(d["Nchan"])
-                self.simPulseBaseline.setValue(d["Pedestal"])
-                self.simPulseSampleRate.setValue(d["SampleRate"])
-                self.simPulseSamplesPerPulse.setValue(d["Nsamp"])
-                a = d["Amplitudes"]
-                if a is None or len(a) == 0:
-                    a = [10000.0]
-                self.simPulseAmplitude.setValue(a[0])
-
-            elif topic == "LANCERO":
-                self.updateLanceroCardChoices(d["DastardOutput"]["AvailableCards"])
-                mask = d["FiberMask"]
-                for k, v in list(self.fiberBoxes.items()):
-                    v.setChecked(mask & (1 << k))
-                ns = d["DastardOutput"]["Nsamp"]
-                if ns > 0 and ns <= 16:
-                    self.nsampSpinBox.setValue(ns)
-
-            elif topic == "ROACH":
-                self.updateRoachSettings(d)
-
-            elif topic == "ABACO":
-                self.updateAbacoCardChoices(d["AvailableCards"])
-                self.fillPhaseResetInfo(d["Unwrapping"], d["UnwrapResetSamp"])
-
-            elif topic == "CHANNELNAMES":
-                self.channel_names[:] = []   # Careful: don't replace the variable
-                self.channel_prefixes.clear()
-                for name in d:
-                    self.channel_names.append(name)
-                    prefix = name.rstrip("1234567890")
-                    self.channel_prefixes.add(prefix)
-                print("New channames: ", self.channel_names)
-                if self.sourceIsTDM:
-                    self.triggerTab.channelChooserBox.setCurrentIndex(2)
-                else:
-                    self.triggerTab.channelChooserBox.setCurrentIndex(1)
-                self.triggerTab.channelChooserChanged()
-
-            elif topic == "TRIGCOUPLING":
-                self.triggerTab.handleTrigCoupling(d)
-                self.triggerTabSimple.handleTriggerMessage(d, self.nmsg)
-
-            elif topic == "NUMBERWRITTEN":
-                self.writingTab.handleNumberWritten(d)
-                self.workflowTab.handleNumberWritten(d)
-
-            elif topic == "NEWDASTARD":
-                if self.fullyConfigured:
-                    self.fullyConfigured = False
-                    self.closeReconnect("New Dastard started")
-
-            elif topic == "TESMAP":
-                self.observeTab.handleTESMap(d)
-                self.observeWindow.handleTESMap(d)
-
-            elif topic == "TESMAPFILE":
-                self.observeTab.handleTESMapFile(d)
-                self.observeWindow.handleTESMapFile(d)
-
-            elif topic == "MIX":
-                # We only permit setting a single, common mix value from DC, so
-                # we have to convert a variety of mixes to a single representative value.
-                try:
-                    mix = d[1]
-                    self.doubleSpinBox_MixFraction.setValue(mix)
-                except Exception as e:
-                    print("Could not set mix; selecting 0")
-                    self.doubleSpinBox_MixFraction.setValue(0.0)
-
-            elif topic == "EXTERNALTRIGGER":
-                self.observeTab.handleExternalTriggerMessage(d)
-                self.observeWindow.handleExternalTriggerMessage(d)
+        if not self.dispatcher.dispatch(topic, d):
+            print("%s is not a topic we handle yet." % topic)
+        self.nmsg += 1
 
-            else:
-                print("%s is not a topic we handle yet." % topic)
+    def topicHandlers(self):
+        """The handlers of ZMQ status messages, by topic, for the main window itself
+        (the tabs have their own)."""
+        statusFields = ("Running", "SourceName", "Nchannels", "ChanGroups", "SamplePeriod")
+        return {"ALIVE": self.heartbeat,
+                "CURRENTTIME": self.handleCurrentTime,
+                ("STATUS", statusFields): self.handleStatusMessage,
+                "CHANNELNAMES": self.handleChannelNames,
+                "NEWDASTARD": self.handleNewDastard,
+                "TRIANGLE": self.handleTriangleMessage,
+                "SIMPULSE": self.handleSimPulseMessage,
+                "LANCERO": self.handleLanceroMessage,
+                "ROACH": self.updateRoachSettings,
+                "ABACO": self.handleAbacoMessage,
+                "MIX": self.handleMixMessage}
+
+    def handleConfigured(self):
+        """Enable the window once Dastard has sent the configuration of every source."""
+        self.fullyConfigured = True
+        self.tabWidget.setEnabled(True)
+
+    def handleCurrentTime(self, d):
+        print("CurrentTime message: '%s'" % d)
+
+    def handleStatusMessage(self, d):
+        is_running = d["Running"]
+        self._setGuiRunning(is_running)
+
+        source = d["SourceName"]
+        nchan = d["Nchannels"]
+        self.samplePeriod = d["SamplePeriod"]
+
+        self.sourceIsTDM = (source == "Lancero")
+        if source == "Triangles":
+            self.dataSource.setCurrentIndex(0)
+            self.triangleNchan.setValue(nchan)
+        elif source == "SimPulses":
+            self.dataSource.setCurrentIndex(1)
+            self.simPulseNchan.setValue(nchan)
+        elif source == "Lancero":
+            self.dataSource.setCurrentIndex(2)
+        elif source == "Roach":
+            self.dataSource.setCurrentIndex(3)
+        elif source == "Abaco":
+            self.dataSource.setCurrentIndex(4)
+        if is_running:
+            groups_info = d["ChanGroups"]
+            ngroups = len(groups_info)
+            # in principle chan per group can vary, we ignore that until it happens
+            nrow = groups_info[0]["Nchan"]
+        else:
+            ngroups = None
+            nrow = None
+        self.updateStatusBar(is_running, source, ngroups, nrow)
+
+    def setChannels(self, channels):
+        """Share the ChannelTable channels with the tabs that need it."""
+        self.channels = channels
+        self.triggerTab.channels = channels
+        self.countRateModel.channels = channels
+        self.workflowTab.channels = channels
+
+    def handleChannelNames(self, d):
+        # The tabs' own CHANNELNAMES handlers run after this, so they see the new table.
+        self.setChannels(ChannelTable(d))
+        print("New channames: ", self.channels)
+        if self.sourceIsTDM:
+            self.triggerTab.channelChooserBox.setCurrentIndex(2)
+        else:
+            self.triggerTab.channelChooserBox.setCurrentIndex(1)
+        self.triggerTab.channelChooserChanged()
+
+    def handleNewDastard(self, d):
+        if self.fullyConfigured:
+            self.fullyConfigured = False
+            self.closeReconnect("New Dastard started")
+
+    def handleTriangleMessage(self, d):
+        self.triangleNchan.setValue(d["Nchan"])
+        self.triangleSampleRate.setValue(d["SampleRate"])
+        self.triangleMinimum.setValue(d["Min"])
+        self.triangleMaximum.setValue(d["Max"])
+
+    def handleSimPulseMessage(self, d):
+        self.simPulseNchan.setValue(d["Nchan"])
+        self.simPulseBaseline.setValue(d["Pedestal"])
+        self.simPulseSampleRate.setValue(d["SampleRate"])
+        self.simPulseSamplesPerPulse.setValue(d["Nsamp"])
+        a = d["Amplitudes"]
+        if a is None or len(a) == 0:
+            a = [10000.0]
+        self.simPulseAmplitude.setValue(a[0])
+
+    def handleLanceroMessage(self, d):
+        self.updateLanceroCardChoices(d["DastardOutput"]["AvailableCards"])
+        mask = d["FiberMask"]
+        for k, v in list(self.fiberBoxes.items()):
+            v.setChecked(mask & (1 << k))
+        ns = d["DastardOutput"]["Nsamp"]
+        if ns > 0 and ns <= 16:
+            self.nsampSpinBox.setValue(ns)
+
+    def handleAbacoMessage(self, d):
+        self.updateAbacoCardChoices(d["AvailableCards"])
+        self.fillPhaseResetInfo(d["Unwrapping"], d["UnwrapResetSamp"])
+
+    def handleMixMessage(self, d):
+        # We only permit setting a single, common mix value from DC, so
+        # we have to convert a variety of mixes to a single representative value.
+        try:
+            mix = d[1]
+            self.doubleSpinBox_MixFraction.setValue(mix)
+        except Exception as e:
+            print("Could not set mix; selecting 0")
+            self.doubleSpinBox_MixFraction.setValue(0.0)
 
-        self.nmsg += 1
-        self.last_messages[topic] = message
-
-        # Enable the window once the following message types have been received
-        require = ("TRIANGLE", "SIMPULSE", "LANCERO", "ABACO")
-        allseen = True
-        for k in require:
-            if k not in self.last_messages:
-                allseen = False
-                break
-        if allseen:
-            self.fullyConfigured = True
-            self.tabWidget.setEnabled(True)
+    @pyqtSlot()
+    def drainConflated(self):
+        self.updateBatchReceived(self.zmqlistener.latest.drain())
 
     def buildStatusBar(self):
         self.statusMainLabel = QtWidgets.QLabel("Server not running. ")
@@ -404,8 +407,11 @@ class MainWindow(QtWidgets.QMainWindow):
         self.zmqlistener.running = False
         self.zmqthread.quit()
         self.zmqthread.wait()
+        self.zmqlistener.stopRecording()
+        self.asyncClient.close()
         event.accept()
         self.observeWindow.hide()  # prevents close hanging due to still visible observeWindow
+        self.diagnosticsWindow.hide()
 
     @pyqtSlot()
     def launchMicroscope(self):
@@ -628,9 +634,8 @@ class MainWindow(QtWidgets.QMainWindow):
     def close(self):
         """Close the main window and also the client connection to a Dastard process."""
         self.hbTimer.stop()
-        if self.client is not None:
-            self.client.close()
-        self.client = None
+        self.renderTimer.stop()
+        # closeEvent closes the connection, after the trigger tab's last edits are sent.
         QtWidgets.QMainWindow.close(self)
 
     @pyqtSlot()
@@ -847,7 +852,7 @@ class MainWindow(QtWidgets.QMainWindow):
         fileName = projectors.getFileNameWithDialog(qtparent=self, startdir=startdir)
         if fileName:
             self.lastdir = os.path.dirname(fileName)
-            projectors.sendProjectors(self, fileName, self.channel_names, self.client)
+            projectors.sendProjectors(self, fileName, self.channels, self.client)
 
     @pyqtSlot()
     def loadMix(self):
@@ -867,18 +872,40 @@ class MainWindow(QtWidgets.QMainWindow):
             print("mixFractions.shape = {}".format(mixFractions.shape))
             config = {"ChannelIndices":  np.arange(1, mixFractions.size*2, 2).tolist(),
                       "MixFractions": mixFractions.flatten().tolist()}
-            okay, error = self.client.call(
-                "SourceControl.ConfigureMixFraction", config, verbose=True, throwError=False)
+            self.asyncClient.call("SourceControl.ConfigureMixFraction", config, verbose=True)
 
     @pyqtSlot()
     def popOutObserve(self):
+        if not self.dispatcher.isRegistered(self.observeWindow):
+            self.dispatcher.register(self.observeWindow, self.observeWindow.topicHandlers())
         self.observeWindow.show()
 
+    @pyqtSlot(bool)
+    def toggleRecordZMQ(self, start):
+        """Start or stop recording the ZMQ status stream to a file."""
+        if not start:
+            self.zmqlistener.stopRecording()
+            return
+        fileName, _ = QFileDialog.getSaveFileName(
+            self, "Record ZMQ status stream to", os.path.expanduser("~/dastard_zmq.rec"),
+            "ZMQ recordings (*.rec);;All Files (*)")
+        if not fileName:
+            self.actionRecord_ZMQ_Stream.setChecked(False)
+            return
+        self.zmqlistener.startRecording(recording.StreamRecorder(fileName))
+
+    @pyqtSlot()
+    def showDiagnostics(self):
+        self.diagnosticsWindow.show()
+        self.diagnosticsWindow.raise_()
+
     @pyqtSlot()
     def sendEdgeMulti(self):
+        # Edits still waiting in the trigger tab would otherwise be sent after these.
+        self.triggerTab.cancelTriggerEdits()
         # first send the trigger mesage for all channels
         config = {
-            "ChannelIndices": list(range(len(self.channel_names))),
+            "ChannelIndices": self.channelIndicesAll(),
             "EdgeMulti": self.checkBox_EdgeMulti.isChecked(),
             "EdgeRising": self.checkBox_EdgeMulti.isChecked(),
             "EdgeTrigger": self.checkBox_EdgeMulti.isChecked(),
@@ -888,53 +915,50 @@ class MainWindow(QtWidgets.QMainWindow):
             "EdgeMultiVerifyNMonotone": self.spinBox_EdgeMultiVerifyNMonotone.value(),
             "EdgeLevel": self.spinBox_EdgeLevel.value()
         }
-        self.client.call("SourceControl.ConfigureTriggers", config)
+        self.asyncClient.call("SourceControl.ConfigureTriggers", config)
 
         # Reset trigger on even-numbered channels if source is TDM and the relevant
         # check box ("Trigger on Error Channels") isn't checked.
         omitEvenChannels = (self.sourceIsTDM and not
                             self.checkBox_edgeMultiTriggerOnError.isChecked())
         if omitEvenChannels:
-            config = {"ChannelIndices": list(range(0, len(self.channel_names), 2))}
-            self.client.call("SourceControl.ConfigureTriggers", config)
+            config = {"ChannelIndices": list(range(0, len(self.channels), 2))}
+            self.asyncClient.call("SourceControl.ConfigureTriggers", config)
 
     @pyqtSlot()
     def sendMix(self):
         print("sendMIX***********")
         mixFraction = self.doubleSpinBox_MixFraction.value()
-        channels = [i for i in range(1, len(self.channel_names), 2)]  # only odd channels get mix
+        channels = [i for i in range(1, len(self.channels), 2)]  # only odd channels get mix
         mixFractions = [mixFraction for _ in range(len(channels))]
         config = {
             "ChannelIndices": channels,
             "MixFractions": mixFractions
         }
-        try:
-            self.client.call("SourceControl.ConfigureMixFraction", config)
-            print("experimental mix config")
-            print(config)
-        except Exception as e:
-            print("Could not set mix: {}".format(e))
+        self.asyncClient.call("SourceControl.ConfigureMixFraction", config)
+        print("experimental mix config")
+        print(config)
 
     @pyqtSlot()
     def sendExperimentStateLabel(self):
         config = {
             "Label": self.lineEdit_experimentStateLabel.text(),
         }
-        self.client.call("SourceControl.SetExperimentStateLabel", config)
+        self.asyncClient.call("SourceControl.SetExperimentStateLabel", config)
 
     @pyqtSlot()
     def handlePauseExperimental(self):
         config = {
             "Request": "Pause"
         }
-        self.client.call("SourceControl.WriteControl", config)
+        self.asyncClient.call("SourceControl.WriteControl", config)
 
     @pyqtSlot()
     def handleUnpauseExperimental(self):
         config = {
             "Request": "Unpause "+self.lineEdit_unpauseExperimentalLabel.text()
         }
-        self.client.call("SourceControl.WriteControl", config)
+        self.asyncClient.call("SourceControl.WriteControl", config)
 
     def _cringeCommand(self, command):
         cringe_address = "localhost"
@@ -984,10 +1008,10 @@ class MainWindow(QtWidgets.QMainWindow):
         QtCore.QTimer.singleShot(wait_ms, lambda: self._cringeCommand("FULL_TUNE"))
 
     def channelIndicesAll(self):
-        return list(range(len(self.channel_names)))
+        return self.channels.allIndices()
 
     def channelIndicesSignalOnly(self):
-        return [i for (i, name) in enumerate(self.channel_names) if name.startswith("chan")]
+        return self.channels.signalIndices()
 
 
 class HostPortDialog(QtWidgets.QDialog):
@@ -0,0 +1,340 @@
+"""
+Performance counters for Dastard Commander, and a dialog to view them.
+
+RPCStats records the timing and size of every JSON-RPC call, per method. TopicStats
+records the rate, size, decode time and handling latency of ZMQ status messages, per
+topic, and HandlerStats the time taken by each handler of those messages. Samples go
+into fixed-size, log-binned histograms, so the memory used doesn't grow however long
+the GUI runs.
+"""
+
+import bisect
+import json
+import math
+import os
+import threading
+import time
+
+# Qt5 imports
+from PyQt5 import QtCore, QtGui, QtWidgets
+
+
+class Histogram(object):
+    """A fixed-size histogram with logarithmically spaced bins, plus running totals.
+
+    Values below lo go in the first bin and values above hi in the last."""
+
+    def __init__(self, lo=1e-6, hi=100.0, binsPerDecade=10):
+        ndecades = math.log10(hi/lo)
+        nbins = int(math.ceil(ndecades*binsPerDecade))
+        self.edges = [lo*10**(i/binsPerDecade) for i in range(nbins+1)]
+        self.counts = [0]*(nbins+2)
+        self.n = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, x):
+        self.counts[bisect.bisect_right(self.edges, x)] += 1
+        self.n += 1
+        self.total += x
+        if x > self.max:
+            self.max = x
+
+    def mean(self):
+        if self.n == 0:
+            return 0.0
+        return self.total/self.n
+
+    def quantile(self, q):
+        """Approximate q-quantile: the upper edge of the bin holding it (or the max)."""
+        if self.n == 0:
+            return 0.0
+        target = q*self.n
+        cumulative = 0
+        for i, c in enumerate(self.counts):
+            cumulative += c
+            if cumulative >= target:
+                return min(self.edges[min(i, len(self.edges)-1)], self.max)
+        return self.max
+
+    def asDict(self):
+        return {"n": self.n, "mean": self.mean(), "max": self.max,
+                "p50": self.quantile(0.5), "p99": self.quantile(0.99),
+                "edges": self.edges, "counts": self.counts}
+
+
+class MethodStats(object):
+    """Counters for a single RPC method."""
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.bytesSent = 0
+        self.bytesReceived = 0
+        self.encodeTime = Histogram()
+        self.roundTrip = Histogram()
+
+    def asDict(self):
+        return {"calls": self.calls, "errors": self.errors,
+                "bytesSent": self.bytesSent, "bytesReceived": self.bytesReceived,
+                "encodeTime": self.encodeTime.asDict(),
+                "roundTrip": self.roundTrip.asDict()}
+
+
+class RPCStats(object):
+    """Per-method statistics on JSON-RPC calls. Safe to share between threads (the
+    synchronous and asynchronous clients both record here)."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.methods = {}
+            self.since = time.time()
+
+    def record(self, method, bytesSent, bytesReceived, encodeTime, roundTrip, error):
+        with self._lock:
+            stats = self.methods.get(method)
+            if stats is None:
+                stats = self.methods[method] = MethodStats()
+            stats.calls += 1
+            stats.bytesSent += bytesSent
+            stats.bytesReceived += bytesReceived
+            stats.encodeTime.add(encodeTime)
+            stats.roundTrip.add(roundTrip)
+            if error is not None:
+                stats.errors += 1
+
+    def asDict(self):
+        with self._lock:
+            return {"since": self.since,
+                    "methods": {k: v.asDict() for k, v in self.methods.items()}}
+
+    def summary(self):
+        """A text table of the statistics, slowest methods (by total time) first."""
+        lines = ["%-40s %7s %5s %10s %10s %9s %9s %9s %9s" % (
+            "RPC method", "calls", "errs", "kB sent", "kB recv",
+            "enc ms", "rtt ms", "p99 ms", "max ms")]
+        with self._lock:
+            methods = sorted(self.methods.items(), key=lambda kv: -kv[1].roundTrip.total)
+            for name, s in methods:
+                lines.append("%-40s %7d %5d %10.1f %10.1f %9.3f %9.3f %9.3f %9.3f" % (
+                    name, s.calls, s.errors, s.bytesSent/1e3, s.bytesReceived/1e3,
+                    1e3*s.encodeTime.mean(), 1e3*s.roundTrip.mean(),
+                    1e3*s.roundTrip.quantile(0.99), 1e3*s.roundTrip.max))
+        return "\n".join(lines)
+
+
+class DecayingRate(object):
+    """An exponentially weighted estimate of a rate (per second), with time constant tau."""
+
+    def __init__(self, tau=10.0):
+        self.tau = tau
+        self.rate = 0.0
+        self.last = None
+
+    def add(self, amount, now):
+        self.rate = self.value(now) + amount/self.tau
+        self.last = now
+
+    def value(self, now):
+        if self.last is None:
+            return 0.0
+        return self.rate*math.exp(-(now-self.last)/self.tau)
+
+
+class TopicCounters(object):
+    """Counters for a single ZMQ topic."""
+
+    def __init__(self):
+        self.messages = 0
+        self.bytes = 0
+        self.messageRate = DecayingRate()
+        self.byteRate = DecayingRate()
+        self.lastReceived = None
+        self.decodeTime = Histogram()
+        self.latency = Histogram()
+
+    def asDict(self, now):
+        age = None if self.lastReceived is None else now-self.lastReceived
+        return {"messages": self.messages, "bytes": self.bytes,
+                "messagesPerSecond": self.messageRate.value(now),
+                "bytesPerSecond": self.byteRate.value(now), "age": age,
+                "decodeTime": self.decodeTime.asDict(), "latency": self.latency.asDict()}
+
+
+class TopicStats(object):
+    """Per-topic statistics on ZMQ status messages: message and byte rates, time to
+    decode, latency from receipt to the end of GUI handling, and age of the newest
+    message. The listener thread records receipt and decoding, the GUI thread records
+    handling. Times are time.perf_counter() values."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.topics = {}
+            self.since = time.time()
+
+    def _counters(self, topic):
+        counters = self.topics.get(topic)
+        if counters is None:
+            counters = self.topics[topic] = TopicCounters()
+        return counters
+
+    def received(self, topic, nbytes, now):
+        with self._lock:
+            c = self._counters(topic)
+            c.messages += 1
+            c.bytes += nbytes
+            c.messageRate.add(1, now)
+            c.byteRate.add(nbytes, now)
+            c.lastReceived = now
+
+    def decoded(self, topic, decodeTime):
+        with self._lock:
+            self._counters(topic).decodeTime.add(decodeTime)
+
+    def handled(self, topic, received):
+        """Record that a message received at time received has been fully handled."""
+        now = time.perf_counter()
+        with self._lock:
+            self._counters(topic).latency.add(now-received)
+
+    def asDict(self):
+        now = time.perf_counter()
+        with self._lock:
+            return {"since": self.since,
+                    "topics": {k: v.asDict(now) for k, v in self.topics.items()}}
+
+    def summary(self):
+        """A text table of the statistics, by topic."""
+        now = time.perf_counter()
+        lines = ["%-16s %8s %8s %9s %9s %9s %9s %9s" % (
+            "ZMQ topic", "msgs", "msg/s", "kB/s", "dec ms", "lat ms", "p99 ms", "age s")]
+        with self._lock:
+            for name, c in sorted(self.topics.items()):
+                age = 0.0 if c.lastReceived is None else now-c.lastReceived
+                lines.append("%-16s %8d %8.2f %9.2f %9.3f %9.3f %9.3f %9.1f" % (
+                    name, c.messages, c.messageRate.value(now), c.byteRate.value(now)/1e3,
+                    1e3*c.decodeTime.mean(), 1e3*c.latency.mean(),
+                    1e3*c.latency.quantile(0.99), age))
+        return "\n".join(lines)
+
+
+class HandlerStats(object):
+    """Time spent in each handler of ZMQ status messages, by topic and handler name.
+    Add its record method as a hook to a dispatch.TopicDispatcher."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.handlers = {}
+            self.since = time.time()
+
+    def record(self, topic, name, seconds):
+        with self._lock:
+            h = self.handlers.get((topic, name))
+            if h is None:
+                h = self.handlers[(topic, name)] = Histogram()
+            h.add(seconds)
+
+    def asDict(self):
+        with self._lock:
+            return {"since": self.since,
+                    "handlers": {"%s %s" % k: v.asDict() for k, v in self.handlers.items()}}
+
+    def summary(self):
+        """A text table of the statistics, handlers taking the most total time first."""
+        lines = ["%-16s %-44s %8s %9s %9s %9s" % (
+            "ZMQ topic", "handler", "calls", "mean ms", "p99 ms", "max ms")]
+        with self._lock:
+            for (topic, name), h in sorted(self.handlers.items(), key=lambda kv: -kv[1].total):
+                lines.append("%-16s %-44s %8d %9.3f %9.3f %9.3f" % (
+                    topic, name, h.n, 1e3*h.mean(), 1e3*h.quantile(0.99), 1e3*h.max))
+        return "\n".join(lines)
+
+
+class DiagnosticsDialog(QtWidgets.QDialog):
+    """A window showing the performance counters, refreshed once per second while
+    visible, with a button to save them all to a JSON file."""
+
+    def __init__(self, rpcStats, parent=None):
+        QtWidgets.QDialog.__init__(self, parent)
+        self.rpcStats = rpcStats
+        self.sections = []
+        self.setWindowTitle("Dastard Commander Diagnostics")
+        self.resize(900, 500)
+
+        self.text = QtWidgets.QPlainTextEdit(self)
+        self.text.setReadOnly(True)
+        self.text.setLineWrapMode(QtWidgets.QPlainTextEdit.NoWrap)
+        self.text.setFont(QtGui.QFontDatabase.systemFont(QtGui.QFontDatabase.FixedFont))
+        resetButton = QtWidgets.QPushButton("Reset", self)
+        resetButton.clicked.connect(self.reset)
+        saveButton = QtWidgets.QPushButton("Save...", self)
+        saveButton.clicked.connect(self.save)
+
+        buttons = QtWidgets.QHBoxLayout()
+        buttons.addStretch()
+        buttons.addWidget(resetButton)
+        buttons.addWidget(saveButton)
+        layout = QtWidgets.QVBoxLayout(self)
+        layout.addWidget(self.text)
+        layout.addLayout(buttons)
+
+        self.refreshTimer = QtCore.QTimer(self)
+        self.refreshTimer.timeout.connect(self.refresh)
+
+    def showEvent(self, event):
+        self.refresh()
+        self.refreshTimer.start(1000)
+        QtWidgets.QDialog.showEvent(self, event)
+
+    def hideEvent(self, event):
+        self.refreshTimer.stop()
+        QtWidgets.QDialog.hideEvent(self, event)
+
+    def addSection(self, name, summary, asDict=None, reset=None):
+        """Also show the text returned by the function summary under the title name.
+        If given, the function asDict provides what is saved to file (otherwise it's the
+        summary text) and reset is called by the Reset button."""
+        self.sections.append((name, summary, asDict, reset))
+
+    def refresh(self):
+        parts = [self.rpcStats.summary()]
+        for name, summary, _, _ in self.sections:
+            parts.append("%s\n%s" % (name, summary()))
+        self.text.setPlainText("\n\n".join(parts))
+
+    def reset(self):
+        self.rpcStats.reset()
+        for _, _, _, reset in self.sections:
+            if reset is not None:
+                reset()
+        self.refresh()
+
+    def asDict(self):
+        d = {"time": time.time(), "rpc": self.rpcStats.asDict()}
+        for name, summary, asDict, _ in self.sections:
+            d[name] = summary() if asDict is None else asDict()
+        return d
+
+    def save(self):
+        filename, _ = QtWidgets.QFileDialog.getSaveFileName(
+            self, "Save diagnostics", os.path.expanduser("~/dcom_diagnostics.json"),
+            "JSON files (*.json);;All Files (*)")
+        if filename:
+            self.dump(filename)
+
+    def dump(self, filename):
+        with open(filename, "w") as fp:
+            json.dump(self.asDict(), fp, indent=1)
+        print("Wrote diagnostics to {}".format(filename))
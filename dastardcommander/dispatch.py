@@ -0,0 +1,149 @@
+"""
+Dispatch decoded ZMQ status messages to the handlers registered for their topics.
+"""
+
+import time
+from collections import OrderedDict
+
+# Groups of STATUS fields, for handlers that care only about changes to some fields.
+STATUS_RUNNING = ("STATUS", ("Running", "SourceName"))
+STATUS_GEOMETRY = ("STATUS", ("Running", "Nchannels", "ChanGroups"))
+STATUS_RECORD_LENGTH = ("STATUS", ("Nsamples", "Npresamp"))
+
+
+def changedFields(old, new):
+    """Return the set of keys whose values differ between dicts old and new (all keys of
+    new, if old is None)."""
+    if old is None or not isinstance(old, dict) or not isinstance(new, dict):
+        return set(new) if isinstance(new, dict) else set()
+    return set(k for k in set(old) | set(new) if old.get(k) != new.get(k))
+
+
+class TopicDispatcher(object):
+    """A table of handlers by topic, for the status messages from Dastard.
+
+    Each consumer (the main window, each tab) registers a dict of topic -> handler,
+    where a handler takes the decoded message as its only argument. A message is handed
+    to the handlers for its topic, in the order the consumers registered. If a
+    listener is given, each consumer's topics are also subscribed to (and unsubscribed
+    from) on it, so that only wanted topics are received.
+
+    Instead of a topic, the key can be a (topic, fields) pair, such as STATUS_GEOMETRY.
+    That handler is called only when at least one of the named fields differs from the
+    previous message on the topic, so a change in one part of a large message like
+    STATUS doesn't redo the work that depends only on other parts.
+
+    The newest message on each topic is kept, so a consumer registered late (such as
+    a window being shown) is brought up to date right away.
+
+    Hooks added with addHook are called after each handler as
+    hook(topic, handlerName, seconds), e.g. to gather timing statistics."""
+
+    def __init__(self, listener=None):
+        self.listener = listener
+        self._consumers = OrderedDict()  # consumer -> {topic: handler}
+        self._handlers = {}  # topic -> [(name, handler, fields)], rebuilt on (un)registering
+        self._fieldTopics = set()  # topics with handlers for only some fields
+        self._latest = {}
+        self._awaiting = []  # (set of topics not yet seen, callback)
+        self.hooks = []
+
+    def register(self, consumer, handlers, replay=True):
+        """Register (or replace) the dict of topic -> handler for consumer. If replay,
+        call the handlers at once with the newest message already seen on their topics."""
+        self._consumers[consumer] = dict(handlers)
+        self._rebuild()
+        if self.listener is not None:
+            self.listener.subscribe(consumer, set(self._split(k)[0] for k in handlers))
+        if replay:
+            for key, handler in handlers.items():
+                topic = self._split(key)[0]
+                if topic in self._latest:
+                    self._call(topic, self._name(consumer, handler), handler,
+                               self._latest[topic])
+
+    def unregister(self, consumer):
+        """Stop sending messages to consumer's handlers."""
+        if self._consumers.pop(consumer, None) is not None:
+            self._rebuild()
+        if self.listener is not None:
+            self.listener.unsubscribe(consumer)
+
+    def isRegistered(self, consumer):
+        return consumer in self._consumers
+
+    def topics(self):
+        """Return the set of topics that have at least one handler."""
+        return set(self._handlers.keys())
+
+    def whenSeen(self, topics, callback):
+        """Call callback() once, as soon as a message has been dispatched on every
+        one of topics."""
+        missing = set(topics) - set(self._latest.keys())
+        if len(missing) == 0:
+            callback()
+        else:
+            self._awaiting.append((missing, callback))
+
+    def dispatch(self, topic, d):
+        """Hand message d to every handler for topic. Return False if there are none."""
+        handlers = self._handlers.get(topic, ())
+        changed = None
+        if topic in self._fieldTopics:
+            changed = changedFields(self._latest.get(topic), d)
+        self._latest[topic] = d
+        for name, handler, fields in handlers:
+            if fields is not None and changed.isdisjoint(fields):
+                continue
+            self._call(topic, name, handler, d)
+        if self._awaiting:
+            self._checkAwaiting(topic)
+        return len(handlers) > 0
+
+    def addHook(self, hook):
+        self.hooks.append(hook)
+
+    def _call(self, topic, name, handler, d):
+        if not self.hooks:
+            handler(d)
+            return
+        tstart = time.perf_counter()
+        handler(d)
+        elapsed = time.perf_counter()-tstart
+        for hook in self.hooks:
+            hook(topic, name, elapsed)
+
+    def _checkAwaiting(self, topic):
+        ready = []
+        for missing, callback in self._awaiting:
+            missing.discard(topic)
+            if len(missing) == 0:
+                ready.append(callback)
+        if ready:
+            self._awaiting = [(m, c) for (m, c) in self._awaiting if len(m) > 0]
+            for callback in ready:
+                callback()
+
+    @staticmethod
+    def _split(key):
+        """Return (topic, fields) for a handler key: a topic or a (topic, fields) pair."""
+        if isinstance(key, tuple):
+            return key[0], frozenset(key[1])
+        return key, None
+
+    @staticmethod
+    def _name(consumer, handler):
+        return "%s.%s" % (type(consumer).__name__, getattr(handler, "__name__", "handler"))
+
+    def _rebuild(self):
+        table = {}
+        fieldTopics = set()
+        for consumer, handlers in self._consumers.items():
+            for key, handler in handlers.items():
+                topic, fields = self._split(key)
+                table.setdefault(topic, []).append((self._name(consumer, handler), handler,
+                                                    fields))
+                if fields is not None:
+                    fieldTopics.add(topic)
+        self._handlers = table
+        self._fieldTopics = fieldTopics
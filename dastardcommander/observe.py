@@ -1,15 +1,19 @@
 import numpy as np
 import os
+import matplotlib
 from matplotlib import cm
 import time
 from string import ascii_uppercase
 import itertools
 
 # Qt5 imports
-from PyQt5 import QtGui, QtWidgets
-from PyQt5.QtCore import pyqtSlot
+from PyQt5 import QtCore, QtGui, QtWidgets
+from PyQt5.QtCore import pyqtSignal, pyqtSlot
 import PyQt5.uic
 
+from .channels import ChannelTable
+from .dispatch import STATUS_GEOMETRY
+
 
 def iter_all_strings():
     "Iterator that returns A,B,C,...X,Y,Z,AA,AB,...ZX,ZY,ZZ,AAA,AAB,..."
@@ -52,8 +56,11 @@ class ExperimentStateIncrementer():
             "Label": stateName,
             "WaitForError": True,
         }
-        _, err = self.parent.client.call("SourceControl.SetExperimentStateLabel", config)
-        if err:
+        self.parent.client.call("SourceControl.SetExperimentStateLabel", config,
+                                callback=lambda result: self.stateSent(stateName, result))
+
+    def stateSent(self, stateName, result):
+        if result is None or result[1]:
             return
         self.updateLabel(stateName)
         self.ignoring = (stateName == "IGNORE")
@@ -78,72 +85,277 @@ class ExperimentStateIncrementer():
         self.lastValidState = "START"
 
 
+class RollingSum(object):
+    """The sum of the last (up to) window arrays added, each of nchan values.
+
+    The arrays are kept in a preallocated (window x nchan) ring buffer, and the sum is
+    updated as each is added and the oldest evicted, so adding costs O(nchan) however
+    long the window. Values are held as float64, so sums of counts are exact."""
+
+    def __init__(self, window, nchan):
+        self.window = max(1, int(window))
+        self.nchan = nchan
+        self.buffer = np.zeros((self.window, nchan))
+        self.total = np.zeros(nchan)
+        self.count = 0  # rows in use
+        self.next = 0  # the row the next array goes in
+
+    def add(self, values):
+        row = self.buffer[self.next]
+        if self.count == self.window:
+            self.total -= row
+        else:
+            self.count += 1
+        row[:] = values
+        self.total += row
+        self.next = (self.next+1) % self.window
+
+    def mean(self):
+        if self.count == 0:
+            return np.zeros(self.nchan)
+        return self.total/self.count
+
+    def isFull(self):
+        return self.count == self.window
+
+    def reset(self):
+        self.total[:] = 0
+        self.count = 0
+        self.next = 0
+
+    def resize(self, window):
+        """Change the window length, keeping the newest arrays that still fit."""
+        window = max(1, int(window))
+        if window == self.window:
+            return
+        keep = min(self.count, window)
+        newest = (self.next-keep+np.arange(keep)) % self.window
+        buffer = np.zeros((window, self.nchan))
+        buffer[:keep] = self.buffer[newest]
+        self.buffer = buffer
+        self.total = buffer[:keep].sum(axis=0)
+        self.window = window
+        self.count = keep
+        self.next = keep % window
+
+
+class CountRateModel(QtCore.QObject):
+    """The count rates and array layout shown by the Observe widgets.
+
+    The model handles the TRIGGERRATE, STATUS, CHANNELNAMES, TESMAP, TESMAPFILE and
+    EXTERNALTRIGGER messages and does the rate integration, once, however many Observe
+    widgets show it. It signals the widgets when there's something new to show."""
+
+    ratesChanged = pyqtSignal()
+    geometryChanged = pyqtSignal()  # new rows, columns or channel names (or source stopped)
+    mapChanged = pyqtSignal()  # new TES map
+    mapFileChanged = pyqtSignal(str)
+    externalTriggersChanged = pyqtSignal(int)
+    integrationTimeChanged = pyqtSignal(int)
+
+    def __init__(self, parent=None):
+        QtCore.QObject.__init__(self, parent)
+        self.channels = ChannelTable()  # injected from dc.py
+        self.cols = 0
+        self.rows = 0
+        self.pixelMap = None
+        self.mapfile = ""
+        self.integrationTime = 1
+        self.rolling = None  # a RollingSum of the CountsSeen over integrationTime messages
+        self.countRates = None
+        self.integrationComplete = False
+        self.arrayCps = 0
+        self.auxCps = 0
+
+    def topicHandlers(self):
+        """The handlers of ZMQ status messages, by topic."""
+        return {STATUS_GEOMETRY: self.handleStatusMessage,
+                "CHANNELNAMES": self.handleChannelNames,
+                "TESMAP": self.handleTESMap,
+                "TESMAPFILE": self.handleTESMapFile,
+                "TRIGGERRATE": self.handleTriggerRateMessage,
+                "EXTERNALTRIGGER": self.handleExternalTriggerMessage}
+
+    def isReady(self):
+        """Whether rates can be shown: the array layout and channel names are known."""
+        return self.cols > 0 and self.rows > 0 and len(self.channels) > 0
+
+    def setIntegrationTime(self, integrationTime):
+        if integrationTime != self.integrationTime:
+            self.integrationTime = integrationTime
+            if self.rolling is not None:
+                self.rolling.resize(integrationTime)
+            self.integrationTimeChanged.emit(integrationTime)
+
+    def handleTriggerRateMessage(self, d):
+        if self.cols == 0 or self.rows == 0:
+            print("got trigger rate message before status")
+            return
+        if len(self.channels) == 0:
+            print("got trigger rate message before channel names")
+            return
+
+        countsSeen = np.asarray(d["CountsSeen"])
+        nchan = len(countsSeen)
+        if self.rolling is None or self.rolling.nchan != nchan:
+            self.rolling = RollingSum(self.integrationTime, nchan)
+        self.rolling.add(countsSeen)
+        countRates = self.rolling.mean()
+        self.countRates = countRates
+        self.integrationComplete = self.rolling.isFull()
+        isSignal = self.channels.isSignal
+        n = min(nchan, len(isSignal))
+        self.arrayCps = countRates[:n][isSignal[:n]].sum()
+        self.auxCps = countRates[:n].sum()-self.arrayCps
+        self.ratesChanged.emit()
+
+    @pyqtSlot()
+    def resetIntegration(self):
+        if self.rolling is not None:
+            self.rolling.reset()
+        self.countRates = None
+        self.integrationComplete = False
+        self.arrayCps = self.auxCps = 0
+        self.ratesChanged.emit()
+
+    def handleStatusMessage(self, d):
+        if d["Running"]:
+            groups = d["ChanGroups"]
+            # in principle chan per group can vary, we ignore that until it happens
+            self.cols = len(groups)
+            self.rows = groups[0]["Nchan"]
+        else:
+            self.cols = 0
+            self.rows = 0
+        self.geometryChanged.emit()
+
+    def handleChannelNames(self, names):
+        # dc has already made the new self.channels from names.
+        self.geometryChanged.emit()
+
+    def handleTESMapFile(self, filename):
+        self.mapfile = filename
+        self.mapFileChanged.emit(filename)
+
+    def handleTESMap(self, msg):
+        scale = 1.0/float(msg["Spacing"])
+        minx = np.min([p["X"] for p in msg["Pixels"]])
+        maxy = np.max([p["Y"] for p in msg["Pixels"]])
+        print("MinX = ", minx, " MaxY=", maxy)
+        self.pixelMap = [((p["X"]-minx)*scale, (maxy-p["Y"])*scale) for p in msg["Pixels"]]
+        print("handleTESMap with spacing ", msg["Spacing"], " scale ", scale)
+        self.mapChanged.emit()
+
+    def handleExternalTriggerMessage(self, msg):
+        self.externalTriggersChanged.emit(msg["NumberObservedInLastSecond"])
+
+
 class Observe(QtWidgets.QWidget):
-    """The tricky bit about this widget is that it cannot be properly set up until
+    """A view of a CountRateModel, which can be shared with other Observe widgets.
+
+    The tricky bit about this widget is that it cannot be properly set up until
     dc has processed both a CHANNELNAMES message and a STATUS message (to get the
-    number of rows and columns)."""
+    number of rows and columns). While hidden, it doesn't render new rates, but
+    catches up when shown."""
+
+    closed = pyqtSignal()  # emitted when the widget, as a top-level window, is closed
+    paintAbove = 1024  # paint arrays with more pixels than this with CountRateImage
 
-    def __init__(self, parent, host, client):
+    def __init__(self, parent, host, client, model=None):
         QtWidgets.QWidget.__init__(self, parent)
         self.client = client
         self.host = host
+        if model is None:
+            model = CountRateModel(self)
+        self.model = model
         PyQt5.uic.loadUi(os.path.join(os.path.dirname(__file__), "ui/observe.ui"), self)
-        self.pushButton_resetIntegration.clicked.connect(self.resetIntegration)
+        self.pushButton_resetIntegration.clicked.connect(self.model.resetIntegration)
         self.pushButton_autoScale.clicked.connect(self.handleAutoScaleClicked)
         self.mapLoadButton.clicked.connect(self.handleLoadMap)
+        self.checkBox_paintedMap.toggled.connect(self.handlePaintedMapToggled)
+        self.spinBox_integrationTime.setValue(self.model.integrationTime)
+        self.spinBox_integrationTime.valueChanged.connect(self.model.setIntegrationTime)
+        self.model.integrationTimeChanged.connect(self.spinBox_integrationTime.setValue)
+        self.model.ratesChanged.connect(self.handleRatesChanged)
+        self.model.geometryChanged.connect(self.handleGeometryChanged)
+        self.model.mapChanged.connect(self.handleMapChanged)
+        self.model.mapFileChanged.connect(self.handleTESMapFile)
+        self.model.externalTriggersChanged.connect(self.handleExternalTriggers)
         self.crm_grid = None
         self.crm_map = None
-        self.countsSeens = []
-        self.cols = 0
-        self.rows = 0
-        self.channel_names = []  # injected from dc.py
+        self.gridKey = None  # the (channel names, rows, cols) crm_grid shows
+        self.mapKey = None  # the (channel names, rows, cols, pixel map) crm_map shows
+        self.layoutChanged = False  # whether the model's layout may differ from the maps'
+        self.stale = False  # whether the model changed while hidden
         self.auxPerChan = 0
         self.lastTotalRate = 0
-        self.mapfile = ""
         self.ExperimentStateIncrementer = ExperimentStateIncrementer(
             self.pushButton_experimentStateNew,
             self.pushButton_experimentStateIGNORE, self.label_experimentState, self)
 
-    def handleTriggerRateMessage(self, d):
-        if self.cols == 0 or self.rows == 0:
-            print("got trigger rate message before status")
+    def topicHandlers(self):
+        """The handlers of ZMQ status messages, by topic. (The model handles the rest.)"""
+        return {"WRITING": self.handleWritingMessage}
+
+    def closeEvent(self, event):
+        self.closed.emit()
+        QtWidgets.QWidget.closeEvent(self, event)
+
+    def showEvent(self, event):
+        QtWidgets.QWidget.showEvent(self, event)
+        if self.stale:
+            self.render()
+
+    @pyqtSlot()
+    def handleRatesChanged(self):
+        if self.isVisible():
+            self.render()
+        else:
+            self.stale = True
+
+    def render(self):
+        """Show the model's current count rates."""
+        self.stale = False
+        model = self.model
+        if self.layoutChanged and model.isReady():
+            self.updateLayout()
+        countRates = model.countRates
+        if countRates is None or len(countRates) != len(model.channels):
+            for crm in (self.crm_grid, self.crm_map):
+                if crm is not None:
+                    crm.setCountRates(np.zeros(len(crm.channel_names)), 1)
+            self.setArrayCps(0, False, 0)
             return
-        if len(self.channel_names) == 0:
-            print("got trigger rate message before channel names")
+        if not model.isReady():
             return
-        if self.crm_grid is None:
-            self.buildCRM()
 
-        countsSeen = np.array(d["CountsSeen"])
-        integrationTime = self.spinBox_integrationTime.value()
-        self.countsSeens.append(countsSeen)
-        n = min(len(self.countsSeens), integrationTime)
-        self.countsSeens = self.countsSeens[-n:]
-        countRates = np.zeros(len(countsSeen))
-        for cs in self.countsSeens:
-            countRates += cs
-        countRates /= len(self.countsSeens)
         colorScale = self.getColorScale(countRates)
-        if self.crm_grid is not None:
-            self.crm_grid.setCountRates(countRates, colorScale)
-        if hasattr(self, "pixelMap"):
-            if self.crm_map is None or len(self.crm_map.buttons) == 0:
-                # if we build the crm_map before we know the source and know channel_names
-                # (eg before a dastard source is started) we will need to rebuild it later
-                # so we check here
-                print("rebuding CRMMap due to len(buttons)==0")
-                self.buildCRMMap()
-                print("now have len(buttons)={}".format(len(self.crm_map.buttons)))
+        self.crm_grid.setCountRates(countRates, colorScale)
+        if self.crm_map is not None:
             self.crm_map.setCountRates(countRates, colorScale)
-        integrationComplete = len(self.countsSeens) == integrationTime
-        arrayCps = 0
-        auxCps = 0
-        for cr, channel_name in zip(countRates, self.channel_names):
-            if channel_name.startswith("chan"):
-                arrayCps += cr
-            else:
-                auxCps += cr
-        self.setArrayCps(arrayCps, integrationComplete, auxCps)
+        self.setArrayCps(model.arrayCps, model.integrationComplete, model.auxCps)
+
+    def updateLayout(self):
+        """Make the count rate maps show the model's array layout, reusing the maps (or as
+        much of them as possible) when the layout hasn't changed."""
+        self.layoutChanged = False
+        model = self.model
+        gridKey = (model.channels, model.rows, model.cols)
+        if self.crm_grid is None:
+            self.buildCRM()
+        elif gridKey != self.gridKey:
+            self.crm_grid.setArrayLayout(model.cols, model.rows, model.channels)
+        self.gridKey = gridKey
+        if model.pixelMap is None:
+            self.deleteCRMMap()
+            return
+        mapKey = gridKey+(tuple(model.pixelMap),)
+        if self.crm_map is None:
+            self.buildCRMMap()
+        elif mapKey != self.mapKey:
+            self.crm_map.setArrayLayout(model.cols, model.rows, model.channels,
+                                        xy=model.pixelMap)
+        self.mapKey = mapKey
 
     def getColorScale(self, countRates):
         if self.pushButton_autoScale.isChecked():
@@ -166,9 +378,16 @@ class Observe(QtWidgets.QWidget):
         sAux = "{:.2f} aux cps".format(auxCps)
         self.label_auxCps.setText(sAux)
 
+    def mapClass(self):
+        """The widget class for the count rate maps: CountRateImage if painting."""
+        if self.checkBox_paintedMap.isChecked():
+            return CountRateImage
+        return CountRateMap
+
     def buildCRM(self):
         self.deleteCRMGrid()
-        self.crm_grid = CountRateMap(self, self.cols, self.rows, self.channel_names)
+        self.crm_grid = self.mapClass()(self, self.model.cols, self.model.rows,
+                                        self.model.channels)
         self.GridTab.layout().addWidget(self.crm_grid)
 
     def deleteCRMGrid(self):
@@ -176,15 +395,18 @@ class Observe(QtWidgets.QWidget):
             self.crm_grid.parent = None
             self.crm_grid.deleteLater()
             self.crm_grid = None
+        self.gridKey = None
+
+    @pyqtSlot()
+    def handleMapChanged(self):
+        self.handleLayoutChanged()
 
     def buildCRMMap(self):
         self.deleteCRMMap()
-        print("Building CountRateMap with %d cols x %d rows" % (self.cols, self.rows))
-        print("len(channel_names", len(self.channel_names))
-        self.crm_map = CountRateMap(self, self.cols, self.rows, self.channel_names,
-                                    xy=self.pixelMap)
-        # if we build the crm_map before we know the source and know channel_names
-        # (eg before a dastard source is started) we will need to rebuild it later
+        model = self.model
+        print("Building CountRateMap with %d cols x %d rows" % (model.cols, model.rows))
+        self.crm_map = self.mapClass()(self, model.cols, model.rows, model.channels,
+                                       xy=model.pixelMap)
         self.MapTab.layout().addWidget(self.crm_map, 0)
 
     def deleteCRMMap(self):
@@ -192,28 +414,28 @@ class Observe(QtWidgets.QWidget):
             self.crm_map.parent = None
             self.crm_map.deleteLater()
             self.crm_map = None
+        self.mapKey = None
 
-    def handleStatusUpdate(self, is_running, source_name, ngroup, nrow):
-        if not is_running:
-            return self.handleStop()
-        # A hack for now to not count error channels.
-        self.cols = ngroup
-        self.rows = nrow
-        self.deleteCRMGrid()
-        self.deleteCRMMap()
+    @pyqtSlot()
+    def handleGeometryChanged(self):
+        if self.model.cols*self.model.rows > self.paintAbove:
+            # A button per pixel is too slow for this many.
+            self.checkBox_paintedMap.setChecked(True)
+        self.handleLayoutChanged()
+
+    def handleLayoutChanged(self):
+        # The maps are kept, to be updated (or found to be unchanged) when next shown.
+        self.layoutChanged = True
+        if self.isVisible():
+            self.render()
+        else:
+            self.stale = True
 
-    def handleStop(self):
-        self.cols = 0
-        self.rows = 0
+    @pyqtSlot(bool)
+    def handlePaintedMapToggled(self, painted):
         self.deleteCRMGrid()
         self.deleteCRMMap()
-
-    @pyqtSlot()
-    def resetIntegration(self):
-        self.countsSeens = []
-        if self.crm_grid is not None:
-            self.crm_grid.setCountRates(np.zeros(len(self.crm_grid.buttons)), 1)
-        self.setArrayCps(0, False, 0)
+        self.handleLayoutChanged()
 
     def handleAutoScaleClicked(self):
         self.doubleSpinBox_colorScale.setEnabled(not self.pushButton_autoScale.isChecked())
@@ -222,7 +444,7 @@ class Observe(QtWidgets.QWidget):
     def handleLoadMap(self):
         if self.host == "localhost":
             file, _ = QtWidgets.QFileDialog.getOpenFileName(
-                self, "Select a TES map file", self.mapfile,
+                self, "Select a TES map file", self.model.mapfile,
                 "Maps (*.cfg *.txt)")
             if file == "":
                 return
@@ -230,28 +452,18 @@ class Observe(QtWidgets.QWidget):
             file, okay = QtWidgets.QInputDialog.getText(
                 self, "Choose map file",
                 "Enter full path to map file on %s (remote server):" % self.host,
-                QtWidgets.QLineEdit.Normal, self.mapfile)
+                QtWidgets.QLineEdit.Normal, self.model.mapfile)
             if not okay or file == "":
                 return
-        okay = self.client.call("MapServer.Load", file)
+        self.client.call("MapServer.Load", file)
 
+    @pyqtSlot(str)
     def handleTESMapFile(self, filename):
-        self.mapfile = filename
         head, tail = os.path.split(filename)
         self.mapFileLabel.setText("Map File: %s" % tail)
 
-    def handleTESMap(self, msg):
-        scale = 1.0/float(msg["Spacing"])
-        minx = np.min([p["X"] for p in msg["Pixels"]])
-        maxy = np.max([p["Y"] for p in msg["Pixels"]])
-        print("MinX = ", minx, " MaxY=", maxy)
-        self.pixelMap = [((p["X"]-minx)*scale, (maxy-p["Y"])*scale) for p in msg["Pixels"]]
-        print("handleTESMap with spacing ", msg["Spacing"], " scale ", scale)
-        # print(self.pixelMap)
-        self.buildCRMMap()
-
-    def handleExternalTriggerMessage(self, msg):
-        n = msg["NumberObservedInLastSecond"]
+    @pyqtSlot(int)
+    def handleExternalTriggers(self, n):
         self.label_externalTriggersInLastSecond.setText(
             "{} external triggers in last second".format(n))
 
@@ -261,6 +473,86 @@ class Observe(QtWidgets.QWidget):
             self.ExperimentStateIncrementer.resetStateLabels()
 
 
+def pixelLayout(channel_names, rows, xy=None):
+    """Return where a count rate map shows each TES signal ("chan") channel, as a list of
+    (channel index, x, y, TES row, TES column), with x and y in units of the pixel spacing.
+
+    Without xy, the pixels fill rows of up to 32, with "continuation rows" indented by 2.
+    Otherwise xy[i] is the (x, y) position of the ith signal channel (see handleTESMap),
+    and channels beyond the end of xy aren't shown."""
+    MaxPerRow = 32  # no more than this many pixels per row
+    layout = []
+    rowdisp = rownum = coldisp = colnum = i = 0
+    # rowdisp means row number on the display
+    # rownum means TES's actual row number
+    for index, name in enumerate(channel_names):
+        if not name.startswith("chan"):
+            continue
+        if xy is None:
+            x, y = rowdisp, coldisp
+        elif i < len(xy):
+            x, y = xy[i]
+        else:
+            break  # the map has no more pixels
+        layout.append((index, x, y, rownum, colnum))
+        rowdisp += 1
+        rownum += 1
+        i += 1
+        if rownum >= rows:
+            rownum = 0
+            colnum += 1
+        elif rowdisp >= MaxPerRow:
+            rowdisp = 2  # Indent "continuation rows"
+            coldisp += 1
+    return layout
+
+
+def pixelTooltip(name, rownum, colnum, rows):
+    return "{}, row{}col{} (matterchan{})".format(name, rownum, colnum, 2*(rows*colnum+rownum)+1)
+
+
+COLOR_LEVELS = 256  # distinct colors in a count rate map
+_colorTables = {}
+
+
+def colorTable(name="Wistia"):
+    """Return the colors of the named matplotlib colormap at COLOR_LEVELS evenly spaced
+    levels, as a (COLOR_LEVELS x 4) array of RGBA bytes. Each table is made only once."""
+    if name not in _colorTables:
+        try:
+            cmap = matplotlib.colormaps[name]
+        except AttributeError:  # matplotlib before 3.5
+            cmap = cm.get_cmap(name)
+        # Sample the middle of each level, so a 256-color map gives exactly its own colors.
+        levels = (np.arange(COLOR_LEVELS)+0.5)/COLOR_LEVELS
+        _colorTables[name] = cmap(levels, bytes=True)
+    return _colorTables[name]
+
+
+def colorLevels(countRates, colorScale):
+    """Return the index into a colorTable for each count rate, where colorScale and
+    above get the last color."""
+    levels = np.nan_to_num(np.asarray(countRates, dtype=float)*(COLOR_LEVELS/float(colorScale)))
+    return np.clip(levels, 0, COLOR_LEVELS-1).astype(int)
+
+
+def rateBuckets(countRates):
+    """Return each count rate in units of 0.01, rounded to the precision formatRate shows,
+    so that rates with equal buckets look the same on a map."""
+    cr = np.nan_to_num(np.asarray(countRates, dtype=float))
+    return np.where(cr < 10, np.round(cr*100),
+                    np.where(cr < 100, np.round(cr*10)*10, np.round(cr)*100)).astype(np.int64)
+
+
+def formatRate(cr):
+    """Format a count rate to fit on a map pixel."""
+    if cr < 10:
+        return "{:.2f}".format(cr)
+    elif cr < 100:
+        return "{:.1f}".format(cr)
+    return "{:.0f}".format(cr)
+
+
 class CountRateMap(QtWidgets.QWidget):
     """Provide the UI inside the Triggering tab.
 
@@ -271,13 +563,21 @@ class CountRateMap(QtWidgets.QWidget):
     def __init__(self, parent, cols, rows, channel_names, xy=None):
         QtWidgets.QWidget.__init__(self, parent)
         self.buttons = []
+        # The color level and rate bucket each button shows (-1 for none yet).
+        self.levels = np.zeros(0, dtype=int)
+        self.buckets = np.zeros(0, dtype=np.int64)
+        self.styleSheets = ["QPushButton {background-color: rgb(%d,%d,%d);}" % tuple(c[:3])
+                            for c in colorTable()]
+        self.setArrayLayout(cols, rows, channel_names, xy)
+
+    def setArrayLayout(self, cols, rows, channel_names, xy=None):
+        """Show channel_names in the grid layout for cols x rows, or at positions xy."""
         self.cols = cols
         self.rows = rows
-        self.channel_names = channel_names
-        if xy is None:
-            self.initButtons(scale=25)
-        else:
-            self.initButtons(scale=23, xy=xy)
+        self.channel_names = list(channel_names)
+        self.xy = xy
+        self.scale = 25 if xy is None else 23
+        self.initButtons()
 
     def addButton(self, x, y, xwidth, ywidth, tooltip):
         button = QtWidgets.QPushButton(self)
@@ -286,8 +586,9 @@ class CountRateMap(QtWidgets.QWidget):
         button.setFont(self.buttonFont)
         button.setFlat(False)
         button.setToolTip(tooltip)
+        button.show()
         # button.setCheckable(True)
-        self.buttons.append(button)
+        return button
 
     def deleteButtons(self):
         for button in self.buttons:
@@ -299,57 +600,223 @@ class CountRateMap(QtWidgets.QWidget):
 
     def setColsRows(self, cols, rows):
         if cols != self.cols or rows != self.rows:
-            self.cols = cols
-            self.rows = rows
-            self.initButtons()
-
-    def initButtons(self, scale=25, xy=None):
-        MaxPerRow = 32  # no more than this many buttons per row
-        self.deleteButtons()
-        print(self.channel_names)
-        rowdisp = rownum = coldisp = colnum = i = 0
-        # rowdisp means row number on the display
-        # rownum means TES's actual row number
-        for name in self.channel_names:
-            if not name.startswith("chan"):
-                self.buttons.append(None)
+            self.setArrayLayout(cols, rows, self.channel_names, self.xy)
+
+    def initButtons(self):
+        """Lay out the buttons, reusing the existing ones. Creating buttons is slow, so
+        only those beyond the number already made are created, and only those that
+        move or change tooltip are touched."""
+        scale = self.scale
+        old = [(b, self.levels[i], self.buckets[i]) for (i, b) in enumerate(self.buttons)
+               if b is not None]
+        self.buttons = [None]*len(self.channel_names)
+        self.levels = np.full(len(self.buttons), -1, dtype=int)
+        self.buckets = np.full(len(self.buttons), -1, dtype=np.int64)
+        layout = pixelLayout(self.channel_names, self.rows, self.xy)
+        for button, _, _ in old[len(layout):]:
+            button.setParent(None)
+            button.deleteLater()
+        for j, (index, x, y, rownum, colnum) in enumerate(layout):
+            pos = QtCore.QPoint(int(scale*x), int(scale*y))
+            tooltip = pixelTooltip(self.channel_names[index], rownum, colnum, self.rows)
+            if j >= len(old):
+                self.buttons[index] = self.addButton(pos.x(), pos.y(), scale-1, scale-1,
+                                                     tooltip)
                 continue
-            if xy is None:
-                x = scale*rowdisp
-                y = scale*coldisp
-            else:
-                x = scale*xy[i][0]
-                y = scale*xy[i][1]
-            self.addButton(x, y, scale-1, scale-1,
-                           "{}, row{}col{} (matterchan{})".format(name, rownum, colnum, 2*(self.rows*colnum+rownum)+1))
-            rowdisp += 1
-            rownum += 1
-            i += 1
-            if rownum >= self.rows:
-                rownum = 0
-                colnum += 1
-            elif rowdisp >= MaxPerRow:
-                rowdisp = 2  # Indent "continuation rows"
-                coldisp += 1
+            button, self.levels[index], self.buckets[index] = old[j]
+            if button.pos() != pos:
+                button.move(pos)
+            if button.width() != scale-1:
+                button.setFixedSize(scale-1, scale-1)
+            if button.toolTip() != tooltip:
+                button.setToolTip(tooltip)
+            self.buttons[index] = button
+        self.hasButton = np.array([b is not None for b in self.buttons], dtype=bool)
 
     def setCountRates(self, countRates, colorScale):
-        colorScale = float(colorScale)
         assert(len(countRates) == len(self.buttons))
-        # cmap = cm.get_cmap('YlOrRd')
-        cmap = cm.get_cmap('Wistia')
-        for i, cr in enumerate(countRates):
+        levels = colorLevels(countRates, colorScale)
+        buckets = rateBuckets(countRates)
+        # Touch only the buttons whose color or text changes: restyling a button is slow.
+        newColor = levels != self.levels
+        newText = buckets != self.buckets
+        for i in np.nonzero((newColor | newText) & self.hasButton)[0]:
             button = self.buttons[i]
-            if button is None:
-                continue
-            if cr < 10:
-                buttonText = "{:.2f}".format(cr)
-            elif cr < 100:
-                buttonText = "{:.1f}".format(cr)
+            if newText[i]:
+                button.setText(formatRate(buckets[i]/100.0))
+            if newColor[i]:
+                button.setStyleSheet(self.styleSheets[levels[i]])
+        self.levels = levels
+        self.buckets = buckets
+
+
+class CountRateImage(QtWidgets.QWidget):
+    """A count rate map that paints the whole array in one widget, for large arrays.
+
+    It shows the same layouts as CountRateMap, but rather than a button per pixel, the
+    colors are written from NumPy arrays into one QImage, which is scaled to fit the
+    widget. The rates are written on the pixels only when they're big enough to read.
+    Hovering over a pixel shows its tooltip, and clicking selects it."""
+
+    pixelSelected = pyqtSignal(int)  # channel index of the pixel clicked, or -1 for none
+    textFont = QtGui.QFont("Times", 7, QtGui.QFont.Bold)
+    subpixels = 8  # image pixels per pixel spacing, including 1 for the gap between pixels
+    minTextSize = 20  # write rates only on pixels at least this many screen pixels wide
+
+    def __init__(self, parent, cols, rows, channel_names, xy=None):
+        QtWidgets.QWidget.__init__(self, parent)
+        self.setSizePolicy(QtWidgets.QSizePolicy.Expanding, QtWidgets.QSizePolicy.Expanding)
+        self.setArrayLayout(cols, rows, channel_names, xy)
+
+    def setArrayLayout(self, cols, rows, channel_names, xy=None):
+        """Show channel_names in the grid layout for cols x rows, or at positions xy."""
+        self.cols = cols
+        self.rows = rows
+        self.channel_names = list(channel_names)
+        self.xy = xy
+        self.scale = 25 if xy is None else 23  # largest screen pixels per pixel spacing
+        self.selected = -1
+        self.countRates = None
+        self.initImage()
+
+    def initImage(self):
+        layout = pixelLayout(self.channel_names, self.rows, self.xy)
+        nchan = len(self.channel_names)
+        self.index = np.array([p[0] for p in layout], dtype=int)
+        self.pixelX = np.array([p[1] for p in layout], dtype=float)
+        self.pixelY = np.array([p[2] for p in layout], dtype=float)
+        self.rownum = np.array([p[3] for p in layout], dtype=int)
+        self.colnum = np.array([p[4] for p in layout], dtype=int)
+        self.position = np.full(nchan, -1, dtype=int)  # channel index -> position in layout
+        self.position[self.index] = np.arange(len(layout))
+
+        # Label each image pixel with the channel index shown there, or nchan for the
+        # background, so coloring the image is one lookup and so is finding the pixel
+        # under the mouse.
+        S = self.subpixels
+        px = np.round(self.pixelX*S).astype(int)
+        py = np.round(self.pixelY*S).astype(int)
+        self.mapWidth = 1+int(np.ceil(self.pixelX.max())) if len(layout) > 0 else 1
+        self.mapHeight = 1+int(np.ceil(self.pixelY.max())) if len(layout) > 0 else 1
+        self.labels = np.full((self.mapHeight*S, self.mapWidth*S), nchan, dtype=np.int32)
+        inside = np.arange(S-1)
+        self.labels[py[:, None, None]+inside[None, :, None],
+                    px[:, None, None]+inside[None, None, :]] = self.index[:, None, None]
+
+        rgba = colorTable().astype(np.uint32)
+        self.table = 0xff000000 | (rgba[:, 0] << 16) | (rgba[:, 1] << 8) | rgba[:, 2]
+        self.levels = np.full(nchan, -1, dtype=int)  # color level of each channel
+        self.buckets = np.full(nchan, -1, dtype=np.int64)  # rate bucket of each channel
+        self.colors = np.zeros(nchan+1, dtype=np.uint32)
+        self.colors[nchan] = self.palette().color(QtGui.QPalette.Window).rgb()
+        self.pixels = self.colors[self.labels]
+        self.image = QtGui.QImage(self.pixels.data, self.pixels.shape[1], self.pixels.shape[0],
+                                  4*self.pixels.shape[1], QtGui.QImage.Format_RGB32)
+        self.updateGeometry()
+        self.update()
+
+    def setCountRates(self, countRates, colorScale):
+        countRates = np.asarray(countRates, dtype=float)
+        assert(len(countRates) == len(self.channel_names))
+        self.countRates = countRates
+        levels = colorLevels(countRates, colorScale)
+        changed = False
+        if not np.array_equal(levels, self.levels):
+            self.levels = levels
+            self.colors[:len(levels)] = self.table[levels]
+            np.take(self.colors, self.labels, out=self.pixels)
+            changed = True
+        if self.showsText():
+            buckets = rateBuckets(countRates)
+            if not np.array_equal(buckets, self.buckets):
+                self.buckets = buckets
+                changed = True
+        if changed:
+            self.update()
+
+    def showsText(self):
+        return self.innerSize() >= self.minTextSize
+
+    def innerSize(self):
+        """The size in screen pixels of a pixel, without the gap around it."""
+        return self.pixelSize()*(self.subpixels-1)/self.subpixels
+
+    def pixelSize(self):
+        """The size in screen pixels of one pixel spacing, as the map is scaled to fit."""
+        return min(float(self.scale), self.width()/self.mapWidth,
+                   self.height()/self.mapHeight)
+
+    def sizeHint(self):
+        return QtCore.QSize(min(self.scale*self.mapWidth, 1000),
+                            min(self.scale*self.mapHeight, 1000))
+
+    def minimumSizeHint(self):
+        return QtCore.QSize(2*self.mapWidth, 2*self.mapHeight)
+
+    def channelAt(self, pos):
+        """Return the index of the channel shown at pos (widget coordinates), or -1."""
+        size = self.pixelSize()
+        ix = int(pos.x()*self.subpixels/size)
+        iy = int(pos.y()*self.subpixels/size)
+        if pos.x() < 0 or pos.y() < 0 or iy >= self.labels.shape[0] or \
+                ix >= self.labels.shape[1]:
+            return -1
+        index = self.labels[iy, ix]
+        if index >= len(self.channel_names):
+            return -1
+        return int(index)
+
+    def tooltip(self, index):
+        p = self.position[index]
+        text = pixelTooltip(self.channel_names[index], self.rownum[p], self.colnum[p],
+                            self.rows)
+        if self.countRates is not None:
+            text += ": {} cps".format(formatRate(self.countRates[index]))
+        return text
+
+    def setSelected(self, index):
+        if index != self.selected:
+            self.selected = index
+            self.pixelSelected.emit(index)
+            self.update()
+
+    def event(self, event):
+        if event.type() == QtCore.QEvent.ToolTip:
+            index = self.channelAt(event.pos())
+            if index < 0:
+                QtWidgets.QToolTip.hideText()
+                event.ignore()
             else:
-                buttonText = "{:.0f}".format(cr)
-            button.setText(buttonText)
+                QtWidgets.QToolTip.showText(event.globalPos(), self.tooltip(index), self)
+            return True
+        return QtWidgets.QWidget.event(self, event)
 
-            color = cmap(cr/colorScale, bytes=True)
-            colorString = "rgb({},{},{})".format(color[0], color[1], color[2])
-            colorString = 'QPushButton {background-color: %s;}' % colorString
-            button.setStyleSheet(colorString)
+    def mousePressEvent(self, event):
+        if event.button() == QtCore.Qt.LeftButton:
+            self.setSelected(self.channelAt(event.pos()))
+        else:
+            QtWidgets.QWidget.mousePressEvent(self, event)
+
+    def paintEvent(self, event):
+        size = self.pixelSize()
+        painter = QtGui.QPainter(self)
+        painter.drawImage(QtCore.QRectF(0, 0, size*self.mapWidth, size*self.mapHeight),
+                          self.image)
+        inner = self.innerSize()
+        if self.countRates is not None and inner >= self.minTextSize:
+            # Write rates on only the pixels in the region being repainted.
+            r = event.rect()
+            x = self.pixelX*size
+            y = self.pixelY*size
+            visible = (x+inner >= r.left()) & (x <= r.right()) & \
+                (y+inner >= r.top()) & (y <= r.bottom())
+            painter.setFont(self.textFont)
+            for p in np.nonzero(visible)[0]:
+                painter.drawText(QtCore.QRectF(x[p], y[p], inner, inner),
+                                 QtCore.Qt.AlignCenter, formatRate(self.countRates[self.index[p]]))
+        if self.selected >= 0 and self.position[self.selected] >= 0:
+            p = self.position[self.selected]
+            painter.setPen(QtGui.QPen(QtCore.Qt.black, 2))
+            painter.drawRect(QtCore.QRectF(self.pixelX[p]*size, self.pixelY[p]*size, inner,
+                                           inner))
+        painter.end()
@@ -7,6 +7,9 @@ import json
 import PyQt5
 from PyQt5 import QtCore, QtGui, QtWidgets
 from PyQt5.QtWidgets import QFileDialog
+
+from .channels import ChannelTable
+
 #  0 -  3  Version = 1          (uint32)
 #  4       'G'                  (byte)
 #  5       'F'                  (byte)
@@ -89,17 +92,13 @@ def getConfigs(filename, channelNames):
 # dastard channelNames go from chan1 to chanN and err1 to errN
 # we need to mape from channelName to channelIndex (0-2N-1)
 def getNameNumberToIndex(channelNames):
-    nameNumberToIndex = {}
-    for (i, name) in enumerate(channelNames):
-        if not name.startswith("chan"):
-            continue
-        nameNumber = int(name[4:])
-        nameNumberToIndex[nameNumber] = i
-        # for now since we only use this with lancero sources, error for non-odd index
-        # if i % 2 != 1:
-        #     raise Exception(
-        #         "all fb channelIndices on a lancero source are odd, we shouldn't load projectors for even channelIndices")
-    return nameNumberToIndex
+    """Return a dict from signal channel number to channel index. channelNames is a
+    ChannelTable (which has the dict already) or a list of channel names."""
+    if not isinstance(channelNames, ChannelTable):
+        channelNames = ChannelTable(channelNames)
+    return channelNames.numberToIndex("chan")
+
+
 #
 # def remapConfigs(configs0, channelNames):
 #     nameNumberToIndex = getNameNumberToIndex(channelNames)
@@ -119,15 +118,19 @@ def getFileNameWithDialog(qtparent, startdir):
 
 def sendProjectors(qtparent, fileName, channel_names, client):
         print("sendProjectors: opening: {}".format(fileName))
+        if not isinstance(channel_names, ChannelTable):
+            channel_names = ChannelTable(channel_names)
         configs = getConfigs(fileName, channel_names)
         print("sendProjectors: Sending model for {} chans".format(len(configs)))
         success_chans = []
         failures = OrderedDict()
-        n_expected = np.sum([s.startswith("chan") for s in channel_names])
-        for channelIndex, config in list(configs.items()):
-            # print("sending ProjectorsBasis for {}".format(channelIndex))
-            okay, error = client.call(
-                "SourceControl.ConfigureProjectorsBasis", config, verbose=False, errorBox=False, throwError=False)
+        n_expected = np.sum(channel_names.isSignal)
+        # Pipeline all channels' requests rather than paying a round trip for each.
+        calls = [("SourceControl.ConfigureProjectorsBasis", config) for config in configs.values()]
+        results = client.call_many(calls, verbose=False, errorBox=False, throwError=False)
+        if results is None:
+            return False
+        for channelIndex, (okay, error) in zip(configs.keys(), results):
             if okay:
                 success_chans.append(channelIndex)
             else:
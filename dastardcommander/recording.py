@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+
+"""
+Record the ZMQ status stream published by Dastard to a file, and replay it.
+
+usage:
+
+python -m dastardcommander.recording record [--host localhost:5501] FILE [TOPIC ...]
+python -m dastardcommander.recording replay [--port 5501] [--speed X] FILE
+
+A recording is an append-only binary file: a short header, then one record per
+message holding its time of receipt, topic and (undecoded) contents. Replaying
+publishes the messages on a local ZMQ PUB socket with the original spacing divided by
+the speed (speed 0 means as fast as possible), so Dastard Commander or any other
+subscriber can be run against real traffic without the hardware.
+"""
+
+import argparse
+import os
+import struct
+import sys
+import threading
+import time
+
+import zmq
+
+MAGIC = b"DCZMQREC1\n"
+RECORD_HEADER = struct.Struct("<dHI")  # receipt time (s), topic length, contents length
+
+
+class StreamRecorder(object):
+    """Append (topic, contents) messages with their receipt times to a recording file."""
+
+    def __init__(self, filename):
+        self.filename = filename
+        isnew = not os.path.exists(filename) or os.path.getsize(filename) == 0
+        self._file = open(filename, "ab")
+        if isnew:
+            self._file.write(MAGIC)
+        self._lock = threading.Lock()
+        self.nrecords = 0
+
+    def write(self, topic, contents, t=None):
+        """Record one message. topic and contents are bytes, as received from ZMQ."""
+        if t is None:
+            t = time.time()
+        with self._lock:
+            if self._file is None:
+                return
+            self._file.write(RECORD_HEADER.pack(t, len(topic), len(contents)))
+            self._file.write(topic)
+            self._file.write(contents)
+            self.nrecords += 1
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+        print("Recorded %d messages to %s" % (self.nrecords, self.filename))
+
+
+def readRecording(filename):
+    """Generate the (time, topic, contents) records in a recording file."""
+    with open(filename, "rb") as fp:
+        if fp.read(len(MAGIC)) != MAGIC:
+            raise ValueError("%s is not a Dastard ZMQ recording" % filename)
+        while True:
+            header = fp.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                return  # A truncated last record means recording was interrupted.
+            t, ntopic, ncontents = RECORD_HEADER.unpack(header)
+            topic = fp.read(ntopic)
+            contents = fp.read(ncontents)
+            if len(contents) < ncontents:
+                return
+            yield t, topic, contents
+
+
+def record(host, filename, topics=None):
+    """Record messages published at host (e.g. "localhost:5501") until interrupted."""
+    context = zmq.Context()
+    socket = context.socket(zmq.SUB)
+    socket.connect("tcp://%s" % host)
+    if topics:
+        for topic in topics:
+            socket.setsockopt_string(zmq.SUBSCRIBE, topic)
+    else:
+        socket.setsockopt_string(zmq.SUBSCRIBE, "")
+    recorder = StreamRecorder(filename)
+    print("Recording messages from %s to %s; interrupt to stop." % (host, filename))
+    try:
+        while True:
+            message = socket.recv_multipart()
+            if len(message) != 2:
+                print("WARNING: message of length {} is {}".format(len(message), message))
+                continue
+            topic, contents = message
+            if topics and topic.decode() not in topics:
+                continue
+            recorder.write(topic, contents)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        recorder.close()
+        socket.close()
+
+
+def replay(filename, port=5501, speed=1.0, startupDelay=1.0):
+    """Publish the messages in a recording on tcp://*:port. Pause startupDelay seconds
+    first, so that subscribers have time to connect."""
+    context = zmq.Context()
+    socket = context.socket(zmq.PUB)
+    socket.bind("tcp://*:%d" % port)
+    time.sleep(startupDelay)
+    print("Replaying %s on port %d at %s" % (filename, port,
+                                             "full speed" if speed <= 0 else "%gx" % speed))
+    n = 0
+    tstart = time.time()
+    t0 = None
+    for t, topic, contents in readRecording(filename):
+        if t0 is None:
+            t0 = t
+        if speed > 0:
+            wait = tstart+(t-t0)/speed-time.time()
+            if wait > 0:
+                time.sleep(wait)
+        socket.send_multipart([topic, contents])
+        n += 1
+    elapsed = time.time()-tstart
+    print("Replayed %d messages in %.2f s" % (n, elapsed))
+    socket.close(linger=1000)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="command")
+    rec = sub.add_parser("record", help="record a Dastard ZMQ status stream")
+    rec.add_argument("--host", default="localhost:5501", help="host:port of the publisher")
+    rec.add_argument("filename")
+    rec.add_argument("topics", nargs="*", help="topics to record (default: all)")
+    rep = sub.add_parser("replay", help="publish a recorded stream")
+    rep.add_argument("--port", type=int, default=5501, help="port to publish on")
+    rep.add_argument("--speed", type=float, default=1.0,
+                     help="speed-up factor (0 means as fast as possible)")
+    rep.add_argument("filename")
+    args = parser.parse_args()
+
+    if args.command == "record":
+        record(args.host, args.filename, set(args.topics))
+    elif args.command == "replay":
+        replay(args.filename, args.port, args.speed)
+    else:
+        parser.print_help()
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,19 +1,119 @@
-import json
 import itertools
+import re
 import socket
+import threading
+import time
+import concurrent.futures
+from collections import OrderedDict
 
-from PyQt5 import QtWidgets
+from PyQt5 import QtCore, QtWidgets
+
+from . import diagnostics
+from .codec import getCodec
+
+
+class JSONStreamReader(object):
+    """Split a byte stream into complete JSON values, one at a time.
+
+    Bytes read from the socket go into a receive buffer that is reused for the
+    life of the connection. The end of each top-level JSON value is found by an
+    incremental scan that tracks nesting depth and string state, so every byte
+    is examined once no matter how many reads a large response needs."""
+
+    # The only bytes that can change the scanner state.
+    _structural = re.compile(rb'[{}\[\]"\\]')
+
+    def __init__(self, sock, codec=None, chunksize=65536):
+        self._socket = sock
+        if codec is None:
+            codec = getCodec()
+        self._codec = codec
+        self._chunk = bytearray(chunksize)
+        self._buffer = bytearray()
+        self.lastSize = 0  # size in bytes of the value most recently read
+        self._reset()
+
+    def _reset(self):
+        self._scanned = 0  # bytes of self._buffer already scanned
+        self._start = -1   # offset of the current value's opening bracket
+        self._depth = 0
+        self._inString = False
+
+    def _scan(self):
+        """Continue scanning the buffer. Return the end offset of a complete
+        top-level value, or -1 if more bytes are needed."""
+        buf = self._buffer
+        pos = self._scanned
+        if self._start < 0:
+            # Skip whitespace (e.g. the newline between responses) before a value.
+            while pos < len(buf) and buf[pos] in b" \t\r\n":
+                pos += 1
+            if pos < len(buf):
+                if buf[pos] not in b"{[":
+                    raise ValueError("JSON-RPC stream does not start with an object: %r" %
+                                     bytes(buf[pos:pos+40]))
+                self._start = pos
+        while True:
+            m = self._structural.search(buf, pos)
+            if m is None:
+                self._scanned = len(buf)
+                return -1
+            c = buf[m.start()]
+            pos = m.end()
+            if self._inString:
+                if c == ord('\\'):
+                    if pos >= len(buf):
+                        # Escaped character hasn't arrived yet; rescan the backslash.
+                        self._scanned = m.start()
+                        return -1
+                    pos += 1
+                elif c == ord('"'):
+                    self._inString = False
+            elif c == ord('"'):
+                self._inString = True
+            elif c in b"{[":
+                self._depth += 1
+            elif c in b"}]":
+                self._depth -= 1
+                if self._depth == 0:
+                    self._scanned = pos
+                    return pos
+
+    def read(self):
+        """Return the next complete JSON value from the socket, decoded.
+        Raises ValueError if the connection is closed before a value is complete."""
+        end = self._scan()
+        while end < 0:
+            nbytes = self._socket.recv_into(self._chunk)
+            if nbytes == 0:
+                raise ValueError("JSON-RPC connection closed by server")
+            self._buffer += memoryview(self._chunk)[:nbytes]
+            end = self._scan()
+        start = self._start
+        self.lastSize = end-start
+        data = bytes(self._buffer[start:end])
+        del self._buffer[:end]
+        self._reset()
+        return self._codec.decode(data)
 
 
 class JSONClient(object):
 
-    def __init__(self, addr, codec=json, qtParent=None):
+    MAX_WRITE = 1 << 20  # bytes per socket write when pipelining calls
+
+    def __init__(self, addr, codec=None, qtParent=None, stats=None):
         self._socket = socket.create_connection(addr)
         self._socket.settimeout(7.0)
+        if codec is None:
+            codec = getCodec()
+        self._reader = JSONStreamReader(self._socket, codec)
         self._id_iter = itertools.count()
         self._codec = codec
         self._closed = False
         self.qtParent = qtParent
+        if stats is None:
+            stats = diagnostics.RPCStats()
+        self.stats = stats
 
     def setQtParent(self, qtParent):
         """ let this know about Qt so it can pop-up error messages"""
@@ -25,54 +125,311 @@ class JSONClient(object):
                     method=name)
 
     def call(self, name, params, verbose=True, errorBox=True, throwError=False):
+        results = self.call_many([(name, params)], verbose=verbose, errorBox=errorBox,
+                                 throwError=throwError)
+        if results is None:
+            return None
+        return results[0]
+
+    def call_many(self, calls, verbose=True, errorBox=True, throwError=False):
+        """Pipeline several calls: send all requests back-to-back, then collect the replies.
+
+        calls is a sequence of (name, params) pairs. Replies are matched to requests
+        by id, so the server may answer them in any order. Returns a list of
+        (result, error) pairs in the same order as calls, or None if the client is
+        closed or the server has gone away. All errors are reported together in a
+        single error box."""
+        exchanged = self.exchange(calls, verbose=verbose)
+        if exchanged is None:
+            return None
+        requests, results = exchanged
+        reportErrors(self.qtParent, requests, results, verbose=verbose, errorBox=errorBox,
+                     throwError=throwError)
+        return results
+
+    def exchange(self, calls, verbose=True):
+        """Send the requests for calls and wait for all the replies, without reporting errors.
+        Returns (requests, results) as two lists in the order of calls, or None if the client
+        is closed or the server has gone away."""
         if self._closed:
-            print("%s(...) ignored because JSON-RPC client is closed." % name)
+            names = ", ".join(sorted(set(name for name, _ in calls)))
+            print("%s(...) ignored because JSON-RPC client is closed." % names)
             return None
             # This might seem like it should be impossible to reach, but it is possible
             # because signals like editingFinished can trigger slots when you try
             # to close a window while editing a QLineEdit (see issue #22).
             # If you skip this test, you get a segfault; this will be graceful.
-        if verbose:
-            print("SEND {} {}".format(name, json.dumps(params)))
-        request = self._message(name, params)
-        reqid = request.get('id')
-        msg = self._codec.dumps(request)
-        self._socket.sendall(msg.encode())
-
-        # This will actually have to loop if resp is bigger than 4096 bytes
-        response = self._socket.recv(4096)
+        requests = OrderedDict()
+        sent = {}  # id -> (bytes sent, encode time, time of send)
+        unsent = []
+        pending = bytearray()
         try:
-            response = self._codec.loads(response.decode())
-        except ValueError:  # This means RPC server is gone
-            print("RPC server is missing.")
-            self.qtParent.reconnect = True
-            self.close()
-            return None
+            for name, params in calls:
+                tstart = time.perf_counter()
+                request = self._message(name, params)
+                encoded = self._codec.encode(request)
+                encodeTime = time.perf_counter()-tstart
+                if verbose:
+                    print("SEND {} {}".format(name, encoded.decode()))
+                requests[request["id"]] = request
+                pending += encoded
+                pending += b"\n"
+                unsent.append((request["id"], len(encoded)+1, encodeTime))
+                # Flush in pieces so that the socket timeout limits each write, not
+                # the whole batch (a batch of projectors can be 100s of MB).
+                if len(pending) >= self.MAX_WRITE:
+                    self._flush(pending, unsent, sent)
+            if len(pending) > 0:
+                self._flush(pending, unsent, sent)
+        except OSError:
+            return self._serverMissing()
+
+        responses = {}
+        while len(responses) < len(requests):
+            try:
+                response = self._reader.read()
+            except (ValueError, OSError):  # This means RPC server is gone
+                return self._serverMissing()
+            respid = response.get('id')
+            if respid not in requests or respid in responses:
+                raise ValueError("JSON-RPC expected id in %s, received id=%s: %s" %
+                                 (list(requests.keys()), respid, response.get('error')))
+            responses[respid] = response
+            nbytes, encodeTime, tsent = sent[respid]
+            self.stats.record(requests[respid]["method"], nbytes, self._reader.lastSize,
+                              encodeTime, time.perf_counter()-tsent, response.get("error"))
 
-        if response.get('id') != reqid:
-            raise ValueError("JSON-RPC expected id=%s, received id=%s: %s" %
-                             (reqid, response.get('id'),
-                              response.get('error')))
-
-        if response.get('error') is not None:
-            message = "Request: {}\n\nError: {}".format(request, response.get('error'))
-            if verbose:
-                print(message)
-            if errorBox and self.qtParent is not None:
-                resultBox = QtWidgets.QMessageBox(self.qtParent)
-                resultBox.setText("DASTARD RPC Error\n"+message)
-                resultBox.setWindowTitle("DASTARD RPC Error")
-                # The above line doesn't work on mac, from qt docs "On macOS, the window
-                # title is ignored (as required by the macOS Guidelines)."
-                resultBox.show()
-            elif throwError:
-                raise Exception(message)
-            else:
-                print("PANIC unhandled response.get(error)")
-        return response.get('result'), response.get("error")
+        results = [(responses[reqid].get('result'), responses[reqid].get("error"))
+                   for reqid in requests]
+        return list(requests.values()), results
+
+    def _flush(self, pending, unsent, sent):
+        """Send the pending bytes and note the send time of the requests they hold."""
+        self._socket.sendall(pending)
+        tsent = time.perf_counter()
+        for reqid, nbytes, encodeTime in unsent:
+            sent[reqid] = (nbytes, encodeTime, tsent)
+        pending.clear()
+        unsent.clear()
+
+    def _serverMissing(self):
+        print("RPC server is missing.")
+        if self.qtParent is not None:
+            self.qtParent.reconnect = True
+        self.close()
+        return None
 
     def close(self):
         if not self._closed:
             self._closed = True
             self._socket.close()
-            self.qtParent.close()
+            if self.qtParent is not None:
+                self.qtParent.close()
+
+
+def reportErrors(qtParent, requests, results, verbose=True, errorBox=True, throwError=False):
+    """Report any errors among the (result, error) pairs in results, which correspond one
+    for one to requests. All errors go into a single message."""
+    messages = []
+    for request, (_, error) in zip(requests, results):
+        if error is not None:
+            messages.append("Request: {}\n\nError: {}".format(request, error))
+    if len(messages) == 0:
+        return
+
+    message = "\n\n".join(messages)
+    if verbose:
+        print(message)
+    if errorBox and qtParent is not None:
+        resultBox = QtWidgets.QMessageBox(qtParent)
+        resultBox.setText("DASTARD RPC Error\n"+message)
+        resultBox.setWindowTitle("DASTARD RPC Error")
+        # The above line doesn't work on mac, from qt docs "On macOS, the window
+        # title is ignored (as required by the macOS Guidelines)."
+        resultBox.show()
+    elif throwError:
+        raise Exception(message)
+    else:
+        print("PANIC unhandled response.get(error)")
+
+
+class RPCWorker(QtCore.QObject):
+    """Owns a JSONClient and makes its calls on whatever QThread this object lives in."""
+
+    finished = QtCore.pyqtSignal(int, object, object)  # ticket, requests, results
+
+    def __init__(self, client):
+        QtCore.QObject.__init__(self)
+        self.client = client
+
+    def _exchange(self, calls, verbose):
+        try:
+            return self.client.exchange(calls, verbose=verbose)
+        except Exception as e:
+            # E.g. a reply out of step with the requests, or params the codec can't
+            # encode. Treat the connection as lost rather than leave the caller
+            # unanswered (or let the exception escape a slot).
+            print("JSON-RPC call failed: %r" % e)
+            self.client.close()
+            return None
+
+    @QtCore.pyqtSlot(int, object, bool)
+    def run(self, ticket, calls, verbose):
+        exchanged = self._exchange(calls, verbose)
+        if exchanged is None:
+            self.finished.emit(ticket, None, None)
+        else:
+            self.finished.emit(ticket, *exchanged)
+
+    @QtCore.pyqtSlot(object)
+    def runWaiting(self, waiter):
+        """Make waiter's calls and wake the thread waiting for them."""
+        try:
+            waiter.exchanged = self._exchange(waiter.calls, waiter.verbose)
+        finally:
+            waiter.done.set()
+
+    @QtCore.pyqtSlot()
+    def stop(self):
+        QtCore.QThread.currentThread().quit()
+
+
+class _Waiter(object):
+    """Calls made through AsyncJSONClient.wait_many, and their results once made."""
+
+    def __init__(self, calls, verbose):
+        self.calls = calls
+        self.verbose = verbose
+        self.exchanged = None
+        self.done = threading.Event()
+
+
+class AsyncJSONClient(QtCore.QObject):
+    """A JSON-RPC client that never blocks the Qt GUI thread.
+
+    Calls are queued to an RPCWorker running on its own QThread, which takes over the
+    given JSONClient's connection to Dastard and handles them in order. call and
+    call_many return a concurrent.futures.Future right away. When the replies arrive,
+    any errors are reported (in the GUI thread) as JSONClient would, the future is
+    completed, and the optional callback is called with the same value that JSONClient
+    would have returned. If the server goes away, serverMissing is emitted and futures
+    resolve to None.
+
+    Calls whose results are needed at once go through wait_many (or a SyncJSONClient),
+    which queues them behind the calls already made and waits for the replies. So all
+    of the GUI's calls reach Dastard over one connection, in the order they were made."""
+
+    _request = QtCore.pyqtSignal(int, object, bool)
+    _wait = QtCore.pyqtSignal(object)
+    _stop = QtCore.pyqtSignal()
+    serverMissing = QtCore.pyqtSignal()
+
+    def __init__(self, client, qtParent=None):
+        QtCore.QObject.__init__(self)
+        self.qtParent = qtParent
+        self._tickets = itertools.count()
+        self._pending = {}
+        self._closed = False
+        client.setQtParent(None)  # The worker's thread mustn't touch widgets.
+        self.worker = RPCWorker(client)
+        self.stats = client.stats
+        self.thread = QtCore.QThread()
+        self.worker.moveToThread(self.thread)
+        self._request.connect(self.worker.run)
+        self._wait.connect(self.worker.runWaiting)
+        self._stop.connect(self.worker.stop)
+        self.worker.finished.connect(self._finished)
+        self.thread.start()
+
+    def setQtParent(self, qtParent):
+        """ let this know about Qt so it can pop-up error messages"""
+        self.qtParent = qtParent
+
+    def call(self, name, params, verbose=True, errorBox=True, throwError=False, callback=None):
+        return self._submit([(name, params)], True, verbose, errorBox, callback)
+
+    def call_many(self, calls, verbose=True, errorBox=True, throwError=False, callback=None):
+        return self._submit(list(calls), False, verbose, errorBox, callback)
+
+    def wait_many(self, calls, verbose=True, errorBox=True, throwError=False):
+        """Make calls after those already queued, and wait for the replies. Return what
+        JSONClient.call_many would."""
+        calls = list(calls)
+        if self._closed:
+            names = ", ".join(sorted(set(name for name, _ in calls)))
+            print("%s(...) ignored because JSON-RPC client is closed." % names)
+            return None
+        waiter = _Waiter(calls, verbose)
+        self._wait.emit(waiter)
+        waiter.done.wait()
+        if waiter.exchanged is None:
+            if not self._closed:
+                self.serverMissing.emit()
+            return None
+        requests, results = waiter.exchanged
+        reportErrors(self.qtParent, requests, results, verbose=verbose, errorBox=errorBox,
+                     throwError=throwError)
+        return results
+
+    def _submit(self, calls, single, verbose, errorBox, callback):
+        future = concurrent.futures.Future()
+        if self._closed:
+            names = ", ".join(sorted(set(name for name, _ in calls)))
+            print("%s(...) ignored because JSON-RPC client is closed." % names)
+            future.set_result(None)
+            return future
+        ticket = next(self._tickets)
+        self._pending[ticket] = (future, single, errorBox, callback)
+        self._request.emit(ticket, calls, verbose)
+        return future
+
+    @QtCore.pyqtSlot(int, object, object)
+    def _finished(self, ticket, requests, results):
+        future, single, errorBox, callback = self._pending.pop(ticket)
+        if results is None:
+            value = None
+            if not self._closed:
+                self.serverMissing.emit()
+        else:
+            # throwError makes no sense here: there is no caller on the stack to catch it.
+            reportErrors(self.qtParent, requests, results, errorBox=errorBox)
+            value = results[0] if single else results
+        future.set_result(value)
+        if callback is not None:
+            callback(value)
+
+    def close(self):
+        """Stop the worker thread (after the calls already made) and close its connection."""
+        if self._closed:
+            return
+        self._closed = True
+        # Quit from the worker's thread, so the requests queued before are run first.
+        self._stop.emit()
+        self.thread.wait()
+        self.worker.client.close()
+
+
+class SyncJSONClient(object):
+    """JSONClient's blocking call and call_many, made through an AsyncJSONClient so that
+    they keep their order with its other calls. See AsyncJSONClient.wait_many."""
+
+    def __init__(self, asyncClient):
+        self.asyncClient = asyncClient
+        self.stats = asyncClient.stats
+
+    def setQtParent(self, qtParent):
+        self.asyncClient.setQtParent(qtParent)
+
+    def call(self, name, params, verbose=True, errorBox=True, throwError=False):
+        results = self.call_many([(name, params)], verbose=verbose, errorBox=errorBox,
+                                 throwError=throwError)
+        if results is None:
+            return None
+        return results[0]
+
+    def call_many(self, calls, verbose=True, errorBox=True, throwError=False):
+        return self.asyncClient.wait_many(calls, verbose=verbose, errorBox=errorBox,
+                                          throwError=throwError)
+
+    def close(self):
+        self.asyncClient.close()
@@ -0,0 +1,566 @@
+#!/usr/bin/env python3
+
+"""
+A stand-in for Dastard, for testing and load-testing Dastard Commander without hardware.
+
+usage:
+
+python -m dastardcommander.simulator [--port 5500] [--nchan N] [--rate R] ...
+
+The simulator answers the JSON-RPC methods that Dastard Commander calls (on port) and
+publishes the status messages that it listens for (on port+1). Data sources are not
+really run: starting one publishes STATUS, CHANNELNAMES and TRIGGER for nchan
+channels (Triangle and SimPulse sources use the Nchan of their configuration), and
+while it "runs" TRIGGERRATE, NUMBERWRITTEN (when writing) and ALIVE are published
+with Poisson-distributed counts at the requested rates.
+
+For testing error handling, every reply can be delayed (--latency), and calls can
+fail at random (--error-rate) or always (--fail METHOD). These can also be changed
+while running, with the extra RPC method Simulator.Configure, e.g.
+client.call("Simulator.Configure", {"Latency": 0.5, "ErrorRate": 0.1}).
+"""
+
+import argparse
+import json
+import os
+import queue
+import random
+import re
+import socketserver
+import threading
+import time
+
+import numpy as np
+import zmq
+
+from .codec import getCodec
+from .rpc_client import JSONStreamReader
+
+SOURCE_NAMES = {
+    "TRIANGLESOURCE": "Triangles",
+    "SIMPULSESOURCE": "SimPulses",
+    "LANCEROSOURCE": "Lancero",
+    "ROACHSOURCE": "Roach",
+    "ABACOSOURCE": "Abaco",
+}
+
+
+def defaultTriggerState(channelIndices):
+    """Return a trigger state (as in a TRIGGER message) with all triggers off."""
+    return {
+        "ChannelIndices": list(channelIndices),
+        "AutoTrigger": False, "AutoDelay": 0, "AutoVetoRange": 0,
+        "LevelTrigger": False, "LevelRising": False, "LevelLevel": 0,
+        "EdgeTrigger": False, "EdgeRising": False, "EdgeFalling": False,
+        "EdgeLevel": 0, "EdgeMulti": False,
+        "EdgeMultiNoise": False, "EdgeMultiMakeShortRecords": False,
+        "EdgeMultiMakeContaminatedRecords": False, "EdgeMultiDisableZeroThreshold": False,
+        "EdgeMultiLevel": 0, "EdgeMultiVerifyNMonotone": 0,
+    }
+
+
+# The name of an RPC method, "Service.Method"; it's run by the method Service_Method.
+RPC_METHOD = re.compile(r"[A-Z][A-Za-z0-9]*\.[A-Z][A-Za-z0-9]*")
+
+
+class SimulatorError(Exception):
+    """An error to be returned to the client as the error of its RPC call."""
+    pass
+
+
+class Simulator(object):
+    """The state of a simulated Dastard, and the RPC methods that change it.
+
+    RPC methods are the methods named like "SourceControl_Start" (for
+    SourceControl.Start). Each takes the single parameter of the call and returns
+    its result or raises SimulatorError. Messages to publish go into self.outbox,
+    which the publisher thread sends."""
+
+    def __init__(self, nchan=64, nrows=32, rate=10.0, ratePeriod=1.0, alivePeriod=2.0,
+                 statusPeriod=0.0, latency=0.0, errorRate=0.0, failMethods=(),
+                 seed=None, codec=None):
+        self.nchan = nchan
+        self.nrows = nrows
+        self.rate = rate
+        self.ratePeriod = ratePeriod
+        self.alivePeriod = alivePeriod
+        self.statusPeriod = statusPeriod
+        self.latency = latency
+        self.errorRate = errorRate
+        self.failMethods = set(failMethods)
+        self.rng = np.random.default_rng(seed)
+        self.random = random.Random(seed)
+        self.lock = threading.RLock()
+        if codec is None:
+            codec = getCodec()
+        self.codec = codec
+        self.outbox = queue.Queue()
+        self.ncalls = 0
+
+        self.running = False
+        self.sourceName = ""
+        self.nsamples = 1024
+        self.npresamp = 256
+        self.samplePeriod = 8000
+        self.triangle = {"Nchan": 4, "SampleRate": 10000, "Min": 100, "Max": 10000}
+        self.simPulse = {"Nchan": 4, "SampleRate": 10000, "Pedestal": 3000.0,
+                         "Amplitudes": [10000.0, 8000.0, 6000.0], "Nsamp": 16000}
+        self.lancero = {"FiberMask": 0xffff, "ClockMHz": 125, "CardDelay": [1], "Nsamp": 4,
+                        "FirstRow": 1, "ChanSepCards": 0, "ChanSepColumns": 0,
+                        "ActiveCards": [0], "AvailableCards": [0]}
+        self.roach = {"HostPort": ["localhost:60001"], "Rates": [10000.0]}
+        self.abaco = {"ActiveCards": [0], "AvailableCards": [0], "Unwrapping": True,
+                      "UnwrapResetSamp": 20000}
+        self.coupling = 1
+        self.comment = ""
+        self.experimentStateLabel = ""
+        self.mapFile = ""
+        self.tesMap = None
+        self.writing = {"Active": False, "Paused": False, "BasePath": "",
+                        "FilenamePattern": "", "ExperimentStateFilename": ""}
+        self.setChannels(0, [])
+        self.dataMB = 0.0
+
+    def setChannels(self, nchannels, names):
+        self.nchannels = nchannels
+        self.channelNames = names
+        self.triggerStates = [defaultTriggerState([i]) for i in range(nchannels)]
+        self.mixFractions = [0.0]*nchannels
+        self.numberWritten = np.zeros(nchannels, dtype=int)
+        # Per-channel mean counts per second, varied so the count-rate map has contrast.
+        self.meanRates = self.rate*self.rng.uniform(0.5, 1.5, nchannels)
+
+    def publish(self, topic, message):
+        """Queue a message for the publisher thread. It is encoded now, so later
+        changes to the state can't alter it."""
+        self.outbox.put((topic.encode(), self.codec.encode(message)))
+
+    # Messages
+
+    def statusMessage(self):
+        if self.running:
+            # A TDM source has an error and a feedback channel per row.
+            n = self.nchannels//2 if self.isTDM() else self.nchannels
+            nrow = max(1, min(self.nrows, n))
+            groups = [{"Firstchan": first, "Nchan": min(nrow, n-first)}
+                      for first in range(0, n, nrow)]
+        else:
+            groups = []
+        return {"Running": self.running, "SourceName": self.sourceName,
+                "Nchannels": self.nchannels, "Nsamples": self.nsamples,
+                "Npresamp": self.npresamp, "SamplePeriod": self.samplePeriod,
+                "ChanGroups": groups}
+
+    def triggerMessage(self):
+        """Group the channels' trigger states into one state per distinct setting."""
+        groups = {}
+        for i, state in enumerate(self.triggerStates):
+            key = json.dumps({k: v for k, v in state.items() if k != "ChannelIndices"},
+                             sort_keys=True)
+            groups.setdefault(key, []).append(i)
+        message = []
+        for key, indices in groups.items():
+            state = json.loads(key)
+            state["ChannelIndices"] = indices
+            message.append(state)
+        return message
+
+    def publishAll(self):
+        """Publish every status message, as Dastard does for SendAllStatus."""
+        self.publish("STATUS", self.statusMessage())
+        self.publish("TRIANGLE", self.triangle)
+        self.publish("SIMPULSE", self.simPulse)
+        self.publish("LANCERO", {"FiberMask": self.lancero["FiberMask"],
+                                 "DastardOutput": self.lancero})
+        self.publish("ROACH", self.roach)
+        self.publish("ABACO", self.abaco)
+        self.publish("WRITING", self.writing)
+        self.publish("TRIGCOUPLING", self.coupling)
+        self.publish("MIX", self.mixFractions)
+        if self.running:
+            self.publish("CHANNELNAMES", self.channelNames)
+            self.publish("TRIGGER", self.triggerMessage())
+        if self.tesMap is not None:
+            self.publish("TESMAP", self.tesMap)
+            self.publish("TESMAPFILE", self.mapFile)
+
+    def tick(self, elapsed):
+        """Publish the messages of a running source for the last elapsed seconds."""
+        with self.lock:
+            if not self.running:
+                return
+            counts = self.rng.poisson(self.meanRates*elapsed)
+            self.dataMB += 2e-6*self.nchannels*elapsed*1e9/self.samplePeriod
+            self.publish("TRIGGERRATE", {"CountsSeen": counts.tolist(),
+                                         "Duration": int(elapsed*1e9)})
+            if self.writing["Active"] and not self.writing["Paused"]:
+                self.numberWritten += counts
+                self.publish("NUMBERWRITTEN", {"NumberWritten": self.numberWritten.tolist()})
+
+    def alive(self, elapsed):
+        with self.lock:
+            mb = self.dataMB
+            self.dataMB = 0.0
+            self.publish("ALIVE", {"Alive": True, "Running": self.running, "DataMB": mb,
+                                   "HWactualMB": mb, "Time": elapsed})
+
+    def isTDM(self):
+        return self.sourceName == "Lancero"
+
+    def requireRunning(self):
+        if not self.running:
+            raise SimulatorError("No source is active")
+
+    def checkIndices(self, indices):
+        for i in indices:
+            if i < 0 or i >= self.nchannels:
+                raise SimulatorError("channel index %d is out of range [0,%d)" %
+                                     (i, self.nchannels))
+
+    # RPC methods
+
+    def call(self, method, param):
+        """Run the RPC method named like "SourceControl.Start", with error injection."""
+        with self.lock:
+            self.ncalls += 1
+            latency = self.latency
+            fail = (method in self.failMethods or
+                    (self.errorRate > 0 and self.random.random() < self.errorRate))
+        if latency > 0:
+            time.sleep(latency)
+        if fail:
+            raise SimulatorError("simulated failure of %s" % method)
+        # Only names like Go's exported "Service.Method" are RPC methods, so that the
+        # simulator's own methods (call, tick, ...) can't be called.
+        func = None
+        if RPC_METHOD.fullmatch(method):
+            func = getattr(self, method.replace(".", "_"), None)
+        if func is None:
+            raise SimulatorError("rpc: can't find method %s" % method)
+        with self.lock:
+            return func(param)
+
+    def Simulator_Configure(self, config):
+        """Change the error injection: any of Latency (s), ErrorRate (0 to 1),
+        FailMethods (list of method names), Rate (mean counts/s per channel)."""
+        self.latency = config.get("Latency", self.latency)
+        self.errorRate = config.get("ErrorRate", self.errorRate)
+        self.failMethods = set(config.get("FailMethods", self.failMethods))
+        if "Rate" in config:
+            self.rate = config["Rate"]
+            self.meanRates = self.rate*self.rng.uniform(0.5, 1.5, self.nchannels)
+        return True
+
+    def SourceControl_SendAllStatus(self, _):
+        self.publishAll()
+        return True
+
+    def SourceControl_ConfigureTriangleSource(self, config):
+        self.triangle.update(config)
+        self.publish("TRIANGLE", self.triangle)
+        return True
+
+    def SourceControl_ConfigureSimPulseSource(self, config):
+        self.simPulse.update(config)
+        self.publish("SIMPULSE", self.simPulse)
+        return True
+
+    def SourceControl_ConfigureLanceroSource(self, config):
+        available = self.lancero["AvailableCards"]
+        self.lancero.update(config)
+        self.lancero["AvailableCards"] = available
+        self.publish("LANCERO", {"FiberMask": self.lancero["FiberMask"],
+                                 "DastardOutput": self.lancero})
+        return True
+
+    def SourceControl_ConfigureRoachSource(self, config):
+        self.roach.update(config)
+        self.publish("ROACH", self.roach)
+        return True
+
+    def SourceControl_ConfigureAbacoSource(self, config):
+        available = self.abaco["AvailableCards"]
+        self.abaco.update(config)
+        self.abaco["AvailableCards"] = available
+        self.publish("ABACO", self.abaco)
+        return True
+
+    def SourceControl_Start(self, source):
+        if self.running:
+            raise SimulatorError("already running source %s" % self.sourceName)
+        if source not in SOURCE_NAMES:
+            raise SimulatorError("data source '%s' not recognized" % source)
+        self.sourceName = SOURCE_NAMES[source]
+        if source == "TRIANGLESOURCE":
+            n = self.triangle["Nchan"]
+        elif source == "SIMPULSESOURCE":
+            n = self.simPulse["Nchan"]
+        else:
+            n = self.nchan
+        if self.isTDM():
+            names = ["%s%d" % (p, i) for i in range(1, n+1) for p in ("err", "chan")]
+        else:
+            names = ["chan%d" % i for i in range(1, n+1)]
+        self.setChannels(len(names), names)
+        self.running = True
+        self.coupling = 1
+        self.publish("STATUS", self.statusMessage())
+        self.publish("CHANNELNAMES", self.channelNames)
+        self.publish("TRIGGER", self.triggerMessage())
+        self.publish("TRIGCOUPLING", self.coupling)
+        self.publish("MIX", self.mixFractions)
+        return True
+
+    def SourceControl_Stop(self, _):
+        self.requireRunning()
+        if self.writing["Active"]:
+            self.SourceControl_WriteControl({"Request": "Stop"})
+        self.running = False
+        self.publish("STATUS", self.statusMessage())
+        return True
+
+    def SourceControl_ConfigurePulseLengths(self, config):
+        self.requireRunning()
+        nsamp, npre = config["Nsamp"], config["Npre"]
+        if npre < 3 or nsamp < npre+3:
+            raise SimulatorError("need 3 <= Npre <= Nsamp-3, have Nsamp=%d, Npre=%d" %
+                                 (nsamp, npre))
+        if self.writing["Active"]:
+            raise SimulatorError("cannot change pulse lengths while writing")
+        self.nsamples, self.npresamp = nsamp, npre
+        self.publish("STATUS", self.statusMessage())
+        return True
+
+    def SourceControl_ConfigureTriggers(self, state):
+        self.requireRunning()
+        indices = state.get("ChannelIndices") or []
+        self.checkIndices(indices)
+        template = defaultTriggerState([])
+        template.update(state)
+        for i in indices:
+            s = dict(template)
+            s["ChannelIndices"] = [i]
+            self.triggerStates[i] = s
+        self.publish("TRIGGER", self.triggerMessage())
+        return True
+
+    def SourceControl_ConfigureProjectorsBasis(self, config):
+        self.requireRunning()
+        self.checkIndices([config["ChannelIndex"]])
+        for key in ("ProjectorsBase64", "BasisBase64"):
+            if len(config.get(key, "")) == 0:
+                raise SimulatorError("%s is empty" % key)
+        return True
+
+    def SourceControl_ConfigureMixFraction(self, config):
+        self.requireRunning()
+        indices = config["ChannelIndices"]
+        fractions = config["MixFractions"]
+        if len(indices) != len(fractions):
+            raise SimulatorError("%d ChannelIndices but %d MixFractions" %
+                                 (len(indices), len(fractions)))
+        self.checkIndices(indices)
+        for i, f in zip(indices, fractions):
+            if self.isTDM() and i % 2 == 0:
+                raise SimulatorError("channel %d is an error channel; cannot mix" % i)
+            self.mixFractions[i] = f
+        self.publish("MIX", self.mixFractions)
+        return True
+
+    def _setCoupling(self, value, on):
+        self.requireRunning()
+        if not self.isTDM():
+            raise SimulatorError("trigger coupling needs a TDM (Lancero) source")
+        if on:
+            self.coupling = value
+        elif self.coupling == value:
+            self.coupling = 1
+        self.publish("TRIGCOUPLING", self.coupling)
+        return True
+
+    def SourceControl_CoupleFBToErr(self, on):
+        return self._setCoupling(2, on)
+
+    def SourceControl_CoupleErrToFB(self, on):
+        return self._setCoupling(3, on)
+
+    def SourceControl_WriteControl(self, config):
+        self.requireRunning()
+        request = config["Request"]
+        if request == "Start":
+            if self.writing["Active"]:
+                raise SimulatorError("already writing")
+            path = config.get("Path", "")
+            run = time.strftime("%Y%m%d")
+            self.writing.update({
+                "Active": True, "Paused": False, "BasePath": path,
+                "FilenamePattern": os.path.join(path, run, "0000", run+"_run0000_%s.%s"),
+                "ExperimentStateFilename": os.path.join(path, run, "0000",
+                                                        run+"_run0000_experiment_state.txt"),
+            })
+            self.numberWritten[:] = 0
+        elif request == "Stop":
+            self.writing.update({"Active": False, "Paused": False})
+        elif request in ("Pause", "Unpause"):
+            if not self.writing["Active"]:
+                raise SimulatorError("not writing")
+            self.writing["Paused"] = (request == "Pause")
+        else:
+            raise SimulatorError("WriteControl request '%s' not recognized" % request)
+        self.publish("WRITING", self.writing)
+        return True
+
+    def SourceControl_WriteComment(self, comment):
+        if not self.writing["Active"]:
+            raise SimulatorError("not writing, so cannot write a comment")
+        self.comment = comment
+        return True
+
+    def SourceControl_ReadComment(self, _):
+        if not self.writing["Active"]:
+            raise SimulatorError("not writing, so no comment to read")
+        return self.comment
+
+    def SourceControl_SetExperimentStateLabel(self, config):
+        if not self.writing["Active"]:
+            raise SimulatorError("not writing, so cannot set an experiment state label")
+        self.experimentStateLabel = config["Label"]
+        return True
+
+    def MapServer_Load(self, filename):
+        """Read a TES map: a first line holding the spacing, then lines of
+        "index x y [name]". Publish it as TESMAP and TESMAPFILE."""
+        try:
+            with open(filename) as fp:
+                lines = [line.split() for line in fp if line.strip()]
+            spacing = float(lines[0][-1])
+            pixels = []
+            for fields in lines[1:]:
+                name = fields[3] if len(fields) > 3 else ""
+                pixels.append({"X": float(fields[1]), "Y": float(fields[2]), "Name": name})
+        except (OSError, IndexError, ValueError) as e:
+            raise SimulatorError("could not load map file %s: %s" % (filename, e))
+        self.mapFile = filename
+        self.tesMap = {"Spacing": spacing, "Pixels": pixels}
+        self.publish("TESMAP", self.tesMap)
+        self.publish("TESMAPFILE", self.mapFile)
+        return True
+
+
+class RPCHandler(socketserver.StreamRequestHandler):
+    """Serve JSON-RPC 1.0 requests on one connection, as Go's net/rpc/jsonrpc does."""
+
+    def handle(self):
+        simulator = self.server.simulator
+        codec = self.server.codec
+        reader = JSONStreamReader(self.request, codec)
+        while True:
+            try:
+                request = reader.read()
+                method = request["method"]
+                params = request.get("params") or [None]
+            except (ValueError, KeyError, TypeError, OSError):
+                return  # Connection closed, or not JSON-RPC.
+            result, error = None, None
+            try:
+                result = simulator.call(method, params[0])
+            except SimulatorError as e:
+                error = str(e)
+            except (KeyError, TypeError, ValueError) as e:
+                error = "bad parameters for %s: %r" % (method, e)
+            reply = {"id": request.get("id"), "result": result, "error": error}
+            self.wfile.write(codec.encode(reply)+b"\n")
+
+
+class RPCServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+def publishLoop(simulator, socket, stop):
+    """Send the simulator's outbox on the PUB socket, and run its periodic messages,
+    until stop is set. The PUB socket belongs to this thread."""
+    now = time.time()
+    lastTick = lastAlive = lastStatus = now
+    while not stop.is_set():
+        try:
+            socket.send_multipart(simulator.outbox.get(timeout=0.01))
+            continue
+        except queue.Empty:
+            pass
+        now = time.time()
+        if now-lastTick >= simulator.ratePeriod:
+            simulator.tick(now-lastTick)
+            lastTick = now
+        if now-lastAlive >= simulator.alivePeriod:
+            simulator.alive(now-lastAlive)
+            lastAlive = now
+        if simulator.statusPeriod > 0 and now-lastStatus >= simulator.statusPeriod:
+            with simulator.lock:
+                simulator.publish("STATUS", simulator.statusMessage())
+            lastStatus = now
+
+
+def serve(simulator, host="localhost", port=5500):
+    """Run the simulator's RPC server on port and its publisher on port+1, until
+    interrupted."""
+    context = zmq.Context()
+    pub = context.socket(zmq.PUB)
+    pub.bind("tcp://%s:%d" % (host, port+1))
+    stop = threading.Event()
+    publisher = threading.Thread(target=publishLoop, args=(simulator, pub, stop))
+    publisher.start()
+
+    server = RPCServer((host, port), RPCHandler)
+    server.simulator = simulator
+    server.codec = simulator.codec
+    simulator.publish("NEWDASTARD", "new Dastard is alive")
+    print("Simulated Dastard serving JSON-RPC on %s:%d and publishing on %s:%d" %
+          (host, port, host, port+1))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        stop.set()
+        publisher.join()
+        pub.close(linger=0)
+        print("Simulator handled %d RPC calls" % simulator.ncalls)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="localhost", help="address to serve on")
+    parser.add_argument("--port", type=int, default=5500,
+                        help="JSON-RPC port (status messages are published on port+1)")
+    parser.add_argument("--nchan", type=int, default=64,
+                        help="channels (TDM: rows*columns) of Lancero, Roach and Abaco sources")
+    parser.add_argument("--nrows", type=int, default=32, help="channels per channel group")
+    parser.add_argument("--rate", type=float, default=10.0,
+                        help="mean triggers per second per channel")
+    parser.add_argument("--rate-period", type=float, default=1.0,
+                        help="seconds between TRIGGERRATE (and NUMBERWRITTEN) messages")
+    parser.add_argument("--alive-period", type=float, default=2.0,
+                        help="seconds between ALIVE messages")
+    parser.add_argument("--status-period", type=float, default=0.0,
+                        help="seconds between repeated STATUS messages (0: only on change)")
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="seconds to delay each RPC reply")
+    parser.add_argument("--error-rate", type=float, default=0.0,
+                        help="fraction of RPC calls that fail at random")
+    parser.add_argument("--fail", action="append", default=[], metavar="METHOD",
+                        help="RPC method that always fails (may be repeated)")
+    parser.add_argument("--seed", type=int, help="random seed")
+    args = parser.parse_args()
+
+    simulator = Simulator(nchan=args.nchan, nrows=args.nrows, rate=args.rate,
+                          ratePeriod=args.rate_period, alivePeriod=args.alive_period,
+                          statusPeriod=args.status_period, latency=args.latency,
+                          errorRate=args.error_rate, failMethods=args.fail, seed=args.seed)
+    serve(simulator, args.host, args.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,76 @@
 import zmq
 from PyQt5 import QtCore
 import collections
+import threading
+import time
+
+from .codec import getCodec
+from .diagnostics import TopicStats
+
+
+class LatestValues(object):
+    """Keep only the newest message per topic, until the GUI thread drains them.
+
+    The listener thread puts and the GUI thread drains, so the memory held is bounded
+    by the number of topics however long the GUI is busy. Messages replaced before
+    they were drained are counted in self.coalesced."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._latest = collections.OrderedDict()
+        self.coalesced = collections.Counter()
+
+    def put(self, topic, d, received):
+        with self._lock:
+            if topic in self._latest:
+                self.coalesced[topic] += 1
+            self._latest[topic] = (d, received)
+
+    def drain(self):
+        """Return and forget all stored (topic, message, time received) tuples."""
+        with self._lock:
+            items = [(topic, d, received) for topic, (d, received) in self._latest.items()]
+            self._latest.clear()
+        return items
+
+    def summary(self):
+        with self._lock:
+            counts = sorted(self.coalesced.items())
+        lines = ["%-40s %10s" % ("Topic", "coalesced")]
+        lines.extend("%-40s %10d" % tc for tc in counts)
+        return "\n".join(lines)
 
 
 class ZMQListener(QtCore.QObject):
-    """Code suggested by https://wiki.python.org/moin/PyQt/Writing%20a%20client%20for%20a%20zeromq%20service"""
+    """Code suggested by https://wiki.python.org/moin/PyQt/Writing%20a%20client%20for%20a%20zeromq%20service
+
+    The listener does the per-message work in its own thread: it decodes each message
+    and drops any that are identical to the previous message on the same topic, so
+    only decoded messages that need GUI work are emitted. Each time the socket has
+    messages waiting, all of them (up to maxBatch, or as many as it can process in
+    maxBatchTime seconds) are processed and emitted together as one batch.
+
+    Each consumer registers the topics it wants with subscribe(). The socket has a ZMQ
+    subscription for only the union of those topics, so Dastard doesn't even send the
+    others, and messages on topics that merely share a prefix with a wanted topic
+    (TRIGGERRATE vs TRIGGER) are dropped before decoding.
+
+    Messages on the high-rate CONFLATED topics are not emitted at all; instead they
+    go to self.latest, which the GUI drains on a timer. If the GUI stalls, it sees
+    the newest of these messages afterwards rather than a backlog. Any waiting there
+    when another message comes are emitted in the batch ahead of it, so that messages
+    are handled in the order they came."""
+
+    messages = QtCore.pyqtSignal(list)  # a batch of (topic, message, time received) tuples
 
-    message = QtCore.pyqtSignal(str, str)
+    # Topics emitted even when identical to the previous message on that topic.
+    ALWAYS_EMIT = frozenset(["ALIVE", "CURRENTTIME", "TRIGGERRATE"])
 
-    def __init__(self, host, port):
+    # Topics where only the latest message matters.
+    CONFLATED = frozenset(["TRIGGERRATE", "NUMBERWRITTEN", "EXTERNALTRIGGER", "DATADROP"])
+
+    def __init__(self, host, port, codec=None, pollTimeout=100, maxBatch=1000,
+                 maxBatchTime=0.05):
 
         QtCore.QObject.__init__(self)
 
@@ -22,35 +84,152 @@ class ZMQListener(QtCore.QObject):
         self.socket.connect(self.address)
         print("Collecting updates from dastard at %s" % self.address)
 
-        self.socket.setsockopt_string(zmq.SUBSCRIBE, u"")
+        # consumer -> set of topics it wants (None means all topics).
+        self._consumers = {}
+        self._consumersLock = threading.Lock()
+        self._consumersChanged = False
+        # Subscribe to all topics at once, so no message is missed while the listener
+        # thread starts; it narrows the subscriptions to the consumers' topics.
+        self.socket.setsockopt_string(zmq.SUBSCRIBE, "")
+        self._subscribed = set([""])  # topics (or "" for all) subscribed on the socket
+        self._wanted = None  # union of consumers' topics; None means all
+        self.recorder = None
+        self._recorderLock = threading.Lock()
 
-        self.messages_seen = collections.Counter()
+        if codec is None:
+            codec = getCodec()
+        self.codec = codec
+        self.stats = TopicStats()
+        self.last_messages = {}
+        self.latest = LatestValues()
+        self.pollTimeout = pollTimeout
+        self.maxBatch = maxBatch
+        self.maxBatchTime = maxBatchTime
         self.quit_once = False
         self.running = False
 
+    def subscribe(self, consumer, topics=None):
+        """Register (or replace) the topics wanted by consumer, which can be any hashable
+        key. topics=None means all topics. May be called from any thread; the socket's
+        subscriptions are updated by the listener thread."""
+        if topics is not None:
+            topics = frozenset(topics)
+        with self._consumersLock:
+            self._consumers[consumer] = topics
+            self._consumersChanged = True
+
+    def unsubscribe(self, consumer):
+        """Forget the topics wanted by consumer."""
+        with self._consumersLock:
+            self._consumers.pop(consumer, None)
+            self._consumersChanged = True
+
+    def startRecording(self, recorder):
+        """Tee every message received (on all topics, not only the subscribed ones)
+        to recorder, a recording.StreamRecorder, until stopRecording."""
+        with self._recorderLock:
+            self.recorder = recorder
+        with self._consumersLock:
+            self._consumersChanged = True
+
+    def stopRecording(self):
+        """Stop teeing messages to the recorder, and close it."""
+        with self._recorderLock:
+            recorder = self.recorder
+            self.recorder = None
+        with self._consumersLock:
+            self._consumersChanged = True
+        if recorder is not None:
+            recorder.close()
+
+    def _updateSubscriptions(self):
+        """Set the socket's ZMQ subscriptions to match the consumers' wishes. Must run in
+        the listener thread, as ZMQ sockets aren't thread safe."""
+        with self._consumersLock:
+            if not self._consumersChanged:
+                return
+            self._consumersChanged = False
+            wanted = set()
+            for topics in self._consumers.values():
+                if topics is None:
+                    wanted = None
+                    break
+                wanted.update(topics)
+        filters = set([""]) if (wanted is None or self.recorder is not None) else wanted
+        for f in filters - self._subscribed:
+            self.socket.setsockopt_string(zmq.SUBSCRIBE, f)
+        for f in self._subscribed - filters:
+            self.socket.setsockopt_string(zmq.UNSUBSCRIBE, f)
+        self._subscribed = filters
+        self._wanted = wanted
+        print("ZMQListener subscribed to: %s" % ("all topics" if wanted is None else sorted(wanted)))
+
     def loop(self):
         if self.quit_once:
             raise ValueError("Cannot run a ZMQListener.loop more than once!")
         self.running = True
         while self.running:
-            # Check socket for events, with 100 ms timeout (so this loop and
+            self._updateSubscriptions()
+            # Check socket for events, with pollTimeout ms timeout (so this loop and
             # its thread can end quickly when self.running set to False)
-            if self.socket.poll(100) == 0:
+            if self.socket.poll(self.pollTimeout) == 0:
                 continue
 
-            msg = self.socket.recv_multipart()
-            try:
-                topic, contents = msg
-            except (ValueError, TypeError):
-                raise Exception(f"msg: `{msg}` should have two parts, but does not")
-            topic = topic.decode()
-            contents = contents.decode()
-
-            if topic == "CURRENTTIME":
-                print("Current time: '%s'" % contents)
-            self.messages_seen[topic] += 1
-            self.message.emit(topic, contents)
+            # Drain everything already waiting (up to the batch limits) without
+            # blocking, and hand it to the GUI as a single signal.
+            batch = []
+            deadline = time.perf_counter()+self.maxBatchTime
+            for _ in range(self.maxBatch):
+                try:
+                    msg = self.socket.recv_multipart(zmq.NOBLOCK)
+                except zmq.Again:
+                    break
+                received = time.perf_counter()
+                self._process(msg, received, batch)
+                if received > deadline:
+                    break
+            if len(batch) > 0:
+                self.messages.emit(batch)
 
         self.socket.close()
         self.quit_once = True
         print("ZMQListener quit cleanly")
+
+    def _process(self, msg, received, batch):
+        """Decode one multipart message and either append it to batch as a
+        (topic, message, received) tuple, store it in self.latest, or drop it."""
+        try:
+            topic, contents = msg
+        except (ValueError, TypeError):
+            raise Exception(f"msg: `{msg}` should have two parts, but does not")
+        with self._recorderLock:
+            if self.recorder is not None:
+                self.recorder.write(topic, contents)
+        topic = topic.decode()
+        self.stats.received(topic, len(contents), received)
+        if self._wanted is not None and topic not in self._wanted:
+            return
+
+        if topic not in self.ALWAYS_EMIT:
+            if self.last_messages.get(topic) == contents:
+                return
+            self.last_messages[topic] = contents
+
+        try:
+            d = self.codec.decodeStatus(topic, contents)
+        except Exception as e:
+            print("Error processing status message [topic,msg]: '%s', '%s'" % (
+                topic, contents))
+            print("Error is: %s" % e)
+            return
+        self.stats.decoded(topic, time.perf_counter()-received)
+
+        if topic == "CURRENTTIME":
+            print("Current time: '%s'" % d)
+        if topic in self.CONFLATED:
+            self.latest.put(topic, d, received)
+        else:
+            # Conflated messages that came first go first, so that e.g. a TRIGGERRATE
+            # from before a change of channels isn't handled after the new CHANNELNAMES.
+            batch.extend(self.latest.drain())
+            batch.append((topic, d, received))
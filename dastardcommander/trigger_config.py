@@ -1,17 +1,29 @@
 # Qt5 imports
 import PyQt5.uic
-from PyQt5 import QtWidgets
+from PyQt5 import QtCore, QtWidgets
 from PyQt5.QtCore import pyqtSignal, pyqtSlot, Qt
 
 # other non qt imports
 import os
 
+import numpy as np
+
+from .channels import ChannelTable, formatNumbers, parseNumbers
+from .dispatch import STATUS_RECORD_LENGTH
+from .trigger_state import TriggerStateStore
+
+
 class TriggerConfig(QtWidgets.QWidget):
     """Provide the UI inside the Triggering tab.
 
     Most of the UI is copied from MATTER, but the Python implementation in this
     class is new."""
 
+    # Wait this long after the last change to the channel list text before parsing it.
+    channelTextDelay = 400  # ms
+    # Send trigger edits this long after the last one, so quick edits go as one batch.
+    editDelay = 300  # ms
+
     def __init__(self, parent, client):
         QtWidgets.QWidget.__init__(self, parent)
         self.client = client
@@ -20,10 +32,22 @@ class TriggerConfig(QtWidgets.QWidget):
         self.pretrigLengthSpinBox.editingFinished.connect(self.sendRecordLengthsToServer)
         self.pretrigPercentSpinBox.editingFinished.connect(self.sendRecordLengthsToServer)
         self.channelsChosenEdit.textChanged.connect(self.channelListTextChanged)
+        self.channelTextTimer = QtCore.QTimer(self)
+        self.channelTextTimer.setSingleShot(True)
+        self.channelTextTimer.setInterval(self.channelTextDelay)
+        self.channelTextTimer.timeout.connect(self.applyChannelText)
+        self.editTimer = QtCore.QTimer(self)
+        self.editTimer.setSingleShot(True)
+        self.editTimer.setInterval(self.editDelay)
+        self.editTimer.timeout.connect(self.sendTriggerStates)
+        self.pendingEdits = []  # (channels, name, value) set but not yet sent
+        self.editsInFlight = 0  # batches of edits sent but not yet answered
+        self.pendingEditsLabel.setVisible(False)
         self.auto1psModeButton.pressed.connect(self.go1psMode)
         self.noiseModeButton.pressed.connect(self.goNoiseMode)
         self.pulseModeButton.pressed.connect(self.goPulseMode)
-        self.trigger_state = {}
+        self.triggerStates = TriggerStateStore()
+        self.channels = ChannelTable()  # to be overwritten by dc.py
         self.chosenChannels = []
         self.editWidgets = [self.recordLengthSpinBox,
                             self.pretrigLengthSpinBox,
@@ -40,6 +64,7 @@ class TriggerConfig(QtWidgets.QWidget):
         being processed when the main window is closing."""
         for w in self.editWidgets:
             w.blockSignals(True)
+        self.flushTriggerEdits()
 
     def isTDM(self, tdm):
         combo = self.channelChooserBox
@@ -76,13 +101,23 @@ class TriggerConfig(QtWidgets.QWidget):
         self.levelTrigActive.setChecked(False)
         self.changedAllTrigConfig()
 
+    def topicHandlers(self):
+        """The handlers of ZMQ status messages, by topic."""
+        return {STATUS_RECORD_LENGTH: self.handleStatusMessage,
+                "TRIGGER": self.handleTriggerMessage,
+                "TRIGCOUPLING": self.handleTrigCoupling}
+
+    def handleStatusMessage(self, d):
+        self.updateRecordLengthsFromServer(d["Nsamples"], d["Npresamp"])
+
     def handleTriggerMessage(self, dicts):
         """Handle the trigger state message (in list-of-dicts form)"""
-        for d in dicts:
-            d["EdgeMulti"] = False  # ignore all EdgeMulti settings from the server
-            # so that we don't send them back... avoid EdgeMulti being stuck on
-            for channelIndex in d["ChannelIndices"]:
-                self.trigger_state[channelIndex] = d
+        # Ignore all EdgeMulti settings from the server so that we don't send them back...
+        # avoid EdgeMulti being stuck on. (Copy, as the message also goes to other tabs.)
+        self.triggerStates.update([dict(d, EdgeMulti=False) for d in dicts])
+        # Edits not yet sent still stand over what Dastard reports.
+        for channels, name, value in self.pendingEdits:
+            self.triggerStates.set(channels, name, value)
         self.updateTriggerGUIElements()
         self.changedTriggerStateSig.emit()
 
@@ -94,7 +129,7 @@ class TriggerConfig(QtWidgets.QWidget):
             return
         cctext = self.channelChooserBox.currentText()
         if cctext.startswith("All"):
-            allprefixes = [self.chanbyprefix(p) for p in self.channel_prefixes]
+            allprefixes = [self.chanbyprefix(p) for p in self.channels.prefixes]
             allprefixes.sort()
             result = "\n".join(allprefixes)
         elif cctext.startswith("user"):
@@ -107,116 +142,98 @@ class TriggerConfig(QtWidgets.QWidget):
                 prefix = "err"
             result = self.chanbyprefix(prefix)
         self.channelsChosenEdit.setPlainText(result)
+        self.flushChannelText()
         if idx != self.channelChooserBox.currentIndex():
             self.channelChooserBox.setCurrentIndex(idx)
 
     def chanbyprefix(self, prefix):
-        """Return a string listing all channels for the given prefix"""
-        cnum = ",".join([p.lstrip(prefix) for p in self.channel_names if p.startswith(prefix)])
-        return "%s:%s" % (prefix, cnum)
+        """Return a string listing all channels for the given prefix, like "chan:1-3999:2"."""
+        indices = self.channels.indicesWithPrefix(prefix)
+        return "%s:%s" % (prefix, formatNumbers(self.channels.number[indices]))
 
     @pyqtSlot()
     def channelListTextChanged(self):
-        """The channel selector text edit box changed."""
+        """The channel selector text edit box changed. Parse it once typing pauses."""
+        self.channelTextTimer.start()
+
+    @pyqtSlot()
+    def applyChannelText(self):
+        self.channelTextTimer.stop()
         self.parseChannelText()
         self.updateTriggerGUIElements()
 
+    def flushChannelText(self, updateGUI=True):
+        """Parse the channel selector text now, if a change to it is waiting to be parsed.
+        Unless updateGUI, leave the trigger widgets alone (as when they're being read)."""
+        if not self.channelTextTimer.isActive():
+            return
+        if updateGUI:
+            self.applyChannelText()
+        else:
+            self.channelTextTimer.stop()
+            self.parseChannelText()
+
     def parseChannelText(self):
         """Parse the text in the channel selector text edit box. Set the list
-        self.chosenChannels accordingly."""
-        self.chosenChannels = []
+        self.chosenChannels accordingly.
+
+        Each line is a prefix and a list of channel numbers, like "chan:1,4,10-20,21-99:2",
+        where "first-last:step" is a range including last (the step defaults to 1)."""
         chantext = self.channelsChosenEdit.toPlainText()
         print("Trying to update the channel information")
         chantext = chantext.replace("\t", "\n").replace(";", "\n").replace(" ", "")
         lines = chantext.split()
+        chosen = [np.zeros(0, dtype=int)]
         for line in lines:
             if ":" not in line:
                 continue
             prefix, cnums = line.split(":", 1)
-            if prefix not in self.channel_prefixes:
+            if prefix not in self.channels.prefixes:
                 print("Channel prefix %s not in known prefixes: %s" %
-                      (prefix, self.channel_prefixes))
+                      (prefix, self.channels.prefixes))
                 continue
-            for cnum in cnums.split(","):
-                # Ignore the "" that follows a trailing comma
-                if len(cnum) == 0:
-                    continue
-                name = prefix+cnum
-                try:
-                    idx = self.channel_names.index(name)
-                    self.chosenChannels.append(idx)
-                except ValueError:
-                    print("Channel '%s' is not known" % (name))
+            numbers, bad = parseNumbers(cnums, self.channels.maxNumber(prefix))
+            if len(bad) > 0:
+                print("Channel numbers '%s' are not understood or not known" %
+                      (",".join(bad)))
+            indices, missing = self.channels.indicesOf(prefix, numbers)
+            if len(missing) > 0:
+                print("Channels %s:%s are not known" % (prefix, formatNumbers(missing)))
+            chosen.append(indices)
+        self.chosenChannels = np.unique(np.concatenate(chosen)).tolist()
         self.channelChooserBox.setCurrentIndex(0)
-        print("The chosen channels are ", self.chosenChannels)
+        print("The chosen channels are %s" % formatNumbers(self.chosenChannels))
 
     def getstate(self, name):
-        "Get the self.trigger_state value named name. If mutiple values, return None"
-        channels = self.chosenChannels
-        if len(channels) == 0:
-            return None
-        for ch in channels:
-            if ch not in self.trigger_state:
-                return None
-        x = self.trigger_state[channels[0]].get(name, None)
-        if x is None:
-            return None
-        for ch in channels[1:]:
-            y = self.trigger_state[ch].get(name, None)
-            if x != y:
-                return None
-        return x
+        "Get the chosen channels' trigger state value named name. If mutiple values, return None"
+        return self.triggerStates.get(self.chosenChannels, name)
 
     def alltriggerstates(self):
-        """Return all unique dictionaries that are values in the self.trigger_state dict.
-        There might be 100s of entries in self.trigger_state dict but only one or a few
-        unique values in it."""
-
-        # A set() might seem natural but cannot be used to store unhashable items like dicts.
-        allstates = []
-        for ch in self.chosenChannels:
-            # This will add a trigger state to the list only if it's not already in the list.
-            if ch in self.trigger_state and self.trigger_state[ch] not in allstates:
-                allstates.append(self.trigger_state[ch])
-
-        # Now we need to split states if any of allstates refers to channels both
-        # in AND out of self.chosenChannels. Those dictionaries each become 2 dictionaries.
-        for state in allstates:
-            chans = state["ChannelIndices"]
-            keep = []
-            splitoff = []
-            for c in chans:
-                if c in self.chosenChannels:
-                    keep.append(c)
-                else:
-                    splitoff.append(c)
-            if len(splitoff) > 0:
-                state["ChannelIndices"] = keep
-                for c in keep:
-                    self.trigger_state[c] = state
-                newstate = state.copy()
-                newstate["ChannelIndices"] = splitoff
-                for c in splitoff:
-                    self.trigger_state[c] = newstate
-
-        return allstates
+        """Return the unique trigger states of the chosen channels, each listing only
+        chosen channels in its "ChannelIndices"."""
+        return self.triggerStates.statesFor(self.chosenChannels)
 
     def setstate(self, name, newvalue):
-        "Set the self.trigger_state value named name to newvalue"
-        for state in self.alltriggerstates():
-            state[name] = newvalue
+        "Set the trigger state value named name to newvalue for the chosen channels"
+        self.flushChannelText(updateGUI=False)
+        channels = self.chosenChannels
+        self.triggerStates.set(channels, name, newvalue)
+        self.pendingEdits = [e for e in self.pendingEdits
+                             if not (e[0] is channels and e[1] == name)]
+        self.pendingEdits.append((channels, name, newvalue))
         return newvalue
 
     def updateTriggerGUIElements(self):
         """Given the self.chosenChannels, update the various trigger status GUI elements."""
 
+        common = self.triggerStates.common(self.chosenChannels)
         boxes = (
             (self.autoTrigActive, "AutoTrigger"),
             (self.edgeTrigActive, "EdgeTrigger"),
             (self.levelTrigActive, "LevelTrigger"),
         )
         for (checkbox, name) in boxes:
-            state = self.getstate(name)
+            state = common.get(name)
             checkbox.setTristate(state is None)
             if state is not None:
                 checkbox.setChecked(state)
@@ -236,14 +253,14 @@ class TriggerConfig(QtWidgets.QWidget):
             (self.levelEdit, "LevelLevel", levelscale),
         )
         for (edit, name, scale) in edits:
-            state = self.getstate(name)
+            state = common.get(name)
             if state is None:
                 edit.setText("")
                 continue
             edit.setText("%f" % (state*scale))
 
-        r = self.getstate("EdgeRising")
-        f = self.getstate("EdgeFalling")
+        r = common.get("EdgeRising")
+        f = common.get("EdgeFalling")
         if r and f:
             self.edgeRiseFallBoth.setCurrentIndex(2)
         elif f:
@@ -284,6 +301,53 @@ class TriggerConfig(QtWidgets.QWidget):
         self.changedEdgeTrigConfig()
         self.changedLevelTrigConfig()
 
+    def scheduleTriggerStates(self):
+        """Send the trigger edits once no more have come for editDelay ms."""
+        self.editTimer.start()
+        self.showPendingEdits()
+
+    def flushTriggerEdits(self):
+        """Send any trigger edits waiting to be sent, now."""
+        if self.editTimer.isActive():
+            self.sendTriggerStates()
+
+    def cancelTriggerEdits(self):
+        """Drop any trigger edits waiting to be sent, as when other trigger states are
+        about to be sent for all channels. (Edits already sent reach Dastard before any
+        later call, as all calls share the client's one queue.) The TRIGGER messages that
+        follow will show the states Dastard ends up with."""
+        if len(self.pendingEdits) > 0:
+            print("Dropped %d trigger edits not yet sent" % len(self.pendingEdits))
+        self.editTimer.stop()
+        self.pendingEdits = []
+        self.showPendingEdits()
+
+    @pyqtSlot()
+    def sendTriggerStates(self):
+        """Send the trigger states of all channels edited since the last send, in one
+        pipelined batch."""
+        self.editTimer.stop()
+        if len(self.pendingEdits) == 0:
+            self.showPendingEdits()
+            return
+        edited = np.unique(np.concatenate([np.asarray(c, dtype=int)
+                                           for (c, _, _) in self.pendingEdits]))
+        self.pendingEdits = []
+        states = self.triggerStates.statesFor(edited)
+        calls = [("SourceControl.ConfigureTriggers", state) for state in states]
+        self.editsInFlight += 1
+        self.showPendingEdits()
+        self.client.call_many(calls, callback=self.sentTriggerStates)
+
+    def sentTriggerStates(self, results):
+        self.editsInFlight -= 1
+        self.showPendingEdits()
+
+    def showPendingEdits(self):
+        """Show the label saying that trigger edits are pending, if any are."""
+        pending = self.editTimer.isActive() or self.editsInFlight > 0
+        self.pendingEditsLabel.setVisible(pending)
+
     @pyqtSlot()
     def changedAutoTrigConfig(self):
         auto = self.autoTrigActive.checkState()
@@ -297,8 +361,7 @@ class TriggerConfig(QtWidgets.QWidget):
             self.setstate("AutoDelay", nsdelay)
         except ValueError:
             pass
-        for state in self.alltriggerstates():
-            self.client.call("SourceControl.ConfigureTriggers", state)
+        self.scheduleTriggerStates()
 
     @pyqtSlot()
     def changedEdgeTrigConfig(self):
@@ -327,8 +390,7 @@ class TriggerConfig(QtWidgets.QWidget):
             self.setstate("EdgeLevel", edgeraw)
         except ValueError:
             pass
-        for state in self.alltriggerstates():
-            self.client.call("SourceControl.ConfigureTriggers", state)
+        self.scheduleTriggerStates()
 
     @pyqtSlot()
     def changedLevelTrigConfig(self):
@@ -356,8 +418,7 @@ class TriggerConfig(QtWidgets.QWidget):
             self.setstate("LevelLevel", levelraw)
         except ValueError:
             pass
-        for state in self.alltriggerstates():
-            self.client.call("SourceControl.ConfigureTriggers", state)
+        self.scheduleTriggerStates()
 
     @pyqtSlot()
     def changedLevelUnits(self):
@@ -1,7 +1,7 @@
 # Qt5 imports
 import PyQt5.uic
 from PyQt5 import QtWidgets
-from PyQt5.QtCore import pyqtSignal, pyqtSlot, Qt, QSettings
+from PyQt5.QtCore import pyqtSignal, pyqtSlot, Qt, QSettings, QTimer
 
 # other non qt imports
 import os
@@ -9,6 +9,8 @@ from enum import Enum
 import numpy as np
 import time
 from . import projectors
+from .dispatch import STATUS_RECORD_LENGTH
+from .trigger_state import TriggerReconciler
 
 """keep track of the state of sync between the GUI and dastard"""
 
@@ -53,7 +55,9 @@ class TriggerConfigSimple(QtWidgets.QWidget):
         self.connect()
         self.setPulseSync(Sync.UNKNOWN)
         self.setProjectorSync(False)
-        self._lastSentConfig = None
+        self.reconciler = TriggerReconciler(dcom.asyncClient)
+        self._sentSync = None  # the Sync that the trigger states last sent amount to
+        self._confirming = False  # whether Dastard has yet to confirm the states last sent
         self._lastSentConfigTime = None
 
     def setupCombo(self):
@@ -93,21 +97,16 @@ class TriggerConfigSimple(QtWidgets.QWidget):
         self.setPulseSync(Sync.UNKNOWN)
 
     def handleSendNoise(self):
-        self.setPulseSync(Sync.NOISE)
         self.writeSettings()  # there are no noise settings, but if there are in the future, we're good
-        self.zeroAllTriggers()
         self.sendRecordLength()
         config = {
             "ChannelIndices": self.channelIndicesSignalOnlyWithExcludes(),
             "AutoTrigger": True
         }
-        self.client.call("SourceControl.ConfigureTriggers", config)
-        self._lastSentConfig = config
-        self._lastSentConfigTime = time.time()
+        self.sendTriggers(config, Sync.NOISE)
 
     def handleSendPulse(self):
         self.writeSettings()
-        self.zeroAllTriggers()
         self.sendRecordLength()
         # first send the trigger mesage for all channels
         s = self.comboBox_twoTriggers.currentText()
@@ -123,10 +122,40 @@ class TriggerConfigSimple(QtWidgets.QWidget):
             "EdgeMultiLevel": self.spinBox_level.value(),
             "EdgeMultiDisableZeroThreshold": self.checkBox_disableZeroThreshold.isChecked(),
         }
-        self.client.call("SourceControl.ConfigureTriggers", config)
-        self._lastSentConfig = config
+        self.sendTriggers(config, Sync.PULSE)
+
+    def sendTriggers(self, config, sync: Sync):
+        """Make config the trigger state of its channels, with all triggers off for all
+        other channels. Only the channels whose state differs from what Dastard last
+        reported are sent, and the sync is shown once Dastard reports the new states."""
+        # Edits still waiting in the advanced tab would otherwise be sent after these.
+        # Those already sent reach Dastard first (the calls share one queue), but aren't
+        # yet in the reported states, so then send the states of every channel.
+        triggerTab = self.dcom.triggerTab
+        triggerTab.cancelTriggerEdits()
+        full = triggerTab.editsInFlight > 0
+        self.reconciler.setDesired([self.zeroTriggersConfig(), config])
+        self._sentSync = sync
+        self._confirming = True
         self._lastSentConfigTime = time.time()
-        self.setPulseSync(Sync.PULSE)
+        ncalls = self.reconciler.reconcile(full, callback=self.checkTriggerSync)
+        print("Sent %d ConfigureTriggers calls for %s triggers" % (ncalls, sync.name.lower()))
+        self.checkTriggerSync()
+        if self.reconciler.isPending():
+            # In case Dastard never reports the states sent, check again after the timeout.
+            wait_ms = int(1000*self.reconciler.confirmTimeout)+100
+            QTimer.singleShot(wait_ms, self.checkTriggerSync)
+
+    def checkTriggerSync(self):
+        """Once Dastard has reported the states sent, show whether they took. After that,
+        show if they change."""
+        if self._sentSync is None or self.reconciler.isPending():
+            return
+        if not self.reconciler.isConverged():
+            self.setPulseSync(Sync.UNKNOWN)
+        elif self._confirming:
+            self.setPulseSync(self._sentSync)
+        self._confirming = False
 
     def handleUIChange(self):
         self.setPulseSync(Sync.UNKNOWN)
@@ -182,20 +211,34 @@ class TriggerConfigSimple(QtWidgets.QWidget):
         time.sleep(0.1)
         self.dcom.triggerTab.blockSignals(False)
 
-    def zeroAllTriggers(self):
-        config = {
+    def zeroTriggersConfig(self):
+        """The ConfigureTriggers parameter that turns off all triggers on all channels."""
+        return {
             "ChannelIndices": self.dcom.channelIndicesAll(),
         }
-        self.client.call("SourceControl.ConfigureTriggers", config)
 
     def channelIndicesSignalOnlyWithExcludes(self):
         return self.dcom.channelIndicesSignalOnly()
         # TODO: add exclude list, and maybe a way to auto populate it?
 
-    def handleTriggerMessage(self, d, nmsg):
-        """If DASTARD indicates the trigger state has changed, change the UI to say so."""
-        # we assume any TRIGGER message more than 100 ms after this class changed the trigger settings
-        # has changed the state
+    def topicHandlers(self):
+        """The handlers of ZMQ status messages, by topic."""
+        return {STATUS_RECORD_LENGTH: self.handleStatusMessage,
+                "TRIGGER": self.handleTriggerMessage,
+                "TRIGCOUPLING": self.handleTrigCouplingMessage}
+
+    def handleStatusMessage(self, d):
+        self.handleNsamplesNpresamplesMessage(d["Nsamples"], d["Npresamp"])
+
+    def handleTriggerMessage(self, d):
+        """Show whether DASTARD's trigger state is (still) the one last sent."""
+        self.reconciler.handleTriggerMessage(d)
+        self.checkTriggerSync()
+
+    def handleTrigCouplingMessage(self, d):
+        """If DASTARD indicates the trigger coupling has changed, change the UI to say so."""
+        # we assume any TRIGCOUPLING message more than 1.5 s after this class changed the
+        # trigger settings has changed the state
         if self._lastSentConfigTime is None:
             return
         elapsed_s = time.time()-self._lastSentConfigTime
@@ -218,7 +261,7 @@ class TriggerConfigSimple(QtWidgets.QWidget):
 
     def handleSendProjectors(self):
         fileName = self.lineEdit_projectors.text()
-        success = projectors.sendProjectors(self, fileName, self.dcom.channel_names, self.client)
+        success = projectors.sendProjectors(self, fileName, self.dcom.channels, self.client)
         print(f"sendprojectors success success = {success}")
         if success:
             self.settings.setValue("projectors_file", self.lineEdit_projectors.text())
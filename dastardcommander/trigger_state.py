@@ -0,0 +1,280 @@
+"""
+The trigger state of every channel, stored as a few groups of identical configuration,
+and the reconciling of Dastard's trigger states with the states wanted.
+"""
+
+import json
+import time
+
+import numpy as np
+
+
+class TriggerStateStore(object):
+    """The trigger state of every channel, as sent in Dastard's TRIGGER messages.
+
+    There may be thousands of channels but usually only a few distinct trigger
+    configurations. Each distinct configuration (a dict of the trigger settings, without
+    the "ChannelIndices") is stored once as a group with an integer id, and groupOf is a
+    NumPy array of the group id of each channel, or -1 where the state isn't known.
+    Looking up or changing the state of a set of channels thus costs O(channels) in
+    NumPy plus a little per group, and changing only some of a group's channels splits
+    it in two."""
+
+    def __init__(self):
+        self.groupOf = np.zeros(0, dtype=int)
+        self.states = {}  # group id -> trigger state
+        self._keys = {}  # group id -> key of its state
+        self._ids = {}  # key of a state -> group id, for finding identical states
+        self._nextId = 0
+
+    def __len__(self):
+        """The number of distinct states."""
+        return len(self.states)
+
+    def update(self, dicts):
+        """Set the state of the channels in each trigger state of dicts (a TRIGGER message)."""
+        for d in dicts:
+            state = {k: v for (k, v) in d.items() if k != "ChannelIndices"}
+            channels = np.asarray(d["ChannelIndices"], dtype=int)
+            if len(channels) == 0:
+                continue
+            self._grow(channels.max()+1)
+            self.groupOf[channels] = self._add(state)
+        self._tidy()
+
+    def groups(self, channels):
+        """Return the ids of the groups of channels, or None if any channel's state isn't
+        known."""
+        channels = np.asarray(channels, dtype=int)
+        if len(channels) == 0 or channels.max() >= len(self.groupOf):
+            return None
+        ids = np.unique(self.groupOf[channels])
+        if ids[0] < 0:
+            return None
+        return ids
+
+    def common(self, channels):
+        """Return the trigger settings shared by all of channels, as a dict. A setting that
+        differs between them is None, and all are None if any channel's state isn't known."""
+        ids = self.groups(channels)
+        if ids is None:
+            return {}
+        result = dict(self.states[ids[0]])
+        for gid in ids[1:]:
+            for name, value in self.states[gid].items():
+                if result.get(name) != value:
+                    result[name] = None
+        return result
+
+    def get(self, channels, name):
+        """Return the setting name shared by all of channels, or None if it differs."""
+        return self.common(channels).get(name)
+
+    def set(self, channels, name, value):
+        """Change the setting name to value for those of channels whose states are known."""
+        chosen = self._mask(channels) & (self.groupOf >= 0)
+        if not np.any(chosen):
+            return
+        ids, inverse, counts = np.unique(self.groupOf[chosen], return_inverse=True,
+                                         return_counts=True)
+        sizes = np.bincount(self.groupOf[self.groupOf >= 0])
+        whole = counts == sizes[ids]
+        # Groups wholly chosen are changed in place; the chosen channels of the others
+        # are split off into groups of their own.
+        newIds = ids.copy()
+        for k, gid in enumerate(ids.tolist()):
+            state = dict(self.states[gid])
+            state[name] = value
+            if whole[k]:
+                self._rekey(gid, state)
+            else:
+                newIds[k] = self._add(state)
+        self.groupOf[chosen] = newIds[inverse.ravel()]
+        self._tidy()
+
+    def statesFor(self, channels):
+        """Return the trigger states of those of channels whose states are known, as a list
+        of dicts with "ChannelIndices", in the form of a TRIGGER message or of the
+        parameter of SourceControl.ConfigureTriggers. Each lists only channels among
+        channels."""
+        chosen = self._mask(channels) & (self.groupOf >= 0)
+        result = []
+        for gid in np.unique(self.groupOf[chosen]):
+            state = dict(self.states[gid])
+            state["ChannelIndices"] = np.nonzero(chosen & (self.groupOf == gid))[0].tolist()
+            result.append(state)
+        return result
+
+    def _mask(self, channels):
+        """Return a boolean array over all channels, True for those of channels that exist."""
+        channels = np.asarray(channels, dtype=int)
+        mask = np.zeros(len(self.groupOf), dtype=bool)
+        mask[channels[(channels >= 0) & (channels < len(mask))]] = True
+        return mask
+
+    def _grow(self, nchan):
+        if nchan > len(self.groupOf):
+            groupOf = np.full(nchan, -1, dtype=int)
+            groupOf[:len(self.groupOf)] = self.groupOf
+            self.groupOf = groupOf
+
+    @staticmethod
+    def _key(state):
+        return json.dumps(state, sort_keys=True)
+
+    def _add(self, state):
+        """Return the id of the group with the given state, new unless one already has it."""
+        key = self._key(state)
+        gid = self._ids.get(key)
+        if gid is not None:
+            return gid
+        gid = self._nextId
+        self._nextId += 1
+        self.states[gid] = state
+        self._keys[gid] = key
+        self._ids[key] = gid
+        return gid
+
+    def _rekey(self, gid, state):
+        """Give group gid a new state. If another group already has that state, the two are
+        left for _tidy to merge."""
+        old = self._keys[gid]
+        if self._ids.get(old) == gid:
+            del self._ids[old]
+        key = self._key(state)
+        self.states[gid] = state
+        self._keys[gid] = key
+        self._ids.setdefault(key, gid)
+
+    def _tidy(self):
+        """Merge groups with identical states and forget groups without channels."""
+        used = np.zeros(self._nextId, dtype=bool)
+        used[self.groupOf[self.groupOf >= 0]] = True
+        for gid in [g for g in self.states if not used[g]]:
+            key = self._keys.pop(gid)
+            if self._ids.get(key) == gid:
+                del self._ids[key]
+            del self.states[gid]
+        # Where a state's group isn't the one _ids knows, it's a duplicate: merge it.
+        remap = np.arange(self._nextId)
+        for gid in list(self.states):
+            key = self._keys[gid]
+            first = self._ids.setdefault(key, gid)
+            if first != gid:
+                remap[gid] = first
+                del self.states[gid]
+                del self._keys[gid]
+        if np.any(remap != np.arange(self._nextId)):
+            known = self.groupOf >= 0
+            self.groupOf[known] = remap[self.groupOf[known]]
+
+
+def sameState(a, b):
+    """Whether trigger states a and b (dicts, without "ChannelIndices") are the same to
+    Dastard, which takes a missing setting as zero (or false)."""
+    for name in set(a) | set(b):
+        if name != "ChannelIndices" and (a.get(name) or 0) != (b.get(name) or 0):
+            return False
+    return True
+
+
+class TriggerReconciler(object):
+    """Bring Dastard's trigger states to the wanted states with few ConfigureTriggers calls.
+
+    The reconciler knows the trigger states Dastard last reported (in TRIGGER messages,
+    which must be passed to handleTriggerMessage) and the states wanted (set with
+    setDesired). reconcile() sends, in one batch, one SourceControl.ConfigureTriggers
+    call for each distinct wanted state, listing only the channels not already in that
+    state. Dastard reports the new states in TRIGGER messages; once they match the
+    wanted states, isConverged() is true. Until then, or until confirmTimeout seconds
+    have passed, the calls sent are pending.
+
+    client must be an rpc_client.AsyncJSONClient: the calls are queued behind the GUI's
+    other calls (such as the trigger tab's edits), so they reach Dastard after them."""
+
+    confirmTimeout = 2.0  # seconds
+
+    def __init__(self, client):
+        self.client = client
+        self.reported = TriggerStateStore()
+        self.desired = None
+        self.sentTime = None  # when the calls last sent were sent, until confirmed
+        self.awaitingReply = False  # whether the calls last sent are yet to be answered
+
+    def setDesired(self, configs):
+        """Want the states in configs, a list of ConfigureTriggers parameters (dicts with
+        "ChannelIndices"), where a later config overrides an earlier one. As for
+        ConfigureTriggers, settings a config doesn't list are zero."""
+        self.desired = TriggerStateStore()
+        self.desired.update(configs)
+
+    def handleTriggerMessage(self, dicts):
+        self.reported.update(dicts)
+
+    def calls(self, full=False):
+        """Return the ConfigureTriggers calls needed to bring the reported states to the
+        desired states, as (method, parameter) pairs. If full, as though no states had
+        been reported (when others' calls may yet change them)."""
+        if self.desired is None:
+            return []
+        want = self.desired.groupOf
+        have = np.full(len(want), -1, dtype=int)
+        n = min(len(want), len(self.reported.groupOf))
+        if not full:
+            have[:n] = self.reported.groupOf[:n]
+
+        # Compare states once per distinct (wanted, reported) pair of groups.
+        stale = np.zeros(len(want), dtype=bool)
+        pairs = np.unique(np.stack([want, have], axis=1), axis=0)
+        for w, h in pairs:
+            if w < 0:
+                continue
+            if h < 0 or not sameState(self.desired.states[w], self.reported.states[h]):
+                stale |= (want == w) & (have == h)
+
+        calls = []
+        for w in np.unique(want[stale]):
+            state = dict(self.desired.states[w])
+            state["ChannelIndices"] = np.nonzero(stale & (want == w))[0].tolist()
+            calls.append(("SourceControl.ConfigureTriggers", state))
+        return calls
+
+    def reconcile(self, full=False, callback=None):
+        """Send the calls needed (see calls), as one batch. Return the number of calls sent.
+        If given, callback() is called once they are answered."""
+        calls = self.calls(full)
+        self.sentTime = None
+        self.awaitingReply = False
+        if len(calls) > 0:
+            sentTime = self.sentTime = time.time()
+            self.awaitingReply = True
+
+            def sent(results):
+                if self.sentTime != sentTime:
+                    return  # Newer calls were sent since.
+                self.awaitingReply = False
+                # Calls that failed won't be confirmed.
+                if results is None or any(error for (_, error) in results):
+                    self.sentTime = None
+                if callback is not None:
+                    callback()
+            self.client.call_many(calls, callback=sent)
+        return len(calls)
+
+    def isPending(self):
+        """Whether the calls last sent are neither confirmed by the reported states nor
+        past confirmTimeout. They aren't confirmed before they are answered, as until then
+        the reported states may come from calls made before them."""
+        if self.sentTime is None:
+            return False
+        if time.time()-self.sentTime > self.confirmTimeout:
+            self.sentTime = None
+            return False
+        if not self.awaitingReply and self.isConverged():
+            self.sentTime = None
+            return False
+        return True
+
+    def isConverged(self):
+        """Whether the reported trigger states are the desired states."""
+        return self.desired is not None and len(self.calls()) == 0
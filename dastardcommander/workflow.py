@@ -59,8 +59,7 @@ class Workflow(QtWidgets.QWidget):
         self.pushButton_loadProjectors.clicked.connect(self.handleLoadProjectors)
         self.pushButton_viewProjectorsPlot.clicked.connect(self.handleViewProjectorsPlot)
         self.dc = dc
-        self.channel_names = None  # to be overwritten by dc.py
-        self.channel_prefixes = None  # to be overwritten by dc.py
+        self.channels = None  # a ChannelTable, to be overwritten by dc.py
         self.nsamples = None  # to be set by handleStatusUpdate
         self.npresamples = None  # to be set by handleStatusUpdate
         self.numberWritten = 0  # to be set by handleNumberWritten
@@ -110,7 +109,7 @@ class Workflow(QtWidgets.QWidget):
         """
         # set triggers to auto for all fb channels
         self.reset()
-        print(self.channel_names)
+        print(self.channels)
         if self.currentlyWriting:
             em = QtWidgets.QErrorMessage(self)
             em.showMessage("dastard is currently writing, stop it and try again")
@@ -120,7 +119,7 @@ class Workflow(QtWidgets.QWidget):
         self.dc.writingTab.start()
 
         comment = """Noise Data\nWorkflow: Take Noise button pushed"""
-        self.dc.client.call("SourceControl.WriteComment", comment)
+        self.dc.asyncClient.call("SourceControl.WriteComment", comment)
         # wait for 1000 records/channels
         # dont know how to do this yet, so lets just wait for 3 seconds
         TIME_UNITS_TO_WAIT = 30
@@ -149,7 +148,7 @@ class Workflow(QtWidgets.QWidget):
         """
         take pulse data, record filename for future use
         """
-        print(self.channel_names)
+        print(self.channels)
         if self.currentlyWriting:
             em = QtWidgets.QErrorMessage(self)
             em.showMessage("dastard is currently writing, stop it and try again")
@@ -158,7 +157,7 @@ class Workflow(QtWidgets.QWidget):
         # start writing files
         self.dc.writingTab.start()
         comment = """Pulse Data for analysis training\nWorkflow: Take Pulses button pushed"""
-        self.dc.client.call("SourceControl.WriteComment", comment)
+        self.dc.asyncClient.call("SourceControl.WriteComment", comment)
         # wait for 1000 records/channels
         # dont know how to do this yet, so lets just wait for 3 seconds
         # its more important than in the noise case to count written records
@@ -256,6 +255,12 @@ class Workflow(QtWidgets.QWidget):
             self.label_loadedProjectors.setText("projectors loaded? yes")
             self.projectorsLoadedSig.emit(True)
 
+    def topicHandlers(self):
+        """The handlers of ZMQ status messages, by topic."""
+        return {("STATUS", ("Nsamples", "Npresamp", "Nchannels")): self.handleStatusUpdate,
+                "WRITING": self.handleWritingMessage,
+                "NUMBERWRITTEN": self.handleNumberWritten}
+
     def handleStatusUpdate(self, d):
         if self.nsamples != d["Nsamples"] or self.npresamples != d["Npresamp"]:
             if self.nsamples is not None:  # don't reset on startup
@@ -35,6 +35,11 @@ class WritingControl(QtWidgets.QWidget):
             cbd.setEnabled(False)
             cbd.setToolTip("Dialog to choose data writing path disabled for remote clients.")
 
+    def topicHandlers(self):
+        """The handlers of ZMQ status messages, by topic."""
+        return {"WRITING": self.handleWritingMessage,
+                "NUMBERWRITTEN": self.handleNumberWritten}
+
     def handleWritingMessage(self, message):
         print(message)
         if message["Active"]:
@@ -118,11 +123,18 @@ class WritingControl(QtWidgets.QWidget):
         self.client.call("SourceControl.WriteControl", {"Request": request})
 
     def comment(self):
+        # Open the dialog only once the current comment has been read from the server.
+        self.client.call("SourceControl.ReadComment", 0, errorBox=False,
+                         callback=self.openCommentDialog)
+
+    def openCommentDialog(self, readCommentResult):
         parent = None
         title = "Enter a comment to be stored"
         label = "Enter a comment to be stored with the data file as comment.txt"
         default = "Operator, settings, purpose..."
-        reply, error = self.client.call("SourceControl.ReadComment", 0, errorBox=False)
+        if readCommentResult is None:
+            return
+        reply, error = readCommentResult
         # The synchronous function getMultiLineText is blocking, which causes us to
         # miss heartbeats and crashes dc. Instead, we build a QInputDialog
         # and connect to a signal
@@ -6,7 +6,9 @@ ZMQ PUB-SUB pattern to port 5501 (or other, as given in command-line)
 
 usage:
 
-python zmq_sub_client.py [portnum]
+python zmq_sub_client.py [host:port] [TOPIC ...]
+
+If any topics are given, only messages on those topics are received and printed.
 """
 
 import sys
@@ -15,6 +17,7 @@ import zmq
 host = "localhost:5501"
 if len(sys.argv) > 1:
     host = sys.argv[1]
+topics = set(sys.argv[2:])
 
 # Socket to talk to server
 context = zmq.Context()
@@ -23,15 +26,21 @@ socket = context.socket(zmq.SUB)
 print("Collecting updates from dastard server...")
 socket.connect("tcp://%s" % host)
 
-# for topicfilter in ("TRIGGER", "STATUS"):
-#     socket.setsockopt_string(zmq.SUBSCRIBE, topicfilter)
-socket.setsockopt_string(zmq.SUBSCRIBE, "")
+if len(topics) > 0:
+    # ZMQ filters match on prefix, so TRIGGER would also bring TRIGGERRATE; the
+    # exact topics are checked again below.
+    for topicfilter in topics:
+        socket.setsockopt_string(zmq.SUBSCRIBE, topicfilter)
+else:
+    socket.setsockopt_string(zmq.SUBSCRIBE, "")
 
 total_value = 0
 while True:
     message = socket.recv_multipart()
     if len(message) == 2:
         topic, messagedata = message
+        if len(topics) > 0 and topic.decode() not in topics:
+            continue
         print(topic, messagedata)
     else:
         print("WARNING: message of length {} is {}".format(len(message), message))
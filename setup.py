@@ -11,6 +11,7 @@ setup(
     python_requires='>=3.5',
     description="Gui for DASTARD.",
     install_requires=["numpy", "PyQt5", "h5py", "zmq", "matplotlib"],
+    extras_require={"fast": ["orjson"]},
     license="MIT license",
     include_package_data=True,
     keywords='dastardcommander',
@@ -22,6 +23,7 @@ setup(
     zip_safe=False,
     package_data={'dastardcommander': ['ui/*.ui', 'ui/*.png']},
     entry_points={
-        'console_scripts': ['dcom=dastardcommander.dc:main'],
+        'console_scripts': ['dcom=dastardcommander.dc:main',
+                            'dcom-simulator=dastardcommander.simulator:main'],
     },
 )
@@ -0,0 +1,57 @@
+import unittest
+
+import numpy as np
+
+from dastardcommander.channels import ChannelTable, formatNumbers, parseNumbers
+
+
+class TestParseNumbers(unittest.TestCase):
+
+    def test_round_trip(self):
+        for numbers in ([], [7], [1, 2], [1, 2, 3, 5, 7, 9, 12], list(range(1, 4000, 2))):
+            text = formatNumbers(numbers)
+            parsed, bad = parseNumbers(text)
+            self.assertEqual(bad, [])
+            self.assertEqual(np.unique(parsed).tolist(), sorted(numbers))
+        self.assertEqual(formatNumbers(range(1, 4000, 2)), "1-3999:2")
+
+    def test_bad_terms(self):
+        """Terms that aren't ASCII numbers or sensible ranges are reported, not raised."""
+        for text in ("x", "²", "١", "-3", "5-2", "7-", "3-9:0", "3-9:", "1:2",
+                     "1234567890123456789", "1-12345678901234567890"):
+            parsed, bad = parseNumbers(text)
+            self.assertEqual(len(parsed), 0, text)
+            self.assertEqual(bad, [text])
+        parsed, bad = parseNumbers("1,,3-9:3,x")
+        self.assertEqual(sorted(parsed.tolist()), [1, 3, 6, 9])
+        self.assertEqual(bad, ["x"])
+
+    def test_huge_ranges(self):
+        """Ranges stop at maxNumber, so they can't allocate more than that."""
+        parsed, bad = parseNumbers("0-999999999999999999", maxNumber=10)
+        self.assertEqual(parsed.tolist(), list(range(11)))
+        self.assertEqual(bad, [])
+        parsed, bad = parseNumbers("0-9999999999")
+        self.assertEqual(len(parsed), 1000000)
+        parsed, bad = parseNumbers("20-30,5", maxNumber=10)
+        self.assertEqual(parsed.tolist(), [5])
+        self.assertEqual(bad, ["20-30"])
+
+
+class TestChannelTable(unittest.TestCase):
+
+    def test_indices(self):
+        names = ["chan1", "err1", "chan3", "err3", "chan5"]
+        table = ChannelTable(names)
+        self.assertEqual(table.maxNumber("chan"), 5)
+        self.assertEqual(table.maxNumber("foo"), -1)
+        indices, missing = table.indicesOf("chan", [5, 1, 2, 99, -1])
+        self.assertEqual(indices.tolist(), [4, 0])
+        self.assertEqual(missing.tolist(), [2, 99, -1])
+        self.assertEqual(table.signalIndices(), [0, 2, 4])
+        self.assertEqual(table.indexOf("err3"), 3)
+        self.assertIsNone(table.indexOf("err4"))
+
+
+if __name__ == "__main__":
+    unittest.main()